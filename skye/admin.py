@@ -1,8 +1,47 @@
+from django.conf import settings
 from django.contrib import admin
+from django.contrib.admin.views.main import PAGE_VAR, ChangeList
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models.lookups import LessThan
+from django.http import QueryDict, StreamingHttpResponse
+from django.utils.functional import cached_property
+from django.utils.html import format_html_join
 from django.utils.translation import gettext_lazy as _
 
-from .models import User, Profile, RedeemCode
+from .exports import iter_redeem_codes_csv
+from .models import User, Profile, RedeemCode, GiftCampaign, Completion
+
+
+class EstimatedCountPaginator(Paginator):
+    """Counts unfiltered changelists of big MySQL tables with the table
+    statistics instead of COUNT(*). The id__lt cursor of CursorChangeList
+    doesn't count as a filter: the pages it links to are estimated too."""
+
+    @staticmethod
+    def is_unfiltered(qs):
+        return all(
+            isinstance(lookup, LessThan)
+            and getattr(lookup.lhs, "target", None) == qs.model._meta.pk
+            for lookup in qs.query.where.children
+        )
+
+    @cached_property
+    def count(self):
+        qs = self.object_list
+        connection = connections[qs.db]
+        if self.is_unfiltered(qs) and connection.vendor == "mysql":
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT TABLE_ROWS FROM information_schema.TABLES"
+                    " WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s",
+                    [qs.model._meta.db_table],
+                )
+                row = cursor.fetchone()
+            if row and row[0] and row[0] > settings.ADMIN_EXACT_COUNT_LIMIT:
+                return row[0]
+        return super().count
 
 
 class ProfileInline(admin.StackedInline):
@@ -43,6 +82,11 @@ class UserAdmin(BaseUserAdmin):
     )
     inlines = (ProfileInline,)
     list_display = ("name", "email", "is_staff", "date_joined", "last_login")
+    list_select_related = ("profile",)
+    # usernames are emails, a prefix search can use their unique index
+    search_fields = ("^username",)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
     @admin.display(ordering="profile__name")
     def name(self, obj):
@@ -50,13 +94,42 @@ class UserAdmin(BaseUserAdmin):
 
 
 class ProfileAdmin(admin.ModelAdmin):
-    fields = ("name", "is_vip")
+    fields = ("name", "is_vip", "downline_size", "referral_gifts", "downline_tree")
+    readonly_fields = ("downline_size", "referral_gifts", "downline_tree")
     list_display = ("name", "is_vip")
     actions = None
 
     def has_add_permission(self, request):
         return None
 
+    @admin.display(description=_("Downline size"))
+    def downline_size(self, obj):
+        return obj.downline_stats()["downline"]
+
+    @admin.display(description=_("Referral gifts"))
+    def referral_gifts(self, obj):
+        return obj.downline_stats()["gifted"]
+
+    @admin.display(description=_("Downline"))
+    def downline_tree(self, obj):
+        downline = (
+            obj.downline()
+            .select_related("user")
+            .order_by("invitation_path")[: settings.INVITATION_TREE_LIMIT]
+        )
+        return format_html_join(
+            "\n",
+            '<div style="padding-left: {}em">{} &lt;{}&gt;</div>',
+            (
+                (
+                    (p.invitation_depth - obj.invitation_depth - 1) * 2,
+                    p.name,
+                    p.user.email,
+                )
+                for p in downline
+            ),
+        )
+
 
 class RedeemCodeAdmin(admin.ModelAdmin):
     fieldsets = (
@@ -73,9 +146,132 @@ class RedeemCodeAdmin(admin.ModelAdmin):
         ),
     )
     readonly_fields = ("code",)
-    list_display = ("code", "amount", "created_at", "redeemed_at")
-    list_filter = ("amount",)
-    search_fields = ("code",)
+    list_display = ("code", "amount", "batch", "created_at", "redeemed_at")
+    list_filter = ("batch",)
+    # a prefix search can use the unique index of the codes
+    search_fields = ("^code",)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    actions = ("export_csv",)
+
+    @admin.action(description=_("Export selected redeem codes as CSV"))
+    def export_csv(self, request, queryset):
+        response = StreamingHttpResponse(
+            iter_redeem_codes_csv(queryset), content_type="text/csv"
+        )
+        response["Content-Disposition"] = 'attachment; filename="redeemcodes.csv"'
+        return response
+
+
+class GiftCampaignAdmin(admin.ModelAdmin):
+    fields = ("name", "target", "amount", "active_since", "min_invitees")
+    list_display = (
+        "name",
+        "target",
+        "amount",
+        "status",
+        "processed",
+        "created_at",
+        "finished_at",
+    )
+    list_filter = ("status", "target")
+    actions = ("run_campaigns",)
+
+    def get_readonly_fields(self, request, obj=None):
+        # a started campaign can't change its target nor amount
+        return self.fields if obj else ()
+
+    @admin.action(description=_("Run selected campaigns"))
+    def run_campaigns(self, request, queryset):
+        # run by `run_gift_campaign --queued`, not in the request
+        queued = queryset.filter(status=GiftCampaign.STATUS_PENDING).update(
+            status=GiftCampaign.STATUS_QUEUED
+        )
+        self.message_user(
+            request,
+            f"{queued} campaigns queued, run_gift_campaign --queued will run them",
+        )
+
+
+class ShardListFilter(admin.SimpleListFilter):
+    """Picks the shard to browse, the queryset is routed by CompletionAdmin."""
+
+    title = _("shard")
+    parameter_name = "shard"
+
+    def lookups(self, request, model_admin):
+        return [(alias, alias) for alias in settings.COMPLETION_SHARDS]
+
+    def queryset(self, request, queryset):
+        return queryset
+
+
+class CursorChangeList(ChangeList):
+    """Links to the next page by the last id of the current one, so that
+    browsing deep into a big table doesn't need a large OFFSET."""
+
+    def get_results(self, request):
+        super().get_results(request)
+        self.cursor_url = None
+        if len(self.result_list) == self.list_per_page:
+            self.cursor_url = self.get_query_string(
+                {"id__lt": self.result_list[len(self.result_list) - 1].pk},
+                [PAGE_VAR],
+            )
+        self.newest_url = self.get_query_string(remove=["id__lt", PAGE_VAR])
+
+
+class CompletionAdmin(admin.ModelAdmin):
+    list_display = (
+        "id",
+        "user",
+        "model",
+        "upstream_model",
+        "total_usage",
+        "finish_reason",
+        "created_at",
+    )
+    list_select_related = ("user",)
+    readonly_fields = ("prompt", "completion")
+    date_hierarchy = "created_at"
+    ordering = ("-id",)
+    search_fields = ("=user__id",)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_changelist(self, request, **kwargs):
+        return CursorChangeList
+
+    def get_list_filter(self, request):
+        return (ShardListFilter,) if settings.COMPLETION_SHARDS else ()
+
+    def get_list_display(self, request):
+        if settings.COMPLETION_SHARDS:
+            # users live on the primary, they can't be joined
+            return ("id", "user_id") + self.list_display[2:]
+        return self.list_display
+
+    def get_list_select_related(self, request):
+        return () if settings.COMPLETION_SHARDS else self.list_select_related
+
+    def get_queryset(self, request):
+        qs = super().get_queryset(request)
+        shards = settings.COMPLETION_SHARDS
+        if shards:
+            # the change view keeps the filters of the changelist
+            filters = QueryDict(request.GET.get("_changelist_filters", ""))
+            alias = request.GET.get("shard") or filters.get("shard")
+            qs = qs.using(alias if alias in shards else shards[0])
+        return qs
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
 
 
 admin.site.site_header = "SKYE Administration"
@@ -85,3 +281,5 @@ admin.site.unregister(User)
 admin.site.register(User, UserAdmin)
 admin.site.register(Profile, ProfileAdmin)
 admin.site.register(RedeemCode, RedeemCodeAdmin)
+admin.site.register(GiftCampaign, GiftCampaignAdmin)
+admin.site.register(Completion, CompletionAdmin)
@@ -0,0 +1,164 @@
+"""Request parsing and response rendering shared by the views.
+
+Bodies are decoded with orjson when it is installed, otherwise with the
+standard json module, and validated against schemas compiled once, so that
+malformed requests are rejected before any database or upstream work.
+"""
+import functools
+import itertools
+import json
+from http import HTTPStatus
+from string import Formatter
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse
+
+from .gpt import AVAILABLE_MODELS
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+_encoder = DjangoJSONEncoder()
+
+if orjson:
+    loads = orjson.loads
+
+    def dumps(data) -> bytes:
+        # datetimes are formatted the way DjangoJSONEncoder does
+        return orjson.dumps(
+            data, default=_encoder.default, option=orjson.OPT_PASSTHROUGH_DATETIME
+        )
+
+else:
+    loads = json.loads
+
+    def dumps(data) -> bytes:
+        return json.dumps(data, cls=DjangoJSONEncoder).encode("utf-8")
+
+
+class JsonResponse(HttpResponse):
+    """Like django.http.JsonResponse, with the faster codec."""
+
+    def __init__(self, data, **kwargs):
+        kwargs.setdefault("content_type", "application/json")
+        super().__init__(content=dumps(data), **kwargs)
+
+
+def bad_request(detail):
+    return JsonResponse(
+        {"error": "bad_request", "detail": detail}, status=HTTPStatus.BAD_REQUEST
+    )
+
+
+class _Optional:
+    def __init__(self, spec):
+        self.spec = spec
+
+
+def optional(spec):
+    """A field which may be missing or null."""
+    return _Optional(spec)
+
+
+def _compile(spec):
+    if isinstance(spec, Schema):
+        return lambda value, path: spec.validate(value, f"{path}.")
+    if isinstance(spec, tuple):
+        choices = frozenset(spec)
+
+        def check_choice(value, path):
+            if not isinstance(value, (str, int)) or value not in choices:
+                return f"{path} must be one of {', '.join(map(str, spec))}"
+
+        return check_choice
+
+    # bools are ints to isinstance()
+    excluded = bool if spec is int else ()
+
+    def check_type(value, path):
+        if not isinstance(value, spec) or isinstance(value, excluded):
+            return f"{path} must be {spec.__name__}"
+
+    return check_type
+
+
+class Schema:
+    """Validates a decoded JSON object. ``fields`` maps each key to a type,
+    a tuple of the allowed values or a nested Schema, wrapped in optional()
+    unless the key is required. Unknown keys are ignored."""
+
+    def __init__(self, fields: dict):
+        self._checks = []
+        for name, spec in fields.items():
+            required = not isinstance(spec, _Optional)
+            if not required:
+                spec = spec.spec
+            self._checks.append((name, required, _compile(spec)))
+
+    def validate(self, data, path=""):
+        """The first problem found with ``data``, or None."""
+        if not isinstance(data, dict):
+            return f"{path[:-1] or 'body'} must be object"
+        for name, required, check in self._checks:
+            value = data.get(name)
+            if value is None:
+                if required:
+                    return f"{path}{name} is required"
+                continue
+            error = check(value, f"{path}{name}")
+            if error:
+                return error
+        return None
+
+
+def json_body(schema: Schema = None):
+    """Decode the JSON body into ``request.data``, or answer 400 if it is
+    malformed or doesn't match ``schema``."""
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            try:
+                data = loads(request.body)
+            except ValueError:
+                return bad_request("body must be JSON")
+            error = schema.validate(data) if schema else None
+            if error:
+                return bad_request(error)
+            request.data = data
+            return view(request, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@functools.lru_cache(maxsize=None)
+def model_schema(name) -> Schema:
+    """The schema of the prompts and params of an ask of model ``name``."""
+    model_class = AVAILABLE_MODELS[name]
+    choices = model_class.param_choices
+    fields = set(model_class.prompt_fields or ())
+    if not fields:
+        # the template may depend on the params, e.g. on the language
+        for values in itertools.product(*choices.values()):
+            model = model_class()
+            model.set_params(dict(zip(choices, values)))
+            t = model.prompt_template
+            text = "\n".join(t) if isinstance(t, tuple) else t
+            fields.update(f for _, f, _, _ in Formatter().parse(text) if f)
+
+    params = Schema(choices)
+    return Schema(
+        {
+            "prompts": Schema(
+                {f: model_class.prompt_choices.get(f, str) for f in sorted(fields)}
+            ),
+            # models without a default template need the params to pick one
+            "params": (
+                optional(params) if hasattr(model_class, "prompt_template") else params
+            ),
+        }
+    )
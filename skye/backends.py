@@ -0,0 +1,28 @@
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+
+from . import passwords
+
+UserModel = get_user_model()
+
+
+class PasswordPoolBackend(ModelBackend):
+    """ModelBackend hashing passwords in the pool of skye.passwords. Raises
+    passwords.Overloaded when the pool is full."""
+
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        if username is None:
+            username = kwargs.get(UserModel.USERNAME_FIELD)
+        if username is None or password is None:
+            return None
+        try:
+            user = UserModel._default_manager.get_by_natural_key(username)
+        except UserModel.DoesNotExist:
+            # hash anyway, not to tell missing users by the time it takes
+            passwords.make_password(password)
+            return None
+        if passwords.check_password(user, password) and self.user_can_authenticate(
+            user
+        ):
+            return user
+        return None
@@ -0,0 +1,72 @@
+"""The balance of the users: settled usage, and holds on it for the
+completions in flight."""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from .models import Profile, Completion, BalanceHold
+from .routers import shard_for
+
+
+def account(user):
+    total_usage = user.completion_set.aggregate(Sum("total_usage"))["total_usage__sum"]
+    paid_balance = user.redeemcode_set.aggregate(Sum("amount"))["amount__sum"]
+    gifted_balance = user.gift_set.aggregate(Sum("amount"))["amount__sum"]
+    return {
+        "total_usage": total_usage or 0,
+        "paid_balance": paid_balance or 0,
+        "gifted_balance": gifted_balance or 0,
+    }
+
+
+def reserve(user, amount, ttl=None):
+    """Put a hold of ``amount`` on the balance of ``user``, or return None if
+    the balance is exhausted by settled usage and other holds. The hold
+    lasts ``ttl`` seconds, BALANCE_HOLD_TTL by default.
+
+    The hold is written before anything is read, so concurrent reservations
+    of the same user are serialized by the profile row lock (and by the
+    database write lock on SQLite). No lock outlives this short transaction.
+    """
+    now = timezone.now()
+    user.balancehold_set.filter(expires_at__lte=now).delete()
+    with transaction.atomic():
+        hold = BalanceHold.objects.create(
+            user=user,
+            amount=amount,
+            expires_at=now + timedelta(seconds=ttl or settings.BALANCE_HOLD_TTL),
+        )
+        Profile.objects.select_for_update().filter(user=user).values_list(
+            "pk", flat=True
+        ).get()
+        held = (
+            user.balancehold_set.filter(expires_at__gt=now)
+            .exclude(pk=hold.pk)
+            .aggregate(Sum("amount"))["amount__sum"]
+        )
+        a = account(user)
+        if a["paid_balance"] + a["gifted_balance"] - a["total_usage"] - (held or 0) < 0:
+            transaction.set_rollback(True)
+            return None
+    return hold
+
+
+def settle(user, codename, prompts, completion, hold):
+    """Record the completion and release its hold on the balance."""
+    # the completion is committed first when it lives on another shard
+    with transaction.atomic(), transaction.atomic(using=shard_for(user.pk)):
+        Completion.objects.create(
+            user=user,
+            model=codename,
+            upstream_model=completion.get("upstream_model", ""),
+            prompt=prompts,
+            completion=completion["completion"],
+            finish_reason=completion["finish_reason"],
+            prompt_usage=completion["prompt_token_usage"],
+            completion_usage=completion["completion_token_usage"],
+            total_usage=completion["total_token_usage"],
+        )
+        hold.delete()
@@ -0,0 +1,38 @@
+"""Encoding of the bodies kept in the Blob table: addressed by the SHA-256
+of their text, and compressed with zstd when it is installed, otherwise
+with zlib. Every blob records its codec, so both can be read anywhere."""
+import hashlib
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+# shorter texts are not worth compressing
+MIN_COMPRESS_SIZE = 64
+
+
+def digest(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def compress(text: str):
+    """The codec and the data to store ``text`` with."""
+    raw = text.encode("utf-8")
+    if len(raw) < MIN_COMPRESS_SIZE:
+        return "", raw
+    if zstandard:
+        codec, data = "zstd", zstandard.ZstdCompressor(level=3).compress(raw)
+    else:
+        codec, data = "zlib", zlib.compress(raw, 6)
+    return (codec, data) if len(data) < len(raw) else ("", raw)
+
+
+def decompress(codec: str, data: bytes) -> str:
+    data = bytes(data)
+    if codec == "zstd":
+        data = zstandard.ZstdDecompressor().decompress(data)
+    elif codec == "zlib":
+        data = zlib.decompress(data)
+    return data.decode("utf-8")
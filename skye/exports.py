@@ -0,0 +1,21 @@
+import csv
+
+REDEEM_CODE_COLUMNS = ("code", "amount", "batch", "created_at")
+
+
+class _Echo:
+    """A file-like object that returns what is written instead of buffering
+    it, so that csv.writer can feed a generator."""
+
+    def write(self, value):
+        return value
+
+
+def iter_redeem_codes_csv(queryset, chunk_size=2000):
+    """Yield the redeem codes of ``queryset`` as CSV lines, reading them from
+    the database in chunks instead of loading the whole batch."""
+    writer = csv.writer(_Echo())
+    yield writer.writerow(REDEEM_CODE_COLUMNS)
+    rows = queryset.order_by("pk").values_list(*REDEEM_CODE_COLUMNS)
+    for row in rows.iterator(chunk_size=chunk_size):
+        yield writer.writerow(row)
@@ -0,0 +1,136 @@
+"""A local stand-in for the completions endpoint of upstream, enforcing per
+key limits of requests and tokens over a sliding window and answering with
+the same x-ratelimit headers, to test the credential pool against."""
+import json
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def _tokens(text):
+    return len(text) // 4 + 1
+
+
+class FakeUpstream:
+    """Serves the keys of ``limits``, a dict of key to (requests, tokens)
+    allowed per ``window`` seconds, "*" standing for any other key. Each
+    completion takes ``latency`` seconds. Use it as a context manager."""
+
+    def __init__(self, limits, window=60.0, text="Hi!", latency=0.0, port=0):
+        self.limits = limits
+        self.window = window
+        self.text = text
+        self.latency = latency
+        self.served = Counter()
+        self.rejected = Counter()
+        self._calls = defaultdict(deque)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_port}/v1"
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def _limits(self, key):
+        return self.limits.get(key) or self.limits.get("*")
+
+    def _headers(self, key, now):
+        calls = self._calls[key]
+        max_requests, max_tokens = self._limits(key)
+        reset = f"{self.window - (now - calls[0][0]):.3f}s" if calls else "0s"
+        return {
+            "x-ratelimit-limit-requests": str(max_requests),
+            "x-ratelimit-limit-tokens": str(max_tokens),
+            "x-ratelimit-remaining-requests": str(max(0, max_requests - len(calls))),
+            "x-ratelimit-remaining-tokens": str(
+                max(0, max_tokens - sum(tokens for _, tokens in calls))
+            ),
+            "x-ratelimit-reset-requests": reset,
+            "x-ratelimit-reset-tokens": reset,
+        }
+
+    def complete(self, key, body):
+        """The status, headers and payload of a completion request."""
+        if not self._limits(key):
+            return 401, {}, {"error": {"message": "Invalid key", "type": "auth"}}
+        prompts = body.get("prompt", "")
+        prompts = prompts if isinstance(prompts, list) else [prompts]
+        prompt_tokens = sum(_tokens(p) for p in prompts)
+        completion_tokens = min(body.get("max_tokens", 16), _tokens(self.text))
+        # upstream counts max_tokens against the limit
+        cost = prompt_tokens + body.get("max_tokens", 16) * len(prompts)
+
+        with self._lock:
+            now = time.monotonic()
+            calls = self._calls[key]
+            while calls and calls[0][0] <= now - self.window:
+                calls.popleft()
+            max_requests, max_tokens = self._limits(key)
+            used = sum(tokens for _, tokens in calls)
+            if len(calls) >= max_requests or used + cost > max_tokens:
+                self.rejected[key] += 1
+                headers = self._headers(key, now)
+                headers["retry-after"] = headers["x-ratelimit-reset-tokens"][:-1]
+                return (
+                    429,
+                    headers,
+                    {"error": {"message": "Rate limit reached", "type": "requests"}},
+                )
+            calls.append((now, cost))
+            self.served[key] += 1
+            headers = self._headers(key, now)
+
+        if self.latency:
+            time.sleep(self.latency)
+        choices = [
+            {"text": self.text, "index": i, "finish_reason": "stop", "logprobs": None}
+            for i in range(len(prompts))
+        ]
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens * len(prompts),
+            "total_tokens": prompt_tokens + completion_tokens * len(prompts),
+        }
+        payload = {
+            "id": "cmpl-fake",
+            "object": "text_completion",
+            "model": body.get("model"),
+            "choices": choices,
+            "usage": usage,
+        }
+        return 200, headers, payload
+
+    def _handler(self):
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                key = self.headers.get("Authorization", "").replace("Bearer ", "")
+                status, headers, payload = upstream.complete(key, body)
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
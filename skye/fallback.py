@@ -0,0 +1,149 @@
+"""Fallback of the upstream models of a product when they breach their SLOs.
+
+Each product routes to the first model of its route that is not tripped:
+the model of its class followed by its fallback_models, or the route of
+GPT_MODEL_ROUTES. The latency and the errors of every product and model are
+watched over the last GPT_SLO_WINDOW seconds; a model whose p90 latency or
+error rate breaches its SLO is tripped for GPT_FALLBACK_COOLDOWN seconds,
+then gets the traffic back and is judged on fresh samples.
+"""
+import logging
+import threading
+import time
+from collections import Counter, defaultdict, deque
+
+import openai
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# failures of upstream, which count against the SLOs of a model
+UPSTREAM_ERRORS = (
+    openai.error.APIError,
+    openai.error.APIConnectionError,
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.Timeout,
+    openai.error.TryAgain,
+)
+
+
+def route_of(product, model) -> list:
+    """The upstream models of ``product``, ``model`` being its model class."""
+    route = settings.GPT_MODEL_ROUTES.get(product)
+    if route:
+        return [m.strip() for m in route.split("|") if m.strip()]
+    return [model.model, *model.fallback_models]
+
+
+class Health:
+    def __init__(self):
+        self.samples = deque()
+        self.tripped_until = None
+
+    def prune(self, now):
+        while self.samples and self.samples[0][0] <= now - settings.GPT_SLO_WINDOW:
+            self.samples.popleft()
+
+    def p90(self):
+        latencies = sorted(latency for _, latency, _ in self.samples)
+        return latencies[int(len(latencies) * 0.9)] if latencies else None
+
+    def error_rate(self):
+        if not self.samples:
+            return None
+        return sum(1 for _, _, ok in self.samples if not ok) / len(self.samples)
+
+    def breach(self):
+        """Which SLO the samples breach, if any."""
+        if len(self.samples) < settings.GPT_SLO_MIN_SAMPLES:
+            return None
+        if self.error_rate() > settings.GPT_ERROR_RATE_SLO:
+            return "error_rate"
+        if self.p90() > settings.GPT_LATENCY_SLO:
+            return "latency"
+        return None
+
+    def as_dict(self, now):
+        p90 = self.p90()
+        error_rate = self.error_rate()
+        return {
+            "samples": len(self.samples),
+            "p90_ms": round(p90 * 1000) if p90 is not None else None,
+            "error_rate": round(error_rate, 3) if error_rate is not None else None,
+            "tripped": self.tripped_until is not None and self.tripped_until > now,
+        }
+
+
+class Router:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._health = defaultdict(Health)
+        self.fallbacks = Counter()
+
+    def route(self, product, models) -> str:
+        """The model to send the next request of ``product`` to."""
+        restored = []
+        with self._lock:
+            now = time.monotonic()
+            chosen = models[0]
+            for model in models:
+                health = self._health[(product, model)]
+                if health.tripped_until is not None:
+                    if health.tripped_until > now:
+                        continue
+                    health.tripped_until = None
+                    restored.append(model)
+                chosen = model
+                break
+            if chosen != models[0]:
+                self.fallbacks[(product, chosen)] += 1
+        for model in restored:
+            logger.info(
+                "Model restored", extra={"data": {"product": product, "model": model}}
+            )
+        return chosen
+
+    def record(self, product, model, models, latency, ok):
+        """Record a request, and trip the model if it breaches its SLOs and
+        the route has another model to fall back to."""
+        with self._lock:
+            now = time.monotonic()
+            health = self._health[(product, model)]
+            health.samples.append((now, latency, ok))
+            health.prune(now)
+            breach = health.breach() if len(models) > 1 else None
+            if not breach:
+                return
+            health.tripped_until = now + settings.GPT_FALLBACK_COOLDOWN
+            # of the samples which tripped it
+            d = dict(health.as_dict(now), product=product, model=model, slo=breach)
+            health.samples.clear()
+        logger.warning("Model fallback", extra={"data": d})
+
+    def metrics(self):
+        with self._lock:
+            now = time.monotonic()
+            for health in self._health.values():
+                health.prune(now)
+            return [
+                dict(
+                    health.as_dict(now),
+                    product=product,
+                    model=model,
+                    fallbacks=self.fallbacks[(product, model)],
+                )
+                for (product, model), health in sorted(self._health.items())
+            ]
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def router() -> Router:
+    global _router
+    with _router_lock:
+        if _router is None:
+            _router = Router()
+    return _router
@@ -0,0 +1,228 @@
+"""Near-duplicate cache of completions for deterministic models.
+
+Inputs are normalized (full-width characters, case, whitespace and
+punctuation) and indexed by a MinHash signature of their character bigrams,
+split into LSH bands: near-duplicates share at least one band with high
+probability. Candidates are verified by the exact Jaccard similarity of the
+bigrams before they count as a hit; rejected candidates are counted as false
+positives of the index.
+
+The backing store has an entry per normalized input and partition, and
+keeps the newest FUZZY_CACHE_MAX_ENTRIES of a partition, the ones an index
+loads.
+"""
+import hashlib
+import random
+import struct
+import threading
+import unicodedata
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+BANDS = 8
+ROWS = 4
+PERMUTATIONS = BANDS * ROWS
+_MASK = (1 << 64) - 1
+_rng = random.Random(20230204)
+# multiply-shift hashing, one odd multiplier per permutation
+_COEFFICIENTS = [
+    (_rng.getrandbits(64) | 1, _rng.getrandbits(64)) for _ in range(PERMUTATIONS)
+]
+_SIGNATURE = struct.Struct(f">{PERMUTATIONS}I")
+
+metrics = {
+    "lookups": 0,
+    "exact_hits": 0,
+    "fuzzy_hits": 0,
+    "misses": 0,
+    "false_positives": 0,
+}
+
+
+def normalize(text: str) -> str:
+    text = unicodedata.normalize("NFKC", text).lower()
+    return "".join(c for c in text if unicodedata.category(c)[0] in "LN")
+
+
+def shingles(normalized: str) -> frozenset:
+    return frozenset(normalized[i : i + 2] for i in range(max(len(normalized) - 1, 1)))
+
+
+def minhash(grams: frozenset) -> tuple:
+    hashes = [
+        int.from_bytes(
+            hashlib.blake2b(g.encode("utf-8"), digest_size=8).digest(), "big"
+        )
+        for g in grams
+    ]
+    return tuple(
+        min((a * h + b) & _MASK for h in hashes) >> 32 for a, b in _COEFFICIENTS
+    )
+
+
+def pack(signature: tuple) -> bytes:
+    return _SIGNATURE.pack(*signature)
+
+
+def unpack(data: bytes) -> tuple:
+    return _SIGNATURE.unpack(bytes(data))
+
+
+def _bands(signature: tuple):
+    return [(i, signature[i * ROWS : (i + 1) * ROWS]) for i in range(BANDS)]
+
+
+class FuzzyIndex:
+    """Up to ``max_entries`` entries, the least recently used evicted first."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        # normalized: (normalized, shingles, value, signature), oldest first
+        self.exact = OrderedDict()
+        # band: {normalized: entry}
+        self.bands = {}
+
+    def add(self, normalized: str, signature: tuple, value):
+        self.remove(normalized)
+        entry = (normalized, shingles(normalized), value, signature)
+        self.exact[normalized] = entry
+        for band in _bands(signature):
+            self.bands.setdefault(band, {})[normalized] = entry
+        while len(self.exact) > self.max_entries:
+            self.remove(next(iter(self.exact)))
+
+    def remove(self, normalized: str):
+        entry = self.exact.pop(normalized, None)
+        if entry is None:
+            return
+        for band in _bands(entry[3]):
+            entries = self.bands[band]
+            del entries[normalized]
+            if not entries:
+                del self.bands[band]
+
+    def lookup(self, normalized: str, signature: tuple, fuzzy=True):
+        """Return the ``(value, exact)`` of the most similar entry, or None.
+        Without ``fuzzy``, only of the entry of ``normalized``."""
+        entry = self.exact.get(normalized)
+        if entry:
+            self.exact.move_to_end(normalized)
+            return entry[2], True
+        if not fuzzy:
+            return None
+
+        grams = shingles(normalized)
+        seen = set()
+        best, best_similarity = None, settings.FUZZY_CACHE_MIN_SIMILARITY
+        for band in _bands(signature):
+            for candidate in self.bands.get(band, {}).values():
+                if candidate[0] in seen:
+                    continue
+                seen.add(candidate[0])
+                similarity = len(grams & candidate[1]) / len(grams | candidate[1])
+                if similarity < settings.FUZZY_CACHE_MIN_SIMILARITY:
+                    metrics["false_positives"] += 1
+                elif similarity >= best_similarity:
+                    best, best_similarity = candidate, similarity
+        if best is None:
+            return None
+        self.exact.move_to_end(best[0])
+        return best[2], False
+
+
+_indexes = {}
+_lock = threading.Lock()
+
+
+def _index(partition: str) -> FuzzyIndex:
+    """The in-memory index of a partition, loaded from the backing store the
+    first time it is used by this process. Called without holding _lock: the
+    load runs outside of it, and the first index published wins."""
+    from .models import CompletionCacheEntry
+
+    with _lock:
+        index = _indexes.get(partition)
+    if index is not None:
+        return index
+
+    index = FuzzyIndex(settings.FUZZY_CACHE_MAX_ENTRIES)
+    entries = CompletionCacheEntry.objects.filter(partition=partition).order_by("-pk")[
+        : settings.FUZZY_CACHE_MAX_ENTRIES
+    ]
+    # oldest first, so that the newest are the last evicted
+    for entry in reversed(list(entries)):
+        index.add(entry.normalized, unpack(entry.signature), entry.as_dict())
+    with _lock:
+        return _indexes.setdefault(partition, index)
+
+
+def get(partition: str, text: str, fuzzy=True):
+    normalized = normalize(text)
+    signature = minhash(shingles(normalized))
+    index = _index(partition)
+    with _lock:
+        metrics["lookups"] += 1
+        found = index.lookup(normalized, signature, fuzzy)
+        if not found:
+            metrics["misses"] += 1
+            return None
+        value, exact = found
+        metrics["exact_hits" if exact else "fuzzy_hits"] += 1
+        return value
+
+
+def _prune(partition: str):
+    """Delete the entries of ``partition`` older than the newest
+    FUZZY_CACHE_MAX_ENTRIES, which no index loads anymore."""
+    from .models import CompletionCacheEntry
+
+    entries = CompletionCacheEntry.objects.filter(partition=partition)
+    limit = settings.FUZZY_CACHE_MAX_ENTRIES
+    newest_dropped = entries.order_by("-pk").values_list("pk", flat=True)[
+        limit : limit + 1
+    ]
+    for pk in newest_dropped:
+        entries.filter(pk__lte=pk).delete()
+
+
+def put(partition: str, text: str, value: dict):
+    from .models import CompletionCacheEntry
+
+    normalized = normalize(text)
+    signature = minhash(shingles(normalized))
+    entry = CompletionCacheEntry(
+        partition=partition,
+        normalized=normalized,
+        digest=hashlib.sha256(normalized.encode("utf-8")).hexdigest(),
+        signature=pack(signature),
+        completion=value["completion"],
+        finish_reason=value["finish_reason"],
+        prompt_usage=value["prompt_token_usage"],
+        completion_usage=value["completion_token_usage"],
+        total_usage=value["total_token_usage"],
+    )
+    # replaces the entry of the same text, which an index may have evicted,
+    # as the newest
+    try:
+        with transaction.atomic():
+            CompletionCacheEntry.objects.filter(
+                partition=partition, digest=entry.digest
+            ).delete()
+            entry.save(force_insert=True)
+    except IntegrityError:
+        # stored by another process meanwhile
+        pass
+    else:
+        _prune(partition)
+    index = _index(partition)
+    with _lock:
+        index.add(normalized, signature, entry.as_dict())
+
+
+def reset():
+    with _lock:
+        _indexes.clear()
+        for k in metrics:
+            metrics[k] = 0
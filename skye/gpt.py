@@ -1,8 +1,18 @@
-import openai
+import hashlib
+import logging
+import re
+import threading
+import time
+from types import SimpleNamespace
+
 from django.conf import settings
 
+from skye_server import log
+from . import fallback, fuzzy_cache, upstream
 from .gpt_models import v1
 
+logger = logging.getLogger(__name__)
+
 KEYWORD_BLACKLIST = ("gpt", "openai", "chat", "microsoft", "微软", "小冰", "小度", "天猫精灵")
 
 
@@ -23,9 +33,16 @@ def test_client():
     return lambda m: FakeResponse()
 
 
-def openai_client():
-    openai.api_key = settings.OPENAI_KEY
+def send(params: dict):
+    """Send a completion request upstream with a credential of the pool."""
+    prompts = params["prompt"]
+    prompts = prompts if isinstance(prompts, list) else [prompts]
+    tokens = sum(calculate_tokens(p) for p in prompts)
+    tokens += params.get("max_tokens", 0) * len(prompts)
+    return upstream.pool().complete(params, tokens)
 
+
+def openai_client():
     def decoy():
         client = test_client()
         fake = client({})
@@ -41,7 +58,10 @@ def openai_client():
             if kw in params["prompt"]:
                 return decoy()
 
-        data = openai.Completion.create(**params)
+        if settings.GPT_BATCH_WINDOW > 0:
+            data = batcher().submit(params)
+        else:
+            data = send(params)
 
         # sometimes completion_tokens is missed...
         if not hasattr(data.usage, "completion_tokens"):
@@ -56,10 +76,185 @@ def openai_client():
     return client
 
 
+# the prompt and the completion share this many tokens
+MAX_TOKENS = 4096
+# ... or this many, for the upstream models with another context size
+CONTEXT_SIZES = {
+    "text-curie-001": 2049,
+    "text-babbage-001": 2049,
+    "text-ada-001": 2049,
+}
+
+
+def context_size(model: str) -> int:
+    return CONTEXT_SIZES.get(model, MAX_TOKENS)
+
+
 def calculate_tokens(s):
     return len(s) * 3
 
 
+def _split(text, pattern):
+    parts = re.split(pattern, text)
+    # glue each separator to the part before it
+    return [a + b for a, b in zip(parts[::2], parts[1::2] + [""]) if a + b]
+
+
+def split_text(text, max_tokens):
+    """Split ``text`` into chunks of at most ``max_tokens`` tokens, at
+    paragraph boundaries where possible, otherwise at sentence boundaries,
+    and only cut through a sentence longer than the budget."""
+    pieces = []
+    for paragraph in _split(text, r"(\n\s*\n)"):
+        if calculate_tokens(paragraph) <= max_tokens:
+            pieces.append(paragraph)
+            continue
+        for sentence in _split(paragraph, r"((?<=[.!?;。！？；])\s*)"):
+            if calculate_tokens(sentence) <= max_tokens:
+                pieces.append(sentence)
+                continue
+            size = max(1, len(sentence) * max_tokens // calculate_tokens(sentence))
+            pieces.extend(sentence[i : i + size] for i in range(0, len(sentence), size))
+
+    chunks = []
+    for piece in pieces:
+        if chunks and calculate_tokens(chunks[-1] + piece) <= max_tokens:
+            chunks[-1] += piece
+        else:
+            chunks.append(piece)
+    return [chunk.strip() for chunk in chunks if chunk.strip()]
+
+
+def _split_usage(total, weights):
+    """Split ``total`` proportionally to ``weights`` so that the parts sum up
+    to ``total`` exactly (largest remainder method)."""
+    weight_sum = sum(weights)
+    if not weight_sum:
+        weights = [1] * len(weights)
+        weight_sum = len(weights)
+    exact = [total * w / weight_sum for w in weights]
+    parts = [int(x) for x in exact]
+    by_remainder = sorted(
+        range(len(weights)), key=lambda i: exact[i] - parts[i], reverse=True
+    )
+    for i in by_remainder[: total - sum(parts)]:
+        parts[i] += 1
+    return parts
+
+
+class _Batch:
+    def __init__(self):
+        self.params = []
+        self.results = None
+        self.error = None
+        self.full = threading.Event()
+        self.done = threading.Event()
+
+
+class MicroBatcher:
+    """Collects concurrent completion requests sharing the same model and
+    sampling params for a short window and sends them upstream as a single
+    multi-prompt request, then hands each caller its own choice and a fair
+    share of the usage."""
+
+    def __init__(self, send, window, max_size, tokens_bucket):
+        self.send = send
+        self.window = window
+        self.max_size = max_size
+        self.tokens_bucket = tokens_bucket
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def batch_key(self, params: dict):
+        return tuple(
+            sorted(
+                (k, v) for k, v in params.items() if k not in ("prompt", "max_tokens")
+            )
+        ) + (
+            params.get("max_tokens", 0) // self.tokens_bucket,
+        )
+
+    def submit(self, params: dict):
+        key = self.batch_key(params)
+        with self._lock:
+            batch = self._pending.get(key)
+            is_leader = batch is None
+            if is_leader:
+                batch = self._pending[key] = _Batch()
+            index = len(batch.params)
+            batch.params.append(params)
+            if len(batch.params) >= self.max_size:
+                del self._pending[key]
+                batch.full.set()
+
+        if is_leader:
+            batch.full.wait(self.window)
+            with self._lock:
+                if self._pending.get(key) is batch:
+                    del self._pending[key]
+            self._flush(batch)
+
+        batch.done.wait()
+        if batch.error:
+            raise batch.error
+        return batch.results[index]
+
+    def _flush(self, batch: _Batch):
+        try:
+            if len(batch.params) == 1:
+                batch.results = [self.send(batch.params[0])]
+            else:
+                batch.results = self._send_many(batch.params)
+        except Exception as err:
+            batch.error = err
+        finally:
+            batch.done.set()
+
+    def _send_many(self, many: list):
+        params = dict(many[0])
+        params["prompt"] = [p["prompt"] for p in many]
+        if "max_tokens" in params:
+            params["max_tokens"] = min(p["max_tokens"] for p in many)
+        response = self.send(params)
+
+        choices = sorted(response.choices, key=lambda c: c.index)
+        usage = response.usage
+        prompt_usage = _split_usage(
+            usage.prompt_tokens, [calculate_tokens(p["prompt"]) for p in many]
+        )
+        completion_usage = _split_usage(
+            getattr(usage, "completion_tokens", 0), [len(c.text) for c in choices]
+        )
+        return [
+            SimpleNamespace(
+                choices=[choice],
+                usage=SimpleNamespace(
+                    prompt_tokens=prompt_usage[i],
+                    completion_tokens=completion_usage[i],
+                    total_tokens=prompt_usage[i] + completion_usage[i],
+                ),
+            )
+            for i, choice in enumerate(choices)
+        ]
+
+
+_batcher = None
+_batcher_lock = threading.Lock()
+
+
+def batcher() -> MicroBatcher:
+    global _batcher
+    with _batcher_lock:
+        if _batcher is None:
+            _batcher = MicroBatcher(
+                send=send,
+                window=settings.GPT_BATCH_WINDOW,
+                max_size=settings.GPT_BATCH_SIZE,
+                tokens_bucket=settings.GPT_BATCH_TOKENS_BUCKET,
+            )
+    return _batcher
+
+
 AVAILABLE_MODELS = {
     "general": v1.GPTModel,
     "dict": v1.DictionaryModel,
@@ -81,15 +276,17 @@ AVAILABLE_MODELS = {
 class GPT:
     TESTING = False
 
-    def __init__(self, model: v1.BaseModel):
+    def __init__(self, model: v1.BaseModel, name: str = None):
         self.model = model
+        # the product, as named in the API
+        self.name = name or model.codename
         self.request = test_client() if self.TESTING else openai_client()
 
     @staticmethod
     def load_model(name):
         if name in AVAILABLE_MODELS:
             target_model = AVAILABLE_MODELS[name]()
-            return GPT(target_model)
+            return GPT(target_model, name)
         else:
             return None
 
@@ -98,16 +295,34 @@ class GPT:
             self.model.set_params(params)
 
         prompt = self.model.prompt(**prompts)
-        if settings.DEBUG:
-            print("*** PROMPT DEBUG START ***\n", prompt, "\n*** PROMPT DEBUG END ***")
+        prompt_tokens = calculate_tokens(prompt)
+        data = self.model.as_dict()
 
-        max_tokens = 4096 - calculate_tokens(prompt)
-        data = self.model.as_dict(max_tokens=max_tokens)
-        if settings.DEBUG:
-            print(data)
+        use_cache = settings.FUZZY_CACHE_ENABLED and self.model.fuzzy_cache
+        if use_cache:
+            partition = self.cache_partition()
+            text = "\n".join(str(prompts[k]) for k in sorted(prompts))
+            cached = fuzzy_cache.get(partition, text, self.model.fuzzy_match)
+            if cached:
+                return dict(cached, prompt=prompt)
 
-        response = self.request(data)
-        return {
+        # only fall back to the models the prompt fits in
+        route = fallback.route_of(self.name, self.model)
+        route = [m for m in route if context_size(m) > prompt_tokens] or route[:1]
+        data["model"] = fallback.router().route(self.name, route)
+        data["max_tokens"] = context_size(data["model"]) - prompt_tokens
+        started = time.perf_counter()
+        try:
+            response = self.request(data)
+        except fallback.UPSTREAM_ERRORS:
+            # unlike the errors of the request itself, e.g. a too long prompt
+            elapsed = time.perf_counter() - started
+            fallback.router().record(self.name, data["model"], route, elapsed, False)
+            raise
+        elapsed = time.perf_counter() - started
+        fallback.router().record(self.name, data["model"], route, elapsed, True)
+        completion = {
+            "upstream_model": data["model"],
             "prompt": prompt,
             "completion": response.choices[0].text,
             "finish_reason": response.choices[0].finish_reason,
@@ -115,3 +330,35 @@ class GPT:
             "completion_token_usage": response.usage.completion_tokens,
             "total_token_usage": response.usage.total_tokens,
         }
+        self.log(completion, elapsed)
+        # decoys and truncated answers are not worth caching
+        if use_cache and completion["finish_reason"] == "stop":
+            fuzzy_cache.put(partition, text, completion)
+        return completion
+
+    def log(self, completion: dict, elapsed: float):
+        d = {
+            "model": self.model.codename,
+            "upstream_model": completion["upstream_model"],
+            "finish_reason": completion["finish_reason"],
+            "total_token_usage": completion["total_token_usage"],
+            "elapsed_ms": round(elapsed * 1000),
+        }
+        if log.sampled(self.model.codename):
+            d["prompt"] = completion["prompt"]
+            d["completion"] = completion["completion"]
+        logger.info("Completion", extra={"data": d})
+
+    def chunk_prompts(self, prompts: dict, max_tokens: int):
+        """The prompts of each chunk of the long text of a chunking model."""
+        field = self.model.chunk_field
+        chunks = split_text(str(prompts[field]), max_tokens)
+        return [dict(prompts, **{field: chunk}) for chunk in chunks] or [prompts]
+
+    def cache_partition(self):
+        """Completions are only shared between requests rendering the same
+        prompt template with the same sampling params."""
+        h = hashlib.sha1()
+        h.update(repr(self.model.prompt_template).encode("utf-8"))
+        h.update(repr(self.model.as_dict(prompt=None)).encode("utf-8"))
+        return f"{self.model.codename}:{h.hexdigest()}"
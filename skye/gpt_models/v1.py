@@ -6,6 +6,25 @@ class BaseModel:
     model: str
     prompt_template: Union[str, tuple]
     temperature = 0
+    # whether near-duplicate inputs may share a completion,
+    # only for deterministic models
+    fuzzy_cache = False
+    # whether the cache may answer with the completion of a near-duplicate
+    # input, instead of only the same input once normalized
+    fuzzy_match = True
+    # the prompt holding the text of long documents, which may be split
+    # into chunks and completed one by one
+    chunk_field = None
+    # the values each param may take, see set_params()
+    param_choices = {}
+    # the prompts a request must provide, if not the placeholders of the
+    # prompt template
+    prompt_fields = None
+    # the values a prompt may take, if not any text
+    prompt_choices = {}
+    # the upstream models to fall back to when the model breaches its SLOs,
+    # see skye.fallback
+    fallback_models = ()
 
     def __init__(self):
         self._prompt = None
@@ -32,6 +51,8 @@ class BaseModel:
 
 
 class TemperatureModeMixin:
+    param_choices = {"mode": ("accurate", "balanced", "creative")}
+
     def set_params(self, d: dict) -> None:
         self.temperature = {
             "accurate": 0,
@@ -49,7 +70,10 @@ class GPTModel(BaseModel):
 class DictionaryModel(BaseModel):
     codename = "dict.1"
     model = "text-davinci-003"
+    fallback_models = ("text-curie-001",)
+    param_choices = {"lang": ("en", "cn")}
     temperature = 0
+    fuzzy_cache = True
 
     def set_params(self, d: dict) -> None:
         if d["lang"] == "en":
@@ -69,7 +93,12 @@ class DictionaryModel(BaseModel):
 class GrammarModel(BaseModel):
     codename = "grammar.1"
     model = "text-davinci-003"
+    fallback_models = ("text-curie-001",)
+    param_choices = {"lang": ("en", "cn")}
     temperature = 0
+    fuzzy_cache = True
+    # a word apart is another correction
+    fuzzy_match = False
 
     def set_params(self, d: dict) -> None:
         if d["lang"] == "en":
@@ -88,6 +117,7 @@ class GrammarModel(BaseModel):
 class ComplexSentenceModel(BaseModel):
     codename = "complex_sentence.1"
     model = "text-davinci-003"
+    param_choices = {"lang": ("en", "cn")}
     temperature = 0
 
     def set_params(self, d: dict) -> None:
@@ -129,6 +159,8 @@ class ThesisOutlineAssistantModel(TemperatureModeMixin, BaseModel):
     codename = "thesis_outline_assistant.1"
     model = "text-davinci-003"
     prompt_template = "这是我论文的{current_title_level}，{content}，帮我想下{next_title_level}怎么写。"
+    prompt_fields = ("level", "content")
+    prompt_choices = {"level": ("title", "h1", "h2")}
 
     def prompt(self, **kwargs) -> str:
         lv = kwargs["level"]
@@ -148,12 +180,14 @@ class ThesisOutlineAssistantModel(TemperatureModeMixin, BaseModel):
 class ThesisStatementExpansionModel(TemperatureModeMixin, BaseModel):
     codename = "thesis_statement_expansion.1"
     model = "text-davinci-003"
+    chunk_field = "prompt"
     prompt_template = "This is one of the arguments of the thesis：{prompt}. Please use Chinese paragraphs. Please ensure the professionalism and diversity of the discussion, and use different professional cases for each argument.Please use a variety of sentence patterns to avoid being seen as machine-generated."
 
 
 class ThesisModel(TemperatureModeMixin, BaseModel):
     codename = "thesis.1"
     model = "text-davinci-003"
+    chunk_field = "prompt"
     prompt_template = (
         "1.结构：遵循学术论文的逻辑结构，清楚地表达研究问题和目的，明确研究方法和结果。一个句子不能有多个中心思想，否则要拆分成多个句子。",
         "2.语言：使用专业术语和行业用语，确保语言精确和专业。避免使用简单的语言、俗语和个人观点。不得有病句、语法错误！",
@@ -169,6 +203,7 @@ class ThesisModel(TemperatureModeMixin, BaseModel):
 class ExpansionModel(TemperatureModeMixin, BaseModel):
     codename = "expansion.1"
     model = "text-davinci-003"
+    chunk_field = "prompt"
     prompt_template = (
         "扩写这段话：",
         "\n###\n",
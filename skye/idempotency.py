@@ -0,0 +1,169 @@
+"""Support of the Idempotency-Key header on mutating endpoints.
+
+The first request with a key claims it and runs the view; its response is
+stored and replayed to the retries with the same key, which wait for it
+while it is in progress. Server errors release the key, so they can be
+retried for real. A streamed response keeps its key in progress until it is
+consumed, and is replayed whole; a stream broken off releases the key.
+"""
+import functools
+import hashlib
+import time
+from datetime import timedelta
+from http import HTTPStatus
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils import timezone
+
+from .api import JsonResponse, bad_request
+from .models import IdempotencyKey
+
+HEADER = "Idempotency-Key"
+
+
+def _fingerprint(request):
+    h = hashlib.sha256()
+    h.update(request.path.encode("utf-8"))
+    h.update(b"\n")
+    h.update(request.body)
+    return h.hexdigest()
+
+
+def _claim(user, key, fingerprint):
+    """The claimed record, or None if another request holds the key."""
+    now = timezone.now()
+    # expired keys are purged by the purge_idempotency_keys command too,
+    # claims abandoned by crashed requests can be taken over
+    IdempotencyKey.objects.filter(user=user, expires_at__lte=now).delete()
+    IdempotencyKey.objects.filter(
+        user=user,
+        key=key,
+        status=IdempotencyKey.STATUS_IN_PROGRESS,
+        created_at__lte=now - timedelta(seconds=settings.IDEMPOTENCY_LOCK_TIMEOUT),
+    ).delete()
+    try:
+        with transaction.atomic():
+            return IdempotencyKey.objects.create(
+                user=user,
+                key=key,
+                fingerprint=fingerprint,
+                expires_at=now + timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL),
+            )
+    except IntegrityError:
+        return None
+
+
+def _wait(user, key):
+    """The record of the key once it is done, None if it is still in progress
+    after IDEMPOTENCY_WAIT seconds or was released."""
+    deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT
+    delay = 0.05
+    while True:
+        record = IdempotencyKey.objects.filter(user=user, key=key).first()
+        if record is None or record.status == IdempotencyKey.STATUS_DONE:
+            return record
+        if time.monotonic() >= deadline:
+            return None
+        time.sleep(delay)
+        delay = min(delay * 2, 0.5)
+
+
+def _replay(record):
+    response = HttpResponse(
+        bytes(record.body),
+        status=record.status_code,
+        content_type=record.content_type,
+    )
+    response["Idempotent-Replayed"] = "true"
+    return response
+
+
+def _done(record, status_code, content_type, body):
+    record.status = IdempotencyKey.STATUS_DONE
+    record.status_code = status_code
+    record.content_type = content_type
+    record.body = body
+    record.save(update_fields=("status", "status_code", "content_type", "body"))
+
+
+class _Recorded:
+    """The streamed content of a response, stored under its key once it ran
+    out. Closed before that, the key is released."""
+
+    def __init__(self, record, response):
+        self.record = record
+        self.status_code = response.status_code
+        self.content_type = response.get("Content-Type", "")
+        self.content = response.streaming_content
+        self.chunks = []
+        self.finished = False
+        self.closed = False
+
+    def __iter__(self):
+        for chunk in self.content:
+            self.chunks.append(chunk)
+            yield chunk
+        self.finished = True
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.finished:
+            _done(
+                self.record, self.status_code, self.content_type, b"".join(self.chunks)
+            )
+        else:
+            self.record.delete()
+
+
+def idempotent(view):
+    """Run this after login_required: keys are per user."""
+
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        key = request.headers.get(HEADER)
+        if key is None:
+            return view(request, *args, **kwargs)
+        if not 0 < len(key) <= 64:
+            return bad_request(f"{HEADER} must have 1 to 64 characters")
+
+        fingerprint = _fingerprint(request)
+        record = _claim(request.user, key, fingerprint)
+        if record is None:
+            record = _wait(request.user, key)
+            if record is None:
+                return JsonResponse(
+                    {"error": "request_in_progress"}, status=HTTPStatus.CONFLICT
+                )
+            if record.fingerprint != fingerprint:
+                return JsonResponse(
+                    {"error": "idempotency_key_reused"},
+                    status=HTTPStatus.UNPROCESSABLE_ENTITY,
+                )
+            return _replay(record)
+
+        try:
+            response = view(request, *args, **kwargs)
+        except Exception:
+            record.delete()
+            raise
+        if response.status_code >= 500:
+            record.delete()
+            return response
+        if isinstance(response, StreamingHttpResponse):
+            # the key is held until the response is closed
+            response.streaming_content = _Recorded(record, response)
+            return response
+
+        _done(
+            record,
+            response.status_code,
+            response.get("Content-Type", ""),
+            response.content,
+        )
+        return response
+
+    return wrapper
@@ -0,0 +1,225 @@
+"""Queue of the completion jobs, kept in the CompletionJob table.
+
+/ask queues a job with a hold on the balance and returns at once; the
+worker processes of the run_completion_workers command claim the oldest
+queued jobs with a conditional update, so a job runs once however many
+workers poll the table, and settle them like /ask does.
+"""
+import logging
+import time
+from datetime import timedelta
+
+import openai
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from skye_server import log
+
+from . import billing
+from .gpt import GPT, MAX_TOKENS
+from .models import BalanceHold, CompletionJob
+
+logger = logging.getLogger(__name__)
+
+FINISHED = (
+    CompletionJob.STATUS_DONE,
+    CompletionJob.STATUS_FAILED,
+    CompletionJob.STATUS_CANCELLED,
+)
+
+
+def queue_full() -> bool:
+    queued = CompletionJob.objects.filter(status=CompletionJob.STATUS_QUEUED)
+    return queued[: settings.JOB_QUEUE_LIMIT].count() >= settings.JOB_QUEUE_LIMIT
+
+
+def pending_count(user) -> int:
+    return user.completionjob_set.filter(status__in=CompletionJob.PENDING).count()
+
+
+def enqueue(user, data):
+    """Queue a job for the ``data`` of an ask request, or return None if
+    the balance is exhausted. The hold lasts as long as a job can."""
+    hold = billing.reserve(
+        user, MAX_TOKENS, ttl=settings.JOB_QUEUE_TIMEOUT + settings.JOB_RUN_TIMEOUT
+    )
+    if not hold:
+        return None
+    return CompletionJob.objects.create(
+        user=user,
+        model=data["model"],
+        prompts=data["prompts"],
+        params=data["params"],
+        hold=hold,
+        request_id=log.request_id.get() or "",
+    )
+
+
+def wait(user, pk, timeout):
+    """The job once it is finished, or as it is after ``timeout`` seconds;
+    None if the user has no such job."""
+    deadline = time.monotonic() + timeout
+    delay = 0.1
+    while True:
+        job = CompletionJob.objects.filter(user=user, pk=pk).first()
+        remaining = deadline - time.monotonic()
+        if job is None or job.status in FINISHED or remaining <= 0:
+            return job
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 1)
+
+
+def _finish(job, status, **fields):
+    """Move the job from ``job.status`` to ``status``, unless somebody
+    else moved it first."""
+    now = timezone.now()
+    updated = CompletionJob.objects.filter(pk=job.pk, status=job.status).update(
+        status=status, finished_at=now, **fields
+    )
+    if updated:
+        job.status = status
+        job.finished_at = now
+        for name, value in fields.items():
+            setattr(job, name, value)
+    return bool(updated)
+
+
+def _release(job):
+    BalanceHold.objects.filter(pk=job.hold_id).delete()
+
+
+def cancel(job) -> bool:
+    """Cancel a pending job. A running job is still billed, its upstream
+    call can't be taken back; its result is dropped."""
+    if job.status == CompletionJob.STATUS_QUEUED:
+        if _finish(job, CompletionJob.STATUS_CANCELLED):
+            _release(job)
+            return True
+        job.refresh_from_db()
+    if job.status == CompletionJob.STATUS_RUNNING:
+        return _finish(job, CompletionJob.STATUS_CANCELLED)
+    return False
+
+
+def claim(worker):
+    """The oldest queued job, now running on ``worker``, or None."""
+    candidates = (
+        CompletionJob.objects.filter(status=CompletionJob.STATUS_QUEUED)
+        .order_by("pk")
+        .values_list("pk", flat=True)[:10]
+    )
+    for pk in candidates:
+        claimed = CompletionJob.objects.filter(
+            pk=pk, status=CompletionJob.STATUS_QUEUED
+        ).update(
+            status=CompletionJob.STATUS_RUNNING,
+            worker=worker,
+            started_at=timezone.now(),
+        )
+        if claimed:
+            return CompletionJob.objects.select_related("user").get(pk=pk)
+    return None
+
+
+def run(job):
+    """Complete a claimed job and bill it."""
+    token = log.request_id.set(job.request_id or None)
+    try:
+        gpt = GPT.load_model(job.model)
+        try:
+            completion = gpt.create_completion(job.prompts, job.params)
+        except Exception as err:
+            if isinstance(err, openai.error.InvalidRequestError):
+                logger.error(
+                    "Upstream rejected the completion request",
+                    extra={"data": {"model": job.model, "error": str(err)}},
+                )
+            else:
+                logger.exception(
+                    "Completion job failed", extra={"data": {"job": job.pk}}
+                )
+            if _finish(job, CompletionJob.STATUS_FAILED, error="skye_internal_error"):
+                _release(job)
+            return
+
+        with transaction.atomic():
+            done = _finish(
+                job,
+                CompletionJob.STATUS_DONE,
+                completion=completion["completion"] or "\n这个我不会，请换一种表述。",
+                finish_reason=completion["finish_reason"],
+            )
+            # billed even if the job was cancelled meanwhile, not if reap()
+            # failed it and released its hold
+            if not done:
+                job.refresh_from_db(fields=("status",))
+                if job.status != CompletionJob.STATUS_CANCELLED:
+                    return
+            billing.settle(
+                job.user,
+                gpt.model.codename,
+                job.prompts,
+                completion,
+                BalanceHold(pk=job.hold_id),
+            )
+    finally:
+        log.request_id.reset(token)
+
+
+def reap():
+    """Fail the jobs queued for too long and the ones whose worker died,
+    and delete the finished jobs older than JOB_RESULT_TTL."""
+    now = timezone.now()
+    stale = (
+        (
+            CompletionJob.STATUS_QUEUED,
+            "created_at",
+            settings.JOB_QUEUE_TIMEOUT,
+            "expired",
+        ),
+        (
+            CompletionJob.STATUS_RUNNING,
+            "started_at",
+            settings.JOB_RUN_TIMEOUT,
+            "worker_lost",
+        ),
+    )
+    for status, field, timeout, error in stale:
+        jobs = CompletionJob.objects.filter(
+            status=status, **{f"{field}__lte": now - timedelta(seconds=timeout)}
+        ).only("pk", "status", "hold")
+        for job in jobs:
+            if _finish(job, CompletionJob.STATUS_FAILED, error=error):
+                _release(job)
+                logger.warning(
+                    "Completion job failed",
+                    extra={"data": {"job": job.pk, "error": error}},
+                )
+    CompletionJob.objects.filter(
+        status__in=FINISHED,
+        finished_at__lte=now - timedelta(seconds=settings.JOB_RESULT_TTL),
+    ).delete()
+
+
+def work(worker, stop, burst=False):
+    """Run the queued jobs until ``stop`` is set, or the queue is empty in
+    ``burst`` mode."""
+    reaped = None
+    while not stop.is_set():
+        if reaped is None or time.monotonic() - reaped >= settings.JOB_REAP_INTERVAL:
+            reap()
+            reaped = time.monotonic()
+        job = claim(worker)
+        if job:
+            try:
+                run(job)
+            except Exception:
+                # the job is failed by reap() once it is stale
+                logger.exception(
+                    "Completion job crashed", extra={"data": {"job": job.pk}}
+                )
+        elif burst:
+            return
+        else:
+            stop.wait(settings.JOB_POLL_INTERVAL)
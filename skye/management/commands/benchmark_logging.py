@@ -0,0 +1,94 @@
+import logging
+import os
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+
+from skye_server.log import AsyncHandler, JsonFormatter
+
+
+class _SlowStream:
+    """A stream taking ``delay`` seconds per write, like a congested pipe."""
+
+    def __init__(self, stream, delay):
+        self.stream = stream
+        self.delay = delay
+
+    def write(self, s):
+        if self.delay:
+            time.sleep(self.delay)
+        self.stream.write(s)
+
+    def flush(self):
+        self.stream.flush()
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure the time request threads spend logging, with a synchronous "
+        "stream handler and with the queue-based handler."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threads", type=int, default=8)
+        parser.add_argument("--records", type=int, default=2000, help="Per thread.")
+        parser.add_argument(
+            "--write-delay",
+            type=float,
+            default=0,
+            help="Milliseconds each write to the log stream takes.",
+        )
+        parser.add_argument("--output", default=os.devnull)
+
+    def handle(self, *args, **options):
+        with open(options["output"], "w") as f:
+            stream = _SlowStream(f, options["write_delay"] / 1000)
+            sync = logging.StreamHandler(stream)
+            sync.setFormatter(JsonFormatter())
+            self.report("sync", sync, options)
+            queued = AsyncHandler(stream, capacity=options["records"] * 10)
+            self.report("queue", queued, options)
+            queued.close()
+            if queued.dropped:
+                self.stdout.write(f"queue: {queued.dropped} records dropped")
+
+    def report(self, name, handler, options):
+        logger = logging.getLogger(f"skye.benchmark.{name}")
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        logger.addHandler(handler)
+        data = {"model": "dict.1", "total_token_usage": 100, "prompt": "x" * 500}
+        latencies = []
+        lock = threading.Lock()
+        barrier = threading.Barrier(options["threads"])
+
+        def run():
+            mine = []
+            barrier.wait()
+            for _ in range(options["records"]):
+                started = time.perf_counter()
+                logger.info("Completion", extra={"data": data})
+                mine.append(time.perf_counter() - started)
+            with lock:
+                latencies.extend(mine)
+
+        threads = [threading.Thread(target=run) for _ in range(options["threads"])]
+        started = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - started
+        logger.removeHandler(handler)
+
+        latencies.sort()
+
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1e6
+
+        self.stdout.write(
+            f"{name}: {len(latencies)} records in {elapsed:.2f}s, "
+            f"p50 {percentile(0.5):.0f}us, p99 {percentile(0.99):.0f}us, "
+            f"max {latencies[-1] * 1e6:.0f}us per call"
+        )
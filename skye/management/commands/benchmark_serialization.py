@@ -0,0 +1,65 @@
+import json
+import timeit
+
+from django.core.management.base import BaseCommand
+from django.http import JsonResponse
+from django.utils import timezone
+
+from skye import api, views
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare parsing an ask request and rendering a history response "
+        "with json and django.http.JsonResponse against skye.api."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--number", type=int, default=10000)
+        parser.add_argument(
+            "--rows", type=int, default=100, help="Rows of the history response."
+        )
+
+    def handle(self, *args, **options):
+        body = json.dumps(
+            {
+                "model": "dict",
+                "prompts": {"q": "serendipity " * 20},
+                "params": {"lang": "en"},
+            }
+        ).encode("utf-8")
+        now = timezone.now()
+        history = {
+            "data": [
+                {"amount": 1000, "reason": "successful_invitation", "gifted_at": now}
+                for _ in range(options["rows"])
+            ]
+        }
+
+        def parse_before():
+            data = json.loads(body)
+            return data["model"], data["prompts"], data.get("params")
+
+        def parse_after():
+            data = api.loads(body)
+            return views.ASK.validate(data) or api.model_schema(data["model"]).validate(
+                data
+            )
+
+        self.compare("parse ask", parse_before, parse_after, options["number"])
+        self.compare(
+            f"render {options['rows']} rows",
+            lambda: JsonResponse(history),
+            lambda: api.JsonResponse(history),
+            max(1, options["number"] // 10),
+        )
+        codec = "orjson" if api.orjson else "json (orjson is not installed)"
+        self.stdout.write(f"codec: {codec}")
+
+    def compare(self, name, before, after, number):
+        before_us = timeit.timeit(before, number=number) / number * 1e6
+        after_us = timeit.timeit(after, number=number) / number * 1e6
+        self.stdout.write(
+            f"{name}: {before_us:.1f}us before, {after_us:.1f}us after "
+            f"({before_us / after_us:.1f}x)"
+        )
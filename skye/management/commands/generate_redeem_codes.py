@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from skye.exports import iter_redeem_codes_csv
+from skye.models import RedeemCode
+
+
+class Command(BaseCommand):
+    help = "Generate a batch of redeem codes and optionally export it as CSV."
+
+    def add_arguments(self, parser):
+        parser.add_argument("amount", type=int, help="Amount of each code.")
+        parser.add_argument("count", type=int, help="Number of codes to generate.")
+        parser.add_argument("--batch", default="", help="Batch name.")
+        parser.add_argument("--chunk-size", type=int, default=1000)
+        parser.add_argument("--output", help="Write the batch to this CSV file.")
+
+    def handle(self, *args, **options):
+        batch = RedeemCode.objects.bulk_generate(
+            options["amount"],
+            options["count"],
+            batch=options["batch"],
+            chunk_size=options["chunk_size"],
+        )
+        self.stdout.write(
+            self.style.SUCCESS(f"Generated {options['count']} codes in batch {batch}")
+        )
+
+        if options["output"]:
+            with open(options["output"], "w", newline="") as f:
+                for line in iter_redeem_codes_csv(
+                    RedeemCode.objects.filter(batch=batch)
+                ):
+                    f.write(line)
+            self.stdout.write(f"Exported to {options['output']}")
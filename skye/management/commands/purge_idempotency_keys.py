@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from skye.models import IdempotencyKey
+
+
+class Command(BaseCommand):
+    help = "Delete the expired idempotency keys."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        total = 0
+        while True:
+            pks = list(
+                IdempotencyKey.objects.filter(expires_at__lte=now).values_list(
+                    "pk", flat=True
+                )[: options["chunk_size"]]
+            )
+            if not pks:
+                break
+            total += IdempotencyKey.objects.filter(pk__in=pks).delete()[0]
+        self.stdout.write(self.style.SUCCESS(f"Deleted {total} keys"))
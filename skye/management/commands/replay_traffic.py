@@ -0,0 +1,239 @@
+import json
+import random
+import re
+import string
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from http.cookies import SimpleCookie
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from skye.fake_upstream import FakeUpstream
+from skye.models import Gift
+from skye_server import capture
+
+PASSWORD = "replay-password"
+REPLAY_BALANCE = 10**9
+# replaying them would log the replay users out, or in as nobody
+SKIPPED = {None, "csrf", "register", "login", "logout"}
+_ARG = re.compile(r"<(?:\w+:)?(\w+)>")
+_LETTERS = string.ascii_lowercase + string.digits
+
+
+def _words(rng, length):
+    """Random words of ``length`` characters. Repeated filler would be
+    near-duplicates to the fuzzy cache, and replayed asks its hits."""
+    words, size = [], -1
+    while size < length:
+        word = "".join(rng.choices(_LETTERS, k=rng.randint(2, 10)))
+        words.append(word)
+        size += len(word) + 1
+    return " ".join(words)[:length]
+
+
+def _fill(value, rng):
+    """A value of the shape of a captured one."""
+    if isinstance(value, int) and not isinstance(value, bool):
+        return _words(rng, value)
+    if isinstance(value, dict):
+        return {k: _fill(v, rng) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_fill(v, rng) for v in value]
+    return value
+
+
+def _fill_fields(d, rng):
+    return {k: v if k in capture.KEEP else _fill(v, rng) for k, v in d.items()}
+
+
+def _percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class Session:
+    """The cookies of a replayed user, kept without the Secure attribute
+    checks of a cookie jar: the local instance may not serve HTTPS."""
+
+    def __init__(self, url):
+        self.url = url
+        self.cookies = {}
+        self.job_ids = []
+        self._lock = threading.Lock()
+
+    def request(self, method, path, body=None):
+        data = json.dumps(body).encode("utf-8") if body is not None else None
+        with self._lock:
+            headers = {
+                "Content-Type": "application/json",
+                "Cookie": "; ".join(f"{k}={v}" for k, v in self.cookies.items()),
+                "X-CSRFToken": self.cookies.get("csrftoken", ""),
+            }
+        request = urllib.request.Request(
+            self.url + path, data=data, headers=headers, method=method
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=300) as response:
+                status, content = response.status, response.read()
+                set_cookies = response.headers.get_all("Set-Cookie") or []
+        except urllib.error.HTTPError as err:
+            status, content = err.code, err.read()
+            set_cookies = err.headers.get_all("Set-Cookie") or []
+        with self._lock:
+            for header in set_cookies:
+                for name, morsel in SimpleCookie(header).items():
+                    self.cookies[name] = morsel.value
+        return status, content
+
+    def login(self, email):
+        self.request("GET", "/csrf")
+        status, _ = self.request(
+            "POST", "/login", {"email": email, "password": PASSWORD}
+        )
+        if status != 200:
+            raise CommandError(f"Could not log in as {email}: {status}")
+
+
+class Command(BaseCommand):
+    help = (
+        "Replay a capture of TRAFFIC_CAPTURE_PATH against a local instance "
+        "sharing this database, and report the throughput, latency "
+        "percentiles and errors per endpoint. Each captured user is "
+        "replayed by a user created with a large balance."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="The capture, may be gzipped.")
+        parser.add_argument("--url", default="http://127.0.0.1:8000")
+        parser.add_argument(
+            "--speed", type=float, default=1.0, help="Replay this many times as fast."
+        )
+        parser.add_argument("--concurrency", type=int, default=64)
+        parser.add_argument(
+            "--seed",
+            type=int,
+            default=0,
+            help="Seed of the random words filling the captured texts.",
+        )
+        parser.add_argument(
+            "--fake-upstream",
+            type=int,
+            metavar="PORT",
+            help="Serve a fake upstream on this port during the replay, "
+            'point the instance at it with OPENAI_KEYS="sk-replay;api_base=..."',
+        )
+        parser.add_argument(
+            "--upstream-latency",
+            type=float,
+            default=0.5,
+            help="Seconds each completion of the fake upstream takes.",
+        )
+
+    def handle(self, *args, **options):
+        records = sorted(capture.read(options["path"]), key=lambda r: r["t"])
+        if not records:
+            raise CommandError("The capture is empty")
+        url = options["url"].rstrip("/")
+
+        sessions = {}
+        for anonymized in {r["user"] for r in records if r["route"] not in SKIPPED}:
+            session = sessions[anonymized] = Session(url)
+            if anonymized is not None:
+                session.login(self.replay_user(anonymized))
+
+        with ExitStack() as stack:
+            if options["fake_upstream"] is not None:
+                fake = stack.enter_context(
+                    FakeUpstream(
+                        {"*": (10**9, 10**12)},
+                        latency=options["upstream_latency"],
+                        port=options["fake_upstream"],
+                    )
+                )
+                self.stdout.write(f"Fake upstream at {fake.url}")
+            stats, skipped, duration = self.replay(records, sessions, options)
+
+        self.report(stats, duration)
+        if skipped:
+            self.stdout.write(f"skipped {skipped} requests of unreplayable routes")
+
+    def replay_user(self, anonymized):
+        email = f"replay-{anonymized}@example.com"
+        user, created = User.objects.get_or_create(
+            username=email, defaults={"email": email}
+        )
+        if created:
+            user.set_password(PASSWORD)
+            user.save()
+            Gift.objects.create(user=user, amount=REPLAY_BALANCE)
+        return email
+
+    def replay(self, records, sessions, options):
+        stats = defaultdict(list)
+        lock = threading.Lock()
+
+        def send(session, record, rng):
+            route = record["route"]
+            if route.startswith("jobs/") and session.job_ids:
+                pk = session.job_ids[-1]
+            else:
+                pk = 0
+            path = "/" + _ARG.sub(str(pk), route)
+            query = _fill_fields(record.get("query") or {}, rng)
+            if query:
+                path += "?" + urllib.parse.urlencode(query)
+            body = record.get("body")
+            started = time.perf_counter()
+            try:
+                status, content = session.request(
+                    record["method"],
+                    path,
+                    _fill_fields(body, rng) if body is not None else None,
+                )
+            except Exception:
+                status, content = None, b""
+            elapsed = time.perf_counter() - started
+            if route == "ask" and status == 202:
+                session.job_ids.append(json.loads(content)["data"]["id"])
+            with lock:
+                stats[(record["method"], route)].append((elapsed, status))
+
+        skipped = 0
+        first = records[0]["t"]
+        executor = ThreadPoolExecutor(options["concurrency"])
+        started = time.monotonic()
+        for i, record in enumerate(records):
+            if record["route"] in SKIPPED:
+                skipped += 1
+                continue
+            # keep the inter-arrival times, divided by the speed
+            delay = (record["t"] - first) / options["speed"]
+            delay -= time.monotonic() - started
+            if delay > 0:
+                time.sleep(delay)
+            # the same words for the same record, whatever the thread
+            rng = random.Random(f"{options['seed']}:{i}")
+            executor.submit(send, sessions[record["user"]], record, rng)
+        executor.shutdown(wait=True)
+        return stats, skipped, time.monotonic() - started
+
+    def report(self, stats, duration):
+        self.stdout.write(f"replayed in {duration:.2f}s")
+        for (method, route), results in sorted(stats.items()):
+            latencies = sorted(elapsed * 1000 for elapsed, _ in results)
+            errors = sum(1 for _, status in results if status is None or status >= 500)
+            rejected = sum(1 for _, status in results if status and 400 <= status < 500)
+            self.stdout.write(
+                f"{method} /{route}: {len(results)} requests, "
+                f"{len(results) / duration:.1f} req/s, "
+                f"p50 {_percentile(latencies, 0.5):.0f}ms, "
+                f"p90 {_percentile(latencies, 0.9):.0f}ms, "
+                f"p99 {_percentile(latencies, 0.99):.0f}ms, "
+                f"{errors} errors, {rejected} 4xx"
+            )
@@ -0,0 +1,112 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from skye.models import Blob, Completion, CompletionSearch, ShardAssignment
+from skye.routers import forget_shard, shard_for
+
+
+class Command(BaseCommand):
+    help = (
+        "Move the completions of users to another shard while they keep "
+        "using the service."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("target", help="Alias of the target shard.")
+        parser.add_argument("user_ids", nargs="+", type=int)
+        parser.add_argument("--chunk-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        target = options["target"]
+        if target not in settings.COMPLETION_SHARDS:
+            raise CommandError(f"{target} is not one of {settings.COMPLETION_SHARDS}")
+
+        for user_id in options["user_ids"]:
+            source = shard_for(user_id)
+            if source == target:
+                self.stdout.write(f"user {user_id} already lives on {target}")
+                continue
+            self.move(user_id, source, target, options["chunk_size"])
+            self.stdout.write(
+                self.style.SUCCESS(f"moved user {user_id} from {source} to {target}")
+            )
+
+    def move(self, user_id, source, target, chunk_size):
+        # leftovers of an interrupted move, the user still lives on source
+        self.delete(user_id, target, chunk_size)
+
+        # copy while the user keeps writing to the source shard
+        last_pk = self.copy(user_id, source, target, 0, chunk_size)
+
+        # switch, and wait until no process writes to the source shard anymore
+        ShardAssignment.objects.update_or_create(
+            user_id=user_id, defaults={"alias": target}
+        )
+        forget_shard(user_id)
+        time.sleep(settings.COMPLETION_SHARD_CACHE_TTL)
+
+        # copy what was written in the meantime, then drop the source rows
+        self.copy(user_id, source, target, last_pk, chunk_size)
+        self.delete(user_id, source, chunk_size)
+
+    def delete(self, user_id, alias, chunk_size):
+        """Delete the completions in chunks, along with their blobs that no
+        other completion of the shard refers to."""
+        completions = Completion.objects.using(alias)
+        while True:
+            chunk = list(
+                completions.filter(user_id=user_id)
+                .order_by("pk")
+                .values_list("pk", "prompt_digest", "completion_digest")[:chunk_size]
+            )
+            if not chunk:
+                return
+            pks = [pk for pk, _, _ in chunk]
+            digests = {
+                d for _, prompt, completion in chunk for d in (prompt, completion)
+            }
+            with transaction.atomic(using=alias):
+                # a completion saved meanwhile with one of these blobs waits
+                # for the delete, and inserts the blob again
+                blobs = Blob.objects.using(alias).filter(digest__in=digests)
+                list(blobs.select_for_update().values_list("pk", flat=True))
+                CompletionSearch.objects.using(alias).filter(
+                    completion_id__in=pks
+                ).delete()
+                completions.filter(pk__in=pks).delete()
+                referenced = set()
+                for field in ("prompt_digest", "completion_digest"):
+                    referenced.update(
+                        completions.filter(**{f"{field}__in": digests})
+                        .values_list(field, flat=True)
+                        .distinct()
+                    )
+                blobs.exclude(digest__in=referenced).delete()
+
+    def copy(self, user_id, source, target, after_pk, chunk_size):
+        """Copy the completions with a pk above ``after_pk`` in chunks, returns
+        the last pk copied."""
+        while True:
+            chunk = list(
+                Completion.objects.using(source)
+                .filter(user_id=user_id, pk__gt=after_pk)
+                .order_by("pk")[:chunk_size]
+            )
+            if not chunk:
+                return after_pk
+            after_pk = chunk[-1].pk
+            Completion.load_bodies(chunk)
+            digests = {c.prompt_digest for c in chunk} | {
+                c.completion_digest for c in chunk
+            }
+            blobs = list(Blob.objects.using(source).filter(digest__in=digests))
+            with transaction.atomic(using=target):
+                Blob.objects.using(target).bulk_create(blobs, ignore_conflicts=True)
+                for completion in chunk:
+                    # primary keys are only unique per shard; a raw save
+                    # keeps created_at like loaddata does
+                    completion.pk = None
+                    completion.save_base(using=target, raw=True, force_insert=True)
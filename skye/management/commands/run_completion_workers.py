@@ -0,0 +1,55 @@
+import multiprocessing
+import os
+import signal
+import socket
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from skye import jobs
+
+
+def _work(name, stop, burst):
+    # the parent stops the workers on SIGINT and SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda *args: stop.set())
+    try:
+        jobs.work(name, stop, burst)
+    finally:
+        connections.close_all()
+
+
+class Command(BaseCommand):
+    help = (
+        "Run worker processes completing the jobs queued by /ask. "
+        "SIGINT or SIGTERM stops them once their current job is done."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--processes", type=int, default=4)
+        parser.add_argument(
+            "--burst", action="store_true", help="Exit once the queue is empty."
+        )
+
+    def handle(self, *args, **options):
+        host = socket.gethostname()
+        stop = multiprocessing.Event()
+        if options["processes"] == 1:
+            jobs.work(f"{host}:{os.getpid()}", stop, options["burst"])
+            return
+
+        # the workers must not share the connections of this process
+        connections.close_all()
+        workers = [
+            multiprocessing.Process(
+                target=_work, args=(f"{host}:{os.getpid()}:{i}", stop, options["burst"])
+            )
+            for i in range(options["processes"])
+        ]
+        for w in workers:
+            w.start()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *args: stop.set())
+        for w in workers:
+            w.join()
+        self.stdout.write(f"Stopped {len(workers)} workers")
@@ -0,0 +1,83 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from skye.models import GiftCampaign
+
+
+class Command(BaseCommand):
+    help = (
+        "Gift every user of a target group. Running an existing campaign again "
+        "resumes it where it stopped, unless another run holds it."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("name", nargs="?", help="Unique name of the campaign.")
+        parser.add_argument(
+            "--queued",
+            action="store_true",
+            help="Run the campaigns queued from the admin instead.",
+        )
+        parser.add_argument(
+            "--target",
+            choices=(GiftCampaign.TARGET_ACTIVE_USERS, GiftCampaign.TARGET_INVITERS),
+        )
+        parser.add_argument("--amount", type=int)
+        parser.add_argument(
+            "--active-days",
+            type=int,
+            help="Active users only: only those who logged in during these days.",
+        )
+        parser.add_argument(
+            "--min-invitees",
+            type=int,
+            default=1,
+            help="Inviters only: the minimum number of invitees.",
+        )
+        parser.add_argument("--chunk-size", type=int, default=5000)
+
+    def handle(self, *args, **options):
+        if options["queued"]:
+            queued = GiftCampaign.objects.filter(status=GiftCampaign.STATUS_QUEUED)
+            for campaign in queued.order_by("pk"):
+                self.run(campaign, options)
+            return
+        if not options["name"]:
+            raise CommandError("name a campaign, or run the --queued ones")
+
+        campaign = GiftCampaign.objects.filter(name=options["name"]).first()
+        if campaign is None:
+            if not options["target"] or not options["amount"]:
+                raise CommandError("a new campaign needs --target and --amount")
+            active_since = None
+            if options["active_days"]:
+                active_since = timezone.now() - timedelta(days=options["active_days"])
+            campaign = GiftCampaign.objects.create(
+                name=options["name"],
+                target=options["target"],
+                amount=options["amount"],
+                active_since=active_since,
+                min_invitees=options["min_invitees"],
+            )
+        elif campaign.status == GiftCampaign.STATUS_DONE:
+            self.stdout.write(f"campaign {campaign} is done already")
+            return
+        else:
+            self.stdout.write(
+                f"resuming campaign {campaign} after user {campaign.last_user_id}"
+            )
+
+        self.run(campaign, options)
+
+    def run(self, campaign, options):
+        done = campaign.run(
+            chunk_size=options["chunk_size"],
+            progress=lambda c: self.stdout.write(
+                f"{c.processed} users processed, up to user {c.last_user_id}"
+            ),
+        )
+        if done:
+            self.stdout.write(self.style.SUCCESS(f"campaign {campaign} is done"))
+        else:
+            self.stdout.write(f"campaign {campaign} is run by another process")
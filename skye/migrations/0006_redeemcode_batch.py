@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-19 01:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('skye', '0005_alter_completion_model'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='redeemcode',
+            name='batch',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=40),
+        ),
+    ]
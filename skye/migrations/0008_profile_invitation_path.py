@@ -0,0 +1,61 @@
+# Generated by Django 3.2.25 on 2026-10-19 01:36
+
+from django.db import migrations, models
+
+
+# Profile.MAX_PATH_DEPTH
+MAX_PATH_DEPTH = 16
+
+
+def build_invitation_paths(apps, schema_editor):
+    Profile = apps.get_model('skye', 'Profile')
+    inviters = dict(Profile.objects.values_list('user_id', 'inviter_id'))
+
+    # user_id: (path, depth)
+    paths = {}
+
+    def path_of(user_id):
+        chain = []
+        while user_id not in paths:
+            chain.append(user_id)
+            inviter_id = inviters.get(user_id, user_id)
+            if inviter_id == user_id or inviter_id in chain:
+                paths[user_id] = (f'/{user_id}/', 0)
+                chain.pop()
+                break
+            user_id = inviter_id
+        for i in reversed(chain):
+            path, depth = paths[inviters[i]]
+            if depth < MAX_PATH_DEPTH:
+                path = f'{path}{i}/'
+            paths[i] = (path, depth + 1)
+        return paths[chain[0]] if chain else paths[user_id]
+
+    profiles = []
+    for profile in Profile.objects.only('pk', 'user_id').iterator():
+        profile.invitation_path, profile.invitation_depth = path_of(profile.user_id)
+        profiles.append(profile)
+    Profile.objects.bulk_update(
+        profiles, ['invitation_path', 'invitation_depth'], batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('skye', '0007_balancehold'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='invitation_depth',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='invitation_path',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=191),
+        ),
+        migrations.RunPython(build_invitation_paths, migrations.RunPython.noop),
+    ]
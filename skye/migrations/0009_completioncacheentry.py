@@ -0,0 +1,28 @@
+# Generated by Django 3.2.25 on 2026-10-19 01:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('skye', '0008_profile_invitation_path'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CompletionCacheEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('partition', models.CharField(db_index=True, max_length=191)),
+                ('normalized', models.TextField()),
+                ('signature', models.BinaryField()),
+                ('completion', models.TextField()),
+                ('finish_reason', models.CharField(max_length=50)),
+                ('prompt_usage', models.PositiveIntegerField()),
+                ('completion_usage', models.PositiveIntegerField()),
+                ('total_usage', models.PositiveIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
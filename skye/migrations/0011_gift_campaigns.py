@@ -0,0 +1,44 @@
+# Generated by Django 3.2.25 on 2026-10-19 01:45
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('skye', '0010_completion_shards'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GiftCampaign',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('target', models.CharField(choices=[('active_users', 'Active Users'), ('inviters', 'Inviters')], max_length=20)),
+                ('active_since', models.DateTimeField(blank=True, help_text='Active users only: only those who logged in since then.', null=True)),
+                ('min_invitees', models.PositiveIntegerField(default=1, help_text='Inviters only: the minimum number of invitees.')),
+                ('amount', models.PositiveIntegerField()),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done')], default='pending', max_length=10)),
+                ('last_user_id', models.BigIntegerField(default=0)),
+                ('processed', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='gift',
+            name='reason',
+            field=models.CharField(choices=[('accepted_invitation', 'Accepted Invitation'), ('successful_invitation', 'Successful Invitation'), ('invitee_redeemed', 'Invitee Redeemed'), ('campaign', 'Campaign')], default='', max_length=50),
+        ),
+        migrations.AddField(
+            model_name='gift',
+            name='campaign',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.DO_NOTHING, to='skye.giftcampaign'),
+        ),
+        migrations.AddConstraint(
+            model_name='gift',
+            constraint=models.UniqueConstraint(fields=('campaign', 'user'), name='unique_campaign_gift'),
+        ),
+    ]
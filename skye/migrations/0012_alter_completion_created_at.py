@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-19 01:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('skye', '0011_gift_campaigns'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='completion',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+    ]
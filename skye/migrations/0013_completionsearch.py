@@ -0,0 +1,100 @@
+# Generated by Django 3.2.25 on 2026-10-19 02:02
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import skye.models
+
+SQLITE_FTS = [
+    "CREATE VIRTUAL TABLE skye_completionsearch_fts USING fts5("
+    "text, content='skye_completionsearch', content_rowid='completion_id', "
+    "tokenize='trigram')",
+    "CREATE TRIGGER skye_completionsearch_ai AFTER INSERT ON skye_completionsearch BEGIN "
+    "INSERT INTO skye_completionsearch_fts(rowid, text) VALUES (new.completion_id, new.text); "
+    "END",
+    "CREATE TRIGGER skye_completionsearch_ad AFTER DELETE ON skye_completionsearch BEGIN "
+    "INSERT INTO skye_completionsearch_fts(skye_completionsearch_fts, rowid, text) "
+    "VALUES ('delete', old.completion_id, old.text); "
+    "END",
+    "CREATE TRIGGER skye_completionsearch_au AFTER UPDATE ON skye_completionsearch BEGIN "
+    "INSERT INTO skye_completionsearch_fts(skye_completionsearch_fts, rowid, text) "
+    "VALUES ('delete', old.completion_id, old.text); "
+    "INSERT INTO skye_completionsearch_fts(rowid, text) VALUES (new.completion_id, new.text); "
+    "END",
+]
+
+
+def create_fulltext_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'mysql':
+        schema_editor.execute(
+            'ALTER TABLE skye_completionsearch '
+            'ADD FULLTEXT INDEX skye_completionsearch_text (text) WITH PARSER ngram'
+        )
+    elif vendor == 'sqlite':
+        for sql in SQLITE_FTS:
+            schema_editor.execute(sql)
+
+
+def drop_fulltext_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'mysql':
+        schema_editor.execute(
+            'ALTER TABLE skye_completionsearch DROP INDEX skye_completionsearch_text'
+        )
+    elif vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE skye_completionsearch_fts')
+
+
+def index_completions(apps, schema_editor):
+    alias = schema_editor.connection.alias
+    Completion = apps.get_model('skye', 'Completion')
+    CompletionSearch = apps.get_model('skye', 'CompletionSearch')
+    last_pk = 0
+    while True:
+        chunk = list(
+            Completion.objects.using(alias)
+            .filter(pk__gt=last_pk)
+            .order_by('pk')
+            .only('pk', 'user_id', 'prompt', 'completion')[:1000]
+        )
+        if not chunk:
+            break
+        searches = []
+        for c in chunk:
+            prompts = c.prompt.values() if isinstance(c.prompt, dict) else [c.prompt]
+            text = '\n'.join([*map(str, prompts), c.completion])
+            searches.append(
+                CompletionSearch(completion_id=c.pk, user_id=c.user_id, text=text)
+            )
+        CompletionSearch.objects.using(alias).bulk_create(searches)
+        last_pk = chunk[-1].pk
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('skye', '0012_alter_completion_created_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CompletionSearch',
+            fields=[
+                ('completion', models.OneToOneField(on_delete=django.db.models.deletion.DO_NOTHING, primary_key=True, related_name='search', serialize=False, to='skye.completion')),
+                ('text', skye.models.SearchTextField()),
+                ('user', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.RunPython(
+            create_fulltext_index,
+            drop_fulltext_index,
+            hints={'model_name': 'completionsearch'},
+        ),
+        migrations.RunPython(
+            index_completions,
+            migrations.RunPython.noop,
+            hints={'model_name': 'completionsearch'},
+        ),
+    ]
@@ -0,0 +1,127 @@
+# Generated by Django 3.2.25 on 2026-10-19 02:20
+
+import json
+
+from django.db import migrations, models, transaction
+
+from skye import blobs
+
+
+def move_bodies_to_blobs(apps, schema_editor):
+    alias = schema_editor.connection.alias
+    Completion = apps.get_model('skye', 'Completion')
+    Blob = apps.get_model('skye', 'Blob')
+    last_pk = 0
+    while True:
+        chunk = list(
+            Completion.objects.using(alias)
+            .filter(pk__gt=last_pk)
+            .order_by('pk')
+            .only('pk', 'prompt', 'completion')[:1000]
+        )
+        if not chunk:
+            break
+        new_blobs = {}
+        for c in chunk:
+            prompt = json.dumps(c.prompt, ensure_ascii=False, sort_keys=True)
+            for name, text in (('prompt', prompt), ('completion', c.completion)):
+                digest = blobs.digest(text)
+                setattr(c, f'{name}_digest', digest)
+                if digest not in new_blobs:
+                    codec, data = blobs.compress(text)
+                    new_blobs[digest] = Blob(
+                        digest=digest, codec=codec, data=data, size=len(text)
+                    )
+        with transaction.atomic(using=alias):
+            Blob.objects.using(alias).bulk_create(
+                new_blobs.values(), ignore_conflicts=True
+            )
+            Completion.objects.using(alias).bulk_update(
+                chunk, ['prompt_digest', 'completion_digest']
+            )
+        last_pk = chunk[-1].pk
+
+
+def restore_bodies_from_blobs(apps, schema_editor):
+    alias = schema_editor.connection.alias
+    Completion = apps.get_model('skye', 'Completion')
+    Blob = apps.get_model('skye', 'Blob')
+    last_pk = 0
+    while True:
+        chunk = list(
+            Completion.objects.using(alias)
+            .filter(pk__gt=last_pk)
+            .order_by('pk')
+            .only('pk', 'prompt_digest', 'completion_digest')[:1000]
+        )
+        if not chunk:
+            break
+        digests = {d for c in chunk for d in (c.prompt_digest, c.completion_digest)}
+        texts = {
+            b.digest: blobs.decompress(b.codec, b.data)
+            for b in Blob.objects.using(alias).filter(digest__in=digests)
+        }
+        for c in chunk:
+            c.prompt = json.loads(texts[c.prompt_digest])
+            c.completion = texts[c.completion_digest]
+        with transaction.atomic(using=alias):
+            Completion.objects.using(alias).bulk_update(
+                chunk, ['prompt', 'completion']
+            )
+        last_pk = chunk[-1].pk
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('skye', '0013_completionsearch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Blob',
+            fields=[
+                ('digest', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('codec', models.CharField(blank=True, max_length=10)),
+                ('data', models.BinaryField()),
+                ('size', models.PositiveIntegerField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='completion',
+            name='prompt_digest',
+            field=models.CharField(default='', max_length=64),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='completion',
+            name='completion_digest',
+            field=models.CharField(default='', max_length=64),
+            preserve_default=False,
+        ),
+        migrations.RunPython(
+            move_bodies_to_blobs,
+            restore_bodies_from_blobs,
+            hints={'model_name': 'completion'},
+        ),
+        # so that the columns are added back with a default for the rows
+        # when migrating backwards, and filled from the blobs
+        migrations.AlterField(
+            model_name='completion',
+            name='prompt',
+            field=models.JSONField(default=dict),
+        ),
+        migrations.AlterField(
+            model_name='completion',
+            name='completion',
+            field=models.TextField(default=''),
+        ),
+        migrations.RemoveField(
+            model_name='completion',
+            name='prompt',
+        ),
+        migrations.RemoveField(
+            model_name='completion',
+            name='completion',
+        ),
+    ]
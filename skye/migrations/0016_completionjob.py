@@ -0,0 +1,40 @@
+# Generated by Django 3.2.25 on 2026-10-19 04:30
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('skye', '0015_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CompletionJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=50)),
+                ('prompts', models.JSONField()),
+                ('params', models.JSONField(null=True)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed'), ('cancelled', 'Cancelled')], default='queued', max_length=20)),
+                ('completion', models.TextField(blank=True)),
+                ('finish_reason', models.CharField(blank=True, max_length=50)),
+                ('error', models.CharField(blank=True, max_length=50)),
+                ('worker', models.CharField(blank=True, max_length=100)),
+                ('request_id', models.CharField(blank=True, max_length=64)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(null=True)),
+                ('finished_at', models.DateTimeField(null=True)),
+                ('hold', models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='skye.balancehold')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='completionjob',
+            index=models.Index(fields=['status', 'id'], name='skye_comple_status_470c7c_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-19 05:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('skye', '0016_completionjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='completion',
+            name='upstream_model',
+            field=models.CharField(blank=True, max_length=50),
+        ),
+    ]
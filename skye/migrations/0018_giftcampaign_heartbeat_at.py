@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-19 03:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('skye', '0017_completion_upstream_model'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='giftcampaign',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='giftcampaign',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('queued', 'Queued'), ('running', 'Running'), ('done', 'Done')], default='pending', max_length=10),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-19 03:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('skye', '0018_giftcampaign_heartbeat_at'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='completion',
+            name='completion_digest',
+            field=models.CharField(db_index=True, max_length=64),
+        ),
+        migrations.AlterField(
+            model_name='completion',
+            name='prompt_digest',
+            field=models.CharField(db_index=True, max_length=64),
+        ),
+    ]
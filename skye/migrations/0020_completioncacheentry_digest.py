@@ -0,0 +1,54 @@
+# Generated by Django 3.2.25 on 2026-10-19 09:40
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def fill_digests(apps, schema_editor):
+    alias = schema_editor.connection.alias
+    CompletionCacheEntry = apps.get_model('skye', 'CompletionCacheEntry')
+    seen = set()
+    duplicates = []
+    # newest first, the older entries of a text are dropped
+    entries = (
+        CompletionCacheEntry.objects.using(alias)
+        .order_by('-pk')
+        .only('pk', 'partition', 'normalized')
+    )
+    for entry in entries.iterator():
+        entry.digest = hashlib.sha256(entry.normalized.encode('utf-8')).hexdigest()
+        if (entry.partition, entry.digest) in seen:
+            duplicates.append(entry.pk)
+            continue
+        seen.add((entry.partition, entry.digest))
+        entry.save(update_fields=['digest'])
+    for i in range(0, len(duplicates), 1000):
+        CompletionCacheEntry.objects.using(alias).filter(
+            pk__in=duplicates[i : i + 1000]
+        ).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('skye', '0019_completion_digest_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='completioncacheentry',
+            name='digest',
+            field=models.CharField(default='', max_length=64),
+            preserve_default=False,
+        ),
+        migrations.RunPython(
+            fill_digests,
+            migrations.RunPython.noop,
+            hints={'model_name': 'completioncacheentry'},
+        ),
+        migrations.AddConstraint(
+            model_name='completioncacheentry',
+            constraint=models.UniqueConstraint(fields=('partition', 'digest'), name='unique_cache_entry'),
+        ),
+    ]
@@ -1,11 +1,19 @@
+import json
 import uuid
+from datetime import timedelta
 from hashlib import sha1
 from uuid import uuid4
 
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import models
-from django.db.models.signals import post_save
+from django.core.cache import cache
+from django.db import IntegrityError, models, router, transaction
+from django.db.models import Count, F, Lookup, Q, Sum
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
+from django.utils import timezone
+
+from . import blobs, versions
 
 
 class Profile(models.Model):
@@ -27,6 +35,63 @@ class Profile(models.Model):
         default=False,
         help_text="Designates whether the user can use General Model.",
     )
+    # materialized path of the invitation tree, e.g. /1/5/12/,
+    # so that a whole downline is a single prefix range of the index
+    invitation_path = models.CharField(
+        max_length=191, db_index=True, blank=True, default=""
+    )
+    invitation_depth = models.PositiveSmallIntegerField(default=0)
+    # the path stops growing past this depth, so that it holds in 191
+    # characters with user ids of up to 10 digits: deeper profiles keep the
+    # path of their ancestor at this depth, and their downline and ancestors
+    # are found by following the inviters instead
+    MAX_PATH_DEPTH = 16
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        profile = super().from_db(db, field_names, values)
+        profile._saved_values = profile._values()
+        return profile
+
+    @classmethod
+    def invited_by(cls, inviter_profile, **fields):
+        """A profile to save along with a new user, see create_user_profile:
+        its path is the one of its inviter until the user has an id."""
+        return cls(
+            inviter_id=inviter_profile.user_id,
+            invitation_path=inviter_profile.invitation_path,
+            invitation_depth=inviter_profile.invitation_depth + 1,
+            **fields,
+        )
+
+    def _values(self):
+        # the deferred fields are left out, they can't have changed
+        return {
+            f.attname: self.__dict__[f.attname]
+            for f in self._meta.concrete_fields
+            if f.attname in self.__dict__
+        }
+
+    def changed_fields(self):
+        """The fields changed since the profile was loaded or saved, or None
+        if it never was."""
+        saved = getattr(self, "_saved_values", None)
+        if saved is None:
+            return None
+        return [k for k, v in self._values().items() if k not in saved or saved[k] != v]
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self._saved_values = self._values()
+
+    def save_changes(self):
+        """Save only the fields changed since the profile was loaded or
+        saved, if any."""
+        changed = self.changed_fields()
+        if changed is None:
+            self.save()
+        elif changed:
+            self.save(update_fields=changed)
 
     def assure_invitation_code(self):
         if not self.invitation_code:
@@ -35,19 +100,112 @@ class Profile(models.Model):
             self.invitation_code = code
         return self.invitation_code
 
+    def set_inviter(self, inviter_profile):
+        self.inviter = inviter_profile.user
+        self.invitation_path = inviter_profile.invitation_path
+        self.invitation_depth = inviter_profile.invitation_depth + 1
+        self.extend_invitation_path()
+
+    def extend_invitation_path(self):
+        """Append the user to the path of its inviter, up to MAX_PATH_DEPTH."""
+        if self.invitation_depth <= self.MAX_PATH_DEPTH:
+            self.invitation_path = f"{self.invitation_path or '/'}{self.user_id}/"
+
+    @property
+    def path_is_capped(self):
+        return self.invitation_depth > self.MAX_PATH_DEPTH
+
+    def downline(self, max_depth=None):
+        """All the profiles invited by this user directly or indirectly."""
+        if self.path_is_capped:
+            return Profile.objects.filter(user_id__in=self._invitee_ids(max_depth))
+        qs = Profile.objects.filter(
+            invitation_path__startswith=self.invitation_path,
+            invitation_depth__gt=self.invitation_depth,
+        )
+        if max_depth is not None:
+            qs = qs.filter(invitation_depth__lte=self.invitation_depth + max_depth)
+        return qs
+
+    def _invitee_ids(self, max_depth=None):
+        """The downline, one level of inviters at a time."""
+        ids, level, depth = [], [self.user_id], 0
+        while level and (max_depth is None or depth < max_depth):
+            level = list(
+                Profile.objects.filter(inviter_id__in=level)
+                .exclude(user_id=F("inviter_id"))
+                .values_list("user_id", flat=True)
+            )
+            ids += level
+            depth += 1
+        return ids
+
+    def ancestor_ids(self):
+        ids = [int(i) for i in self.invitation_path.strip("/").split("/")]
+        if not self.path_is_capped:
+            return ids[:-1]
+        # the inviters between the end of the path and this profile
+        between, inviter_id = [], self.inviter_id
+        while inviter_id != ids[-1]:
+            between.append(inviter_id)
+            inviter_id = Profile.objects.values_list("inviter_id", flat=True).get(
+                user_id=inviter_id
+            )
+        return ids + between[::-1]
+
+    def downline_stats(self):
+        """The size of the downline and the amount gifted for it, cached for
+        INVITATION_STATS_TTL seconds."""
+        key = self.downline_stats_key(self.user_id)
+        stats = cache.get(key)
+        if stats is None:
+            gifted = self.user.gift_set.filter(
+                reason__in=(
+                    Gift.REASON_SUCCESSFUL_INVITATION,
+                    Gift.REASON_INVITEE_REDEEMED,
+                )
+            ).aggregate(Sum("amount"))["amount__sum"]
+            stats = {"downline": self.downline().count(), "gifted": gifted or 0}
+            cache.set(key, stats, settings.INVITATION_STATS_TTL)
+        return stats
+
+    @staticmethod
+    def downline_stats_key(user_id):
+        return f"skye:downline_stats:{user_id}"
+
+    @classmethod
+    def invalidate_downline_stats(cls, user_ids):
+        cache.delete_many([cls.downline_stats_key(i) for i in user_ids])
+
     def __str__(self):
         return self.user.email
 
 
+def _cached_profile(user):
+    """The profile loaded or set along with ``user``, without a query."""
+    return User.profile.related.get_cached_value(user, default=None)
+
+
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
     if created:
-        Profile.objects.create(user=instance, inviter=instance)
+        # a profile set on the new user, e.g. Profile.invited_by, is saved
+        # with it instead of being updated right after
+        profile = _cached_profile(instance) or Profile()
+        profile.user = instance
+        if profile.inviter_id is None:
+            profile.inviter = instance
+        profile.extend_invitation_path()
+        profile.save(force_insert=True)
 
 
 @receiver(post_save, sender=User)
-def save_user_profile(sender, instance, **kwargs):
-    instance.profile.save()
+def save_user_profile(sender, instance, created, **kwargs):
+    # only a profile loaded with the user can have changed, and the user is
+    # saved on every login: don't load it to save it as it was
+    profile = _cached_profile(instance)
+    if profile is not None and not created:
+        profile.save_changes()
 
 
 def generate_redeem_code():
@@ -60,6 +218,27 @@ class RedeemCodeManager(models.Manager):
     def generate_new_code(self, amount):
         return self.create(code=generate_redeem_code(), amount=amount)
 
+    def bulk_generate(self, amount, count, batch="", chunk_size=1000):
+        """Create ``count`` codes worth ``amount`` each with chunked inserts,
+        one transaction per chunk. Returns the batch name."""
+        batch = batch or timezone.now().strftime("%Y%m%d%H%M%S")
+        created = 0
+        while created < count:
+            codes = set()
+            while len(codes) < min(chunk_size, count - created):
+                codes.add(generate_redeem_code())
+            codes -= set(self.filter(code__in=codes).values_list("code", flat=True))
+            try:
+                with transaction.atomic():
+                    self.bulk_create(
+                        [RedeemCode(code=c, amount=amount, batch=batch) for c in codes]
+                    )
+            except IntegrityError:
+                # a concurrent insert took one of the codes, retry the chunk
+                continue
+            created += len(codes)
+        return batch
+
 
 class RedeemCode(models.Model):
     redeemer = models.ForeignKey(
@@ -72,6 +251,7 @@ class RedeemCode(models.Model):
     )
     code = models.CharField(max_length=40, unique=True, default=generate_redeem_code)
     amount = models.PositiveIntegerField()
+    batch = models.CharField(max_length=40, blank=True, default="", db_index=True)
     created_at = models.DateTimeField(auto_now_add=True, blank=True)
     redeemed_at = models.DateTimeField(
         blank=True,
@@ -86,10 +266,153 @@ class RedeemCode(models.Model):
         return self.code
 
 
+class GiftCampaign(models.Model):
+    """Gifts an amount to every user of a target group, see run()."""
+
+    TARGET_ACTIVE_USERS = "active_users"
+    TARGET_INVITERS = "inviters"
+
+    STATUS_PENDING = "pending"
+    STATUS_QUEUED = "queued"
+    STATUS_RUNNING = "running"
+    STATUS_DONE = "done"
+
+    name = models.CharField(max_length=50, unique=True)
+    target = models.CharField(
+        max_length=20,
+        choices=(
+            (TARGET_ACTIVE_USERS, "Active Users"),
+            (TARGET_INVITERS, "Inviters"),
+        ),
+    )
+    active_since = models.DateTimeField(
+        blank=True,
+        null=True,
+        help_text="Active users only: only those who logged in since then.",
+    )
+    min_invitees = models.PositiveIntegerField(
+        default=1, help_text="Inviters only: the minimum number of invitees."
+    )
+    amount = models.PositiveIntegerField()
+    status = models.CharField(
+        max_length=10,
+        choices=(
+            (STATUS_PENDING, "Pending"),
+            (STATUS_QUEUED, "Queued"),
+            (STATUS_RUNNING, "Running"),
+            (STATUS_DONE, "Done"),
+        ),
+        default=STATUS_PENDING,
+    )
+    # users are gifted in ascending id order, this is where to resume
+    last_user_id = models.BigIntegerField(default=0)
+    processed = models.PositiveIntegerField(default=0)
+    # set by each chunk of the run holding the campaign, see claim()
+    heartbeat_at = models.DateTimeField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    def target_user_ids(self):
+        if self.target == self.TARGET_INVITERS:
+            return (
+                Profile.objects.exclude(user_id=F("inviter_id"))
+                .values("inviter_id")
+                .annotate(invitees=Count("pk"))
+                .filter(invitees__gte=self.min_invitees)
+                .order_by("inviter_id")
+                .values_list("inviter_id", flat=True)
+            )
+        users = User.objects.filter(is_active=True)
+        if self.active_since:
+            users = users.filter(last_login__gte=self.active_since)
+        return users.order_by("pk").values_list("pk", flat=True)
+
+    def claim(self) -> bool:
+        """Hold the campaign for a run, unless another run holds it: one
+        that committed a chunk in the last GIFT_CAMPAIGN_LEASE seconds."""
+        now = timezone.now()
+        stale = now - timedelta(seconds=settings.GIFT_CAMPAIGN_LEASE)
+        claimed = (
+            GiftCampaign.objects.filter(pk=self.pk)
+            .filter(
+                Q(status__in=(self.STATUS_PENDING, self.STATUS_QUEUED))
+                | Q(status=self.STATUS_RUNNING, heartbeat_at__lt=stale)
+                | Q(status=self.STATUS_RUNNING, heartbeat_at=None)
+            )
+            .update(status=self.STATUS_RUNNING, heartbeat_at=now)
+        )
+        if claimed:
+            self.refresh_from_db(
+                fields=("status", "heartbeat_at", "last_user_id", "processed")
+            )
+        return bool(claimed)
+
+    def run(self, chunk_size=5000, progress=None) -> bool:
+        """Gift the target users chunk by chunk, one transaction each.
+        Returns False if another run holds the campaign, see claim().
+
+        An interrupted campaign resumes after the last chunk committed, and
+        the unique constraint on (campaign, user) makes sure no user is
+        gifted twice by the same campaign. A chunk only commits if this run
+        still holds the campaign, so that processed counts each user once.
+        """
+        if not self.claim():
+            return False
+        while True:
+            if self.target == self.TARGET_INVITERS:
+                chunk = self.target_user_ids().filter(inviter_id__gt=self.last_user_id)
+            else:
+                chunk = self.target_user_ids().filter(pk__gt=self.last_user_id)
+            user_ids = list(chunk[:chunk_size])
+            if not user_ids:
+                break
+            with transaction.atomic():
+                Gift.objects.bulk_create(
+                    [
+                        Gift(
+                            user_id=user_id,
+                            amount=self.amount,
+                            reason=Gift.REASON_CAMPAIGN,
+                            campaign=self,
+                        )
+                        for user_id in user_ids
+                    ],
+                    ignore_conflicts=True,
+                )
+                now = timezone.now()
+                held = GiftCampaign.objects.filter(
+                    pk=self.pk, heartbeat_at=self.heartbeat_at
+                ).update(
+                    last_user_id=user_ids[-1],
+                    processed=F("processed") + len(user_ids),
+                    heartbeat_at=now,
+                )
+                if not held:
+                    # another run claimed the campaign after our lease ran out
+                    transaction.set_rollback(True)
+                    return False
+                versions.bump(versions.GIFTS, user_ids)
+            self.refresh_from_db(fields=("last_user_id", "processed", "heartbeat_at"))
+            if progress:
+                progress(self)
+
+        now = timezone.now()
+        done = GiftCampaign.objects.filter(
+            pk=self.pk, heartbeat_at=self.heartbeat_at
+        ).update(status=self.STATUS_DONE, finished_at=now)
+        if done:
+            self.status, self.finished_at = self.STATUS_DONE, now
+        return bool(done)
+
+    def __str__(self):
+        return self.name
+
+
 class Gift(models.Model):
     REASON_ACCEPTED_INVITATION = "accepted_invitation"
     REASON_SUCCESSFUL_INVITATION = "successful_invitation"
     REASON_INVITEE_REDEEMED = "invitee_redeemed"
+    REASON_CAMPAIGN = "campaign"
 
     user = models.ForeignKey(User, on_delete=models.DO_NOTHING)
     amount = models.PositiveIntegerField()
@@ -99,19 +422,374 @@ class Gift(models.Model):
             (REASON_ACCEPTED_INVITATION, "Accepted Invitation"),
             (REASON_SUCCESSFUL_INVITATION, "Successful Invitation"),
             (REASON_INVITEE_REDEEMED, "Invitee Redeemed"),
+            (REASON_CAMPAIGN, "Campaign"),
         ),
         default="",  # default to empty to be compatible with the existing table
     )
+    campaign = models.ForeignKey(
+        GiftCampaign, on_delete=models.DO_NOTHING, blank=True, null=True
+    )
     gifted_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=("campaign", "user"), name="unique_campaign_gift"
+            ),
+        ]
+
+
+class CompletionQuerySet(models.QuerySet):
+    def for_user(self, user_id):
+        """The completions of a user, read from the shard they live on."""
+        from .routers import shard_for
+
+        return self.using(shard_for(user_id)).filter(user_id=user_id)
+
+    def create(self, **kwargs):
+        # unlike QuerySet.create, let the router see the instance (and its
+        # user) unless a database was picked explicitly
+        obj = self.model(**kwargs)
+        self._for_write = True
+        obj.save(force_insert=True, using=self._db)
+        return obj
+
+
+class Blob(models.Model):
+    """Text stored once per database however many rows refer to it, see
+    skye.blobs."""
+
+    digest = models.CharField(max_length=64, primary_key=True)
+    codec = models.CharField(max_length=10, blank=True)
+    data = models.BinaryField()
+    size = models.PositiveIntegerField()
+
+    @classmethod
+    def of(cls, text):
+        codec, data = blobs.compress(text)
+        return cls(digest=blobs.digest(text), codec=codec, data=data, size=len(text))
+
+    def text(self):
+        return blobs.decompress(self.codec, self.data)
+
 
 class Completion(models.Model):
-    user = models.ForeignKey(User, on_delete=models.DO_NOTHING)
+    # completions may live on another database than the users,
+    # see COMPLETION_SHARDS
+    user = models.ForeignKey(User, on_delete=models.DO_NOTHING, db_constraint=False)
     model = models.CharField(max_length=35)
-    prompt = models.JSONField()
+    # the upstream model that completed it, see skye.fallback
+    upstream_model = models.CharField(max_length=50, blank=True)
+    # the prompt (as JSON) and the completion are blobs of the same database,
+    # read and written through the properties below
+    # indexed to find the blobs no completion refers to anymore
+    prompt_digest = models.CharField(max_length=64, db_index=True)
+    completion_digest = models.CharField(max_length=64, db_index=True)
+    finish_reason = models.CharField(max_length=50)
+    prompt_usage = models.PositiveIntegerField()
+    completion_usage = models.PositiveIntegerField()
+    total_usage = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    objects = CompletionQuerySet.as_manager()
+
+    @property
+    def prompt(self):
+        return self._body("prompt")
+
+    @prompt.setter
+    def prompt(self, value):
+        self._set_body("prompt", value)
+
+    @property
+    def completion(self):
+        return self._body("completion")
+
+    @completion.setter
+    def completion(self, value):
+        self._set_body("completion", value)
+
+    def _body(self, name):
+        bodies = self.__dict__.setdefault("_bodies", {})
+        if name not in bodies:
+            Completion.load_bodies([self])
+        return bodies[name]
+
+    def _set_body(self, name, value):
+        self.__dict__.setdefault("_bodies", {})[name] = value
+        setattr(self, f"{name}_digest", "")
+
+    @staticmethod
+    def _encode(name, value):
+        if name == "prompt":
+            return json.dumps(value, ensure_ascii=False, sort_keys=True)
+        return value
+
+    @classmethod
+    def load_bodies(cls, completions):
+        """Read the bodies of ``completions`` with one query per database."""
+        by_db = {}
+        for completion in completions:
+            by_db.setdefault(completion._state.db, []).append(completion)
+        for db, group in by_db.items():
+            digests = {c.prompt_digest for c in group} | {
+                c.completion_digest for c in group
+            }
+            texts = {
+                blob.digest: blob.text()
+                for blob in Blob.objects.using(db).filter(digest__in=digests)
+            }
+            for c in group:
+                bodies = c.__dict__.setdefault("_bodies", {})
+                bodies.setdefault("prompt", json.loads(texts[c.prompt_digest]))
+                bodies.setdefault("completion", texts[c.completion_digest])
+
+    def save(self, *args, using=None, **kwargs):
+        using = using or router.db_for_write(Completion, instance=self)
+        new_blobs = []
+        for name, value in self.__dict__.get("_bodies", {}).items():
+            if not getattr(self, f"{name}_digest"):
+                blob = Blob.of(self._encode(name, value))
+                setattr(self, f"{name}_digest", blob.digest)
+                new_blobs.append(blob)
+        if new_blobs:
+            # blobs that already exist are shared
+            Blob.objects.using(using).bulk_create(new_blobs, ignore_conflicts=True)
+        super().save(*args, using=using, **kwargs)
+
+    def search_text(self):
+        prompts = (
+            self.prompt.values() if isinstance(self.prompt, dict) else [self.prompt]
+        )
+        return "\n".join([*map(str, prompts), self.completion])
+
+
+class SearchTextField(models.TextField):
+    """A text column with a full-text index, created by the migration."""
+
+
+@SearchTextField.register_lookup
+class FullText(Lookup):
+    """``text__fulltext=query``: the texts containing ``query``, looked up in
+    an ngram FULLTEXT index on MySQL or an FTS5 trigram table on SQLite.
+    Queries shorter than the n-grams of the index fall back to LIKE."""
+
+    lookup_name = "fulltext"
+
+    def _like(self, compiler, connection):
+        lhs, params = self.process_lhs(compiler, connection)
+        pattern = f"%{connection.ops.prep_for_like_query(self.rhs)}%"
+        return f"{lhs} LIKE %s", params + [pattern]
+
+    def as_sql(self, compiler, connection):
+        return self._like(compiler, connection)
+
+    def as_mysql(self, compiler, connection):
+        # ngram_token_size defaults to 2
+        if len(self.rhs) < 2:
+            return self._like(compiler, connection)
+        lhs, params = self.process_lhs(compiler, connection)
+        query = self.rhs.replace('"', " ")
+        return f"MATCH ({lhs}) AGAINST (%s IN BOOLEAN MODE)", params + [f'"{query}"']
+
+    def as_sqlite(self, compiler, connection):
+        if len(self.rhs) < 3:
+            return self._like(compiler, connection)
+        qn = connection.ops.quote_name
+        opts = self.lhs.target.model._meta
+        fts = qn(f"{opts.db_table}_fts")
+        pk = f"{qn(self.lhs.alias)}.{qn(opts.pk.column)}"
+        query = self.rhs.replace('"', '""')
+        return (
+            f"{pk} IN (SELECT rowid FROM {fts} WHERE {fts} MATCH %s)",
+            [f'"{query}"'],
+        )
+
+
+class CompletionSearch(models.Model):
+    """Searchable text of a completion, on the shard of the completion."""
+
+    # not cascaded, so that completions can still be fast-deleted:
+    # delete the searches first
+    completion = models.OneToOneField(
+        Completion, on_delete=models.DO_NOTHING, primary_key=True, related_name="search"
+    )
+    user = models.ForeignKey(
+        User, on_delete=models.DO_NOTHING, db_constraint=False, related_name="+"
+    )
+    text = SearchTextField()
+
+
+class ShardAssignment(models.Model):
+    """Places the completions of a user on another shard than the one picked
+    by the user id, see the reshard_completions command."""
+
+    user = models.OneToOneField(
+        User, on_delete=models.CASCADE, primary_key=True, related_name="+"
+    )
+    alias = models.CharField(max_length=50)
+
+
+class BalanceHold(models.Model):
+    """Balance reserved for an in-flight completion, settled to the actual
+    usage once the completion is recorded."""
+
+    user = models.ForeignKey(User, on_delete=models.DO_NOTHING)
+    amount = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+
+class CompletionJob(models.Model):
+    """A completion queued by /ask, run by the run_completion_workers
+    command, see skye.jobs."""
+
+    STATUS_QUEUED = "queued"
+    STATUS_RUNNING = "running"
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+    STATUS_CANCELLED = "cancelled"
+    STATUS_CHOICES = (
+        (STATUS_QUEUED, "Queued"),
+        (STATUS_RUNNING, "Running"),
+        (STATUS_DONE, "Done"),
+        (STATUS_FAILED, "Failed"),
+        (STATUS_CANCELLED, "Cancelled"),
+    )
+    PENDING = (STATUS_QUEUED, STATUS_RUNNING)
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    # the name of the model in the API
+    model = models.CharField(max_length=50)
+    prompts = models.JSONField()
+    params = models.JSONField(null=True)
+    status = models.CharField(
+        max_length=20, choices=STATUS_CHOICES, default=STATUS_QUEUED
+    )
+    # held until the job is settled, cancelled or failed
+    hold = models.ForeignKey(
+        BalanceHold,
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        null=True,
+        related_name="+",
+    )
+    completion = models.TextField(blank=True)
+    finish_reason = models.CharField(max_length=50, blank=True)
+    error = models.CharField(max_length=50, blank=True)
+    worker = models.CharField(max_length=100, blank=True)
+    # of the request queueing the job, for the logs of the worker
+    request_id = models.CharField(max_length=64, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True)
+    finished_at = models.DateTimeField(null=True)
+
+    class Meta:
+        indexes = [models.Index(fields=("status", "id"))]
+
+    def as_dict(self):
+        d = {"id": self.pk, "status": self.status, "created_at": self.created_at}
+        if self.status == self.STATUS_DONE:
+            d["completion"] = self.completion
+            d["finish_reason"] = self.finish_reason
+        if self.error:
+            d["error"] = self.error
+        return d
+
+
+class CompletionCacheEntry(models.Model):
+    """Backing store of the near-duplicate completion cache."""
+
+    partition = models.CharField(max_length=191, db_index=True)
+    normalized = models.TextField()
+    # of the normalized text, an entry per text and partition
+    digest = models.CharField(max_length=64)
+    signature = models.BinaryField()
     completion = models.TextField()
     finish_reason = models.CharField(max_length=50)
     prompt_usage = models.PositiveIntegerField()
     completion_usage = models.PositiveIntegerField()
     total_usage = models.PositiveIntegerField()
     created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=("partition", "digest"), name="unique_cache_entry"
+            )
+        ]
+
+    def as_dict(self):
+        return {
+            "completion": self.completion,
+            "finish_reason": self.finish_reason,
+            "prompt_token_usage": self.prompt_usage,
+            "completion_token_usage": self.completion_usage,
+            "total_token_usage": self.total_usage,
+        }
+
+
+class IdempotencyKey(models.Model):
+    """A request made with an Idempotency-Key header, and its response once
+    it is done, replayed to the retries, see skye.idempotency."""
+
+    STATUS_IN_PROGRESS = "in_progress"
+    STATUS_DONE = "done"
+    STATUS_CHOICES = (
+        (STATUS_IN_PROGRESS, "In progress"),
+        (STATUS_DONE, "Done"),
+    )
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="+")
+    key = models.CharField(max_length=64)
+    # of the path and body, a key is not reusable for another request
+    fingerprint = models.CharField(max_length=64)
+    status = models.CharField(
+        max_length=20, choices=STATUS_CHOICES, default=STATUS_IN_PROGRESS
+    )
+    status_code = models.PositiveSmallIntegerField(null=True)
+    content_type = models.CharField(max_length=100, blank=True)
+    body = models.BinaryField(default=b"")
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=("user", "key"), name="unique_idempotency_key"
+            )
+        ]
+
+
+# versions of the history endpoints, bulk writes bump them explicitly
+
+
+@receiver((post_save, post_delete), sender=Gift)
+def bump_gifts_version(sender, instance, using, **kwargs):
+    versions.bump(versions.GIFTS, [instance.user_id], using)
+
+
+@receiver((post_save, post_delete), sender=RedeemCode)
+def bump_redeem_codes_version(sender, instance, using, **kwargs):
+    versions.bump(versions.REDEEM_CODES, [instance.redeemer_id], using)
+
+
+@receiver((post_save, post_delete), sender=Profile)
+def bump_invitees_version(sender, instance, using, **kwargs):
+    versions.bump(versions.INVITEES, [instance.inviter_id], using)
+
+
+# not on delete, it would keep completions from being fast-deleted when they
+# are moved to another shard
+@receiver(post_save, sender=Completion)
+def bump_completions_version(sender, instance, using, **kwargs):
+    versions.bump(versions.COMPLETIONS, [instance.user_id], using)
+
+
+@receiver(post_save, sender=Completion)
+def index_completion(sender, instance, created, using, **kwargs):
+    # raw saves too: they copy completions to another shard
+    if created:
+        CompletionSearch.objects.using(using).create(
+            completion=instance, user_id=instance.user_id, text=instance.search_text()
+        )
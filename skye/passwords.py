@@ -0,0 +1,125 @@
+"""Password hashing off the request threads.
+
+Hashing and checking passwords is CPU-bound by design, and a burst of logins
+would starve every other request of CPU. They run in a pool of
+PASSWORD_HASH_PROCESSES processes instead, or in the calling thread if it is
+0. At most PASSWORD_HASH_QUEUE_LIMIT of them may be running or waiting at
+once; past that they are refused with Overloaded, answered with 503.
+
+Hashes that are not of the preferred hasher, or not with its current
+iterations, are replaced on the next successful login, see
+PBKDF2PasswordHasher.
+"""
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import django
+from django.conf import settings
+from django.contrib.auth import hashers
+
+
+class Overloaded(Exception):
+    """Too many passwords are being hashed already."""
+
+
+class PBKDF2PasswordHasher(hashers.PBKDF2PasswordHasher):
+    """PBKDF2-SHA256 with PASSWORD_HASH_ITERATIONS. Hashes with other
+    iterations still verify, and are rehashed when they do."""
+
+    @property
+    def iterations(self):
+        return settings.PASSWORD_HASH_ITERATIONS
+
+
+def _setup():
+    # the processes are spawned, not forked from a threaded server
+    django.setup()
+
+
+def _check(password, encoded):
+    """Whether ``password`` matches ``encoded``, and its new hash if
+    ``encoded`` is outdated."""
+    rehashed = []
+    ok = hashers.check_password(
+        password,
+        encoded,
+        setter=lambda raw: rehashed.append(hashers.make_password(raw)),
+    )
+    return ok, rehashed[0] if rehashed else None
+
+
+class Pool:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self.in_flight = 0
+        self.shed = 0
+
+    def _get_executor(self):
+        if not settings.PASSWORD_HASH_PROCESSES:
+            return None
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                settings.PASSWORD_HASH_PROCESSES,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_setup,
+            )
+        return self._executor
+
+    def run(self, fn, *args):
+        """``fn(*args)`` in the pool, or Overloaded if it is full."""
+        with self._lock:
+            if self.in_flight >= settings.PASSWORD_HASH_QUEUE_LIMIT:
+                self.shed += 1
+                raise Overloaded
+            self.in_flight += 1
+            executor = self._get_executor()
+        try:
+            if executor is None:
+                return fn(*args)
+            return executor.submit(fn, *args).result()
+        except BrokenProcessPool:
+            # a process died, e.g. killed for memory: start a new pool
+            with self._lock:
+                if self._executor is executor:
+                    self._executor = None
+            raise
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def metrics(self):
+        with self._lock:
+            return {
+                "processes": settings.PASSWORD_HASH_PROCESSES,
+                "queue_limit": settings.PASSWORD_HASH_QUEUE_LIMIT,
+                "in_flight": self.in_flight,
+                "shed": self.shed,
+            }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def pool() -> Pool:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = Pool()
+    return _pool
+
+
+def make_password(password) -> str:
+    return pool().run(hashers.make_password, password)
+
+
+def check_password(user, password) -> bool:
+    """Like User.check_password, saving the new hash of an outdated one."""
+    ok, rehashed = pool().run(_check, password, user.password)
+    if rehashed:
+        user.password = rehashed
+        user.save(update_fields=["password"])
+    return ok
@@ -0,0 +1,201 @@
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.contrib.auth import SESSION_KEY
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+
+_state = threading.local()
+_health = {}
+
+# models that are read from the primary only, jobs are polled for their status
+PRIMARY_ONLY = {"sessions.session", "skye.shardassignment", "skye.completionjob"}
+# models that live on the shard of their user, see COMPLETION_SHARDS;
+# blobs are written to the shard of the completions referring to them
+SHARDED = {"skye.completion", "skye.completionsearch", "skye.blob"}
+
+
+# caches of a single process
+LOCAL_CACHES = (
+    "django.core.cache.backends.locmem.LocMemCache",
+    "django.core.cache.backends.dummy.DummyCache",
+)
+
+
+def cache_is_shared() -> bool:
+    """Whether the processes share the default cache."""
+    return settings.CACHES["default"]["BACKEND"] not in LOCAL_CACHES
+
+
+def shard_for(user_id):
+    """The database alias the completions of a user live on."""
+    shards = settings.COMPLETION_SHARDS
+    if not shards:
+        return DEFAULT_DB_ALIAS
+
+    # a process caching the shard on its own would miss the user moving
+    key = f"skye:shard:{user_id}"
+    alias = cache.get(key) if cache_is_shared() else None
+    if alias is None:
+        from .models import ShardAssignment
+
+        alias = (
+            ShardAssignment.objects.filter(user_id=user_id)
+            .values_list("alias", flat=True)
+            .first()
+            or shards[int(user_id) % len(shards)]
+        )
+        if cache_is_shared():
+            cache.set(key, alias, settings.COMPLETION_SHARD_CACHE_TTL)
+    return alias
+
+
+def forget_shard(user_id):
+    cache.delete(f"skye:shard:{user_id}")
+
+
+@contextmanager
+def pinned_to_primary(pinned=True):
+    """Send every read of the current thread to the primary database."""
+    previous = getattr(_state, "pinned", False)
+    _state.pinned = pinned or previous
+    try:
+        yield
+    finally:
+        _state.pinned = previous
+
+
+STICKY_COOKIE = "read_your_writes"
+
+
+def stick(response, user_id):
+    """Keep the reads of a user on the primary until the replicas caught up
+    with what they just wrote. The mark is a signed cookie, so that the
+    next request sees it whichever process serves it."""
+    response.set_signed_cookie(
+        STICKY_COOKIE,
+        str(user_id),
+        salt=STICKY_COOKIE,
+        max_age=settings.READ_YOUR_WRITES_TTL,
+        secure=settings.SESSION_COOKIE_SECURE,
+        httponly=True,
+        samesite=settings.SESSION_COOKIE_SAMESITE,
+    )
+
+
+def is_sticky(request, user_id):
+    if user_id is None:
+        return False
+    marked = request.get_signed_cookie(
+        STICKY_COOKIE,
+        default=None,
+        salt=STICKY_COOKIE,
+        max_age=settings.READ_YOUR_WRITES_TTL,
+    )
+    return marked == str(user_id)
+
+
+def session_user_id(request):
+    """The id of the logged in user, without loading the user."""
+    return request.session.get(SESSION_KEY)
+
+
+def replica_lag(alias):
+    """Seconds the replica is behind the primary, None if unknown."""
+    with connections[alias].cursor() as cursor:
+        if connections[alias].vendor != "mysql":
+            cursor.execute("SELECT 1")
+            return 0
+        cursor.execute("SHOW SLAVE STATUS")
+        row = cursor.fetchone()
+        if row is None:
+            return 0
+        status = dict(zip((col[0] for col in cursor.description), row))
+        return status["Seconds_Behind_Master"]
+
+
+def is_healthy(alias):
+    """Whether the replica is up and not lagging, checked at most every
+    DATABASE_REPLICA_CHECK_INTERVAL seconds per process."""
+    checked_at, healthy = _health.get(alias, (0, False))
+    if time.monotonic() - checked_at < settings.DATABASE_REPLICA_CHECK_INTERVAL:
+        return healthy
+    try:
+        lag = replica_lag(alias)
+        healthy = lag is not None and lag <= settings.DATABASE_REPLICA_MAX_LAG
+    except Exception:
+        healthy = False
+    _health[alias] = (time.monotonic(), healthy)
+    return healthy
+
+
+class ShardRouter:
+    """Places the models of SHARDED on the shard of their user.
+
+    The user is taken from the instance hint: a sharded instance, or the
+    user of a related manager such as ``user.completion_set``. Queries
+    without a hint should use ``Completion.objects.for_user()``.
+    """
+
+    def _shard(self, model, hints):
+        if model._meta.label_lower not in SHARDED or not settings.COMPLETION_SHARDS:
+            return None
+        instance = hints.get("instance")
+        if instance is None:
+            return None
+        if instance._meta.label_lower in SHARDED:
+            user_id = getattr(instance, "user_id", None)
+        else:
+            user_id = instance.pk
+        return shard_for(user_id) if user_id is not None else None
+
+    def db_for_read(self, model, **hints):
+        return self._shard(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self._shard(model, hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if {obj1._meta.label_lower, obj2._meta.label_lower} & SHARDED:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db not in settings.COMPLETION_SHARDS or db == DEFAULT_DB_ALIAS:
+            return None
+        return f"{app_label}.{model_name}" in SHARDED
+
+
+class ReplicaRouter:
+    """Sends reads to a healthy replica of DATABASE_REPLICAS and everything
+    else to the primary.
+
+    Reads stay on the primary inside transactions, for sessions, and while
+    the current thread is pinned to it (see ReadReplicaMiddleware).
+    """
+
+    def db_for_read(self, model, **hints):
+        if (
+            getattr(_state, "pinned", False)
+            or model._meta.label_lower in PRIMARY_ONLY
+            or connections[DEFAULT_DB_ALIAS].in_atomic_block
+        ):
+            return DEFAULT_DB_ALIAS
+        replicas = [a for a in settings.DATABASE_REPLICAS if is_healthy(a)]
+        return random.choice(replicas) if replicas else DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        dbs = {DEFAULT_DB_ALIAS, *settings.DATABASE_REPLICAS}
+        if obj1._state.db in dbs and obj2._state.db in dbs:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replicas receive the schema from the primary
+        return db not in settings.DATABASE_REPLICAS
@@ -1,10 +1,70 @@
+import json
+import logging
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from io import StringIO
+from contextlib import ExitStack
+from types import SimpleNamespace
+from unittest import mock, skipUnless
+
+import openai
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, connections
 from django.db.models import Sum
-from django.test import SimpleTestCase, TestCase, override_settings
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.test import (
+    Client,
+    LiveServerTestCase,
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
-from skye import gpt
+from django.http import JsonResponse
+
+from skye import (
+    admin,
+    api,
+    fallback,
+    fuzzy_cache,
+    gpt,
+    jobs,
+    passwords,
+    routers,
+    upstream,
+    urls,
+)
+from skye_server import capture, log
+from .management.commands import replay_traffic
+from skye_server.mysql import pool as database_pool
+from .exports import iter_redeem_codes_csv
+from .fake_upstream import FakeUpstream
 from .gpt_models import v1
-from .models import User, RedeemCode, Gift, Completion
+from .models import (
+    User,
+    Profile,
+    RedeemCode,
+    Gift,
+    Completion,
+    BalanceHold,
+    ShardAssignment,
+    GiftCampaign,
+    Blob,
+    IdempotencyKey,
+    CompletionJob,
+    CompletionCacheEntry,
+)
 
 
 def _create_superuser():
@@ -20,6 +80,7 @@ def _create_superuser():
 
 
 class GPTTestModel(v1.BaseModel):
+    codename = "test.1"
     model = "test"
     prompt_template = "{p}"
     temperature = 0.5
@@ -68,6 +129,20 @@ class GptTests(SimpleTestCase):
     def test_load_model(self):
         self.assertIsNone(gpt.GPT.load_model("nonexistence"))
 
+    def test_split_text(self):
+        text = "First one. Second one.\n\n第一句。第二句！\n\n" + "x" * 50
+        # paragraphs are packed as long as they fit
+        self.assertEqual(
+            ["First one. Second one.\n\n第一句。第二句！", "x" * 50],
+            gpt.split_text(text, 150),
+        )
+        # then sentences, and only sentences over the budget are cut
+        self.assertEqual(
+            ["First one.", "Second one.", "第一句。第二句！"] + ["x" * 13] * 3 + ["x" * 11],
+            gpt.split_text(text, 40),
+        )
+        self.assertEqual([], gpt.split_text(" \n\n ", 100))
+
     def test_create_completion(self):
         gpt.AVAILABLE_MODELS["test"] = GPTTestModel
         gpt.GPT.TESTING = True
@@ -76,6 +151,7 @@ class GptTests(SimpleTestCase):
         self.assertDictEqual(
             completion,
             {
+                "upstream_model": "test",
                 "prompt": "Hello!",
                 "completion": "Hi!",
                 "finish_reason": "stop",
@@ -86,7 +162,750 @@ class GptTests(SimpleTestCase):
         )
 
 
+class ApiSchemaTests(SimpleTestCase):
+    def test_schema(self):
+        schema = api.Schema(
+            {
+                "name": str,
+                "count": api.optional(int),
+                "lang": ("en", "cn"),
+                "nested": api.optional(api.Schema({"q": str})),
+            }
+        )
+        self.assertIsNone(schema.validate({"name": "a", "lang": "en", "x": 1}))
+        self.assertEqual("body must be object", schema.validate([]))
+        self.assertEqual("name is required", schema.validate({"lang": "en"}))
+        self.assertEqual(
+            "count must be int",
+            schema.validate({"name": "a", "lang": "en", "count": True}),
+        )
+        self.assertEqual(
+            "lang must be one of en, cn", schema.validate({"name": "a", "lang": []})
+        )
+        self.assertEqual(
+            "nested.q is required",
+            schema.validate({"name": "a", "lang": "cn", "nested": {}}),
+        )
+
+    def test_model_schema(self):
+        for name in gpt.AVAILABLE_MODELS:
+            self.assertIsInstance(api.model_schema(name), api.Schema)
+
+        dictionary = api.model_schema("dict")
+        self.assertIsNone(
+            dictionary.validate({"prompts": {"q": "hi"}, "params": {"lang": "en"}})
+        )
+        self.assertEqual(
+            "params is required", dictionary.validate({"prompts": {"q": "hi"}})
+        )
+        outline = api.model_schema("thesis_outline_assistant")
+        self.assertEqual(
+            "prompts.content is required",
+            outline.validate({"prompts": {"level": "h1"}}),
+        )
+        self.assertEqual(
+            "params.mode is required",
+            outline.validate({"prompts": {"level": "h1", "content": ""}, "params": {}}),
+        )
+
+    def test_dumps(self):
+        data = {"at": timezone.now(), "text": "你好", "n": [1, 2.5, None, True]}
+        self.assertEqual(
+            json.loads(JsonResponse(data).content),
+            json.loads(api.JsonResponse(data).content),
+        )
+
+
+class MicroBatcherTests(SimpleTestCase):
+    def setUp(self):
+        self.calls = []
+
+    def _send(self, params):
+        self.calls.append(params)
+        prompts = params["prompt"]
+        if isinstance(prompts, str):
+            prompts = [prompts]
+        return SimpleNamespace(
+            choices=[
+                SimpleNamespace(index=i, text="A" * (i + 1), finish_reason="stop")
+                for i in reversed(range(len(prompts)))
+            ],
+            usage=SimpleNamespace(
+                prompt_tokens=31, completion_tokens=61, total_tokens=92
+            ),
+        )
+
+    def _submit_concurrently(self, batcher, many):
+        results = [None] * len(many)
+
+        def run(i):
+            results[i] = batcher.submit(many[i])
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(len(many))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    def test_batches_same_params(self):
+        batcher = gpt.MicroBatcher(self._send, window=5, max_size=3, tokens_bucket=256)
+        many = [
+            {"model": "m", "prompt": p, "temperature": 0, "max_tokens": 4000 - i}
+            for i, p in enumerate(("a", "bb", "ccc"))
+        ]
+        results = self._submit_concurrently(batcher, many)
+
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(sorted(self.calls[0]["prompt"]), ["a", "bb", "ccc"])
+        self.assertEqual(self.calls[0]["max_tokens"], 3998)
+        order = self.calls[0]["prompt"]
+        for params, result in zip(many, results):
+            self.assertEqual(
+                result.choices[0].text, "A" * (order.index(params["prompt"]) + 1)
+            )
+        self.assertEqual(sum(r.usage.prompt_tokens for r in results), 31)
+        self.assertEqual(sum(r.usage.completion_tokens for r in results), 61)
+        self.assertEqual(sum(r.usage.total_tokens for r in results), 92)
+
+    def test_does_not_mix_sampling_params(self):
+        batcher = gpt.MicroBatcher(
+            self._send, window=0.05, max_size=5, tokens_bucket=256
+        )
+        many = [
+            {"model": "m", "prompt": "a", "temperature": 0, "max_tokens": 4000},
+            {"model": "m", "prompt": "b", "temperature": 1, "max_tokens": 4000},
+            {"model": "m", "prompt": "c", "temperature": 0, "max_tokens": 1000},
+        ]
+        results = self._submit_concurrently(batcher, many)
+
+        self.assertEqual(len(self.calls), 3)
+        for result in results:
+            self.assertEqual(result.usage.total_tokens, 92)
+
+    def test_split_usage(self):
+        self.assertEqual(gpt._split_usage(10, [1, 1, 1]), [4, 3, 3])
+        self.assertEqual(gpt._split_usage(7, [0, 0]), [4, 3])
+        self.assertEqual(sum(gpt._split_usage(1001, [3, 5, 11, 2])), 1001)
+
+
+@override_settings(
+    GPT_SLO_MIN_SAMPLES=3,
+    GPT_LATENCY_SLO=1,
+    GPT_ERROR_RATE_SLO=0.5,
+    GPT_FALLBACK_COOLDOWN=60,
+)
+class FallbackTests(SimpleTestCase):
+    route = ["fast", "faster"]
+
+    def test_route_of(self):
+        self.assertEqual(
+            ["text-davinci-003", "text-curie-001"],
+            fallback.route_of("dict", v1.DictionaryModel),
+        )
+        with override_settings(GPT_MODEL_ROUTES={"dict": "text-curie-001"}):
+            self.assertEqual(
+                ["text-curie-001"], fallback.route_of("dict", v1.DictionaryModel)
+            )
+
+    def test_falls_back_on_latency(self):
+        router = fallback.Router()
+        for _ in range(2):
+            router.record("dict", "fast", self.route, 5, True)
+        self.assertEqual("fast", router.route("dict", self.route))
+        with self.assertLogs("skye.fallback", "WARNING") as logs:
+            router.record("dict", "fast", self.route, 5, True)
+        self.assertEqual(
+            {
+                "samples": 3,
+                "p90_ms": 5000,
+                "error_rate": 0.0,
+                "tripped": True,
+                "product": "dict",
+                "model": "fast",
+                "slo": "latency",
+            },
+            logs.records[0].data,
+        )
+        self.assertEqual("faster", router.route("dict", self.route))
+        # other products are not affected
+        self.assertEqual("fast", router.route("grammar", self.route))
+        metrics = {(m["product"], m["model"]): m for m in router.metrics()}
+        self.assertTrue(metrics[("dict", "fast")]["tripped"])
+        self.assertEqual(1, metrics[("dict", "faster")]["fallbacks"])
+
+        # the model gets the traffic back after the cooldown
+        later = time.monotonic() + 61
+        with mock.patch.object(fallback.time, "monotonic", return_value=later):
+            self.assertEqual("fast", router.route("dict", self.route))
+
+    def test_falls_back_on_errors(self):
+        router = fallback.Router()
+        router.record("dict", "fast", self.route, 0.1, True)
+        router.record("dict", "fast", self.route, 0.1, False)
+        self.assertEqual("fast", router.route("dict", self.route))
+        router.record("dict", "fast", self.route, 0.1, False)
+        self.assertEqual("faster", router.route("dict", self.route))
+
+    @mock.patch.object(gpt.GPT, "TESTING", True)
+    def test_fallback_model_context(self):
+        router = fallback.Router()
+        router.record("dict", "text-davinci-003", ["a", "b"], 0, False)
+        for _ in range(3):
+            router.record("dict", "text-davinci-003", ["a", "b"], 5, True)
+        sent = []
+        client = gpt.test_client()
+
+        def request(data):
+            sent.append(dict(data))
+            return client(data)
+
+        with mock.patch.object(fallback, "_router", router):
+            g = gpt.GPT.load_model("dict")
+            g.request = request
+            completion = g.create_completion({"q": "hi"}, {"lang": "en"})
+            self.assertEqual("text-curie-001", completion["upstream_model"])
+            prompt_tokens = gpt.calculate_tokens(completion["prompt"])
+            self.assertEqual(2049, sent[0]["max_tokens"] + prompt_tokens)
+
+            # a prompt too long for the fallback model stays on the model
+            g = gpt.GPT.load_model("dict")
+            g.request = request
+            completion = g.create_completion({"q": "hi " * 300}, {"lang": "en"})
+            self.assertEqual("text-davinci-003", completion["upstream_model"])
+            self.assertGreater(sent[1]["max_tokens"], 0)
+
+    @mock.patch.object(gpt.GPT, "TESTING", True)
+    def test_client_errors_dont_count(self):
+        router = fallback.Router()
+
+        def request(error):
+            def raise_error(data):
+                raise error
+
+            return raise_error
+
+        with mock.patch.object(fallback, "_router", router):
+            for error in (
+                openai.error.InvalidRequestError("Too long", "prompt"),
+                openai.error.ServiceUnavailableError("Overloaded"),
+            ):
+                g = gpt.GPT.load_model("dict")
+                g.request = request(error)
+                with self.assertRaises(type(error)):
+                    g.create_completion({"q": "hi"}, {"lang": "en"})
+        samples = {m["model"]: m["samples"] for m in router.metrics()}
+        self.assertEqual({"text-davinci-003": 1}, samples)
+        self.assertEqual(1.0, router.metrics()[0]["error_rate"])
+
+    def test_no_fallback_without_another_model(self):
+        router = fallback.Router()
+        for _ in range(5):
+            router.record("thesis", "fast", ["fast"], 5, False)
+        self.assertEqual("fast", router.route("thesis", ["fast"]))
+
+
+class UpstreamPoolTests(SimpleTestCase):
+    params = {"model": "text-davinci-003", "prompt": "hi " * 40, "max_tokens": 100}
+
+    def _pool(self, fake, *keys, weights=None):
+        weights = weights or [1] * len(keys)
+        return upstream.CredentialPool(
+            [
+                upstream.Credential(key, weight=weight, api_base=fake.url)
+                for key, weight in zip(keys, weights)
+            ]
+        )
+
+    def test_parse(self):
+        self.assertEqual(360.02, upstream.parse_duration("6m20ms"))
+        self.assertEqual(1.5, upstream.parse_duration("1.5"))
+        self.assertIsNone(upstream.parse_duration(""))
+        a, b = upstream.parse_credentials(["sk-a", "sk-b;weight=2;api_base=http://x"])
+        self.assertEqual(("sk-a", 1.0, None), (a.key, a.weight, a.api_base))
+        self.assertEqual(("sk-b", 2.0, "http://x"), (b.key, b.weight, b.api_base))
+
+    def test_routes_by_weight(self):
+        limits = {"sk-a": (1000, 10**6), "sk-b": (1000, 10**6)}
+        with FakeUpstream(limits) as fake:
+            pool = self._pool(fake, "sk-a", "sk-b", weights=[1, 4])
+            for _ in range(100):
+                response = pool.complete(self.params, 200)
+                self.assertEqual("Hi!", response.choices[0].text)
+        self.assertGreater(fake.served["sk-b"], fake.served["sk-a"] * 2)
+
+    def test_routes_by_headroom(self):
+        # the small key has room for 10 requests a minute
+        limits = {"sk-small": (1000, 1110), "sk-large": (1000, 10**6)}
+        with FakeUpstream(limits) as fake:
+            pool = self._pool(fake, "sk-small", "sk-large")
+            for _ in range(60):
+                pool.complete(self.params, 111)
+            metrics = pool.metrics()
+        self.assertEqual(60, sum(fake.served.values()))
+        self.assertLessEqual(fake.served["sk-small"], 10)
+        self.assertLessEqual(fake.rejected["sk-small"], 1)
+        self.assertEqual(
+            ["...mall", "...arge"], [credential["name"] for credential in metrics]
+        )
+
+    def test_ejects_rate_limited_keys(self):
+        limits = {"sk-a": (1, 10**6), "sk-b": (1, 10**6)}
+        with FakeUpstream(limits) as fake:
+            pool = self._pool(fake, "sk-a", "sk-b")
+            pool.complete(self.params, 111)
+            pool.complete(self.params, 111)
+            self.assertEqual({"sk-a": 1, "sk-b": 1}, dict(fake.served))
+            # both keys answer 429 and are ejected
+            with self.assertRaises(openai.error.RateLimitError):
+                pool.complete(self.params, 111)
+            self.assertEqual(2, sum(fake.rejected.values()))
+            self.assertTrue(all(c["ejected"] for c in pool.metrics()))
+            # until their quota resets, upstream is not asked again
+            with self.assertRaises(openai.error.RateLimitError):
+                pool.complete(self.params, 111)
+            self.assertEqual(2, sum(fake.rejected.values()))
+            self.assertTrue(all(c.requests == 2 for c in pool.credentials))
+
+    def test_keeps_the_last_key_on_connection_errors(self):
+        with FakeUpstream({"sk-up": (1000, 10**6)}) as fake:
+            down = upstream.Credential("sk-down", api_base="http://127.0.0.1:9")
+            pool = upstream.CredentialPool([down])
+            # the only key isn't ejected, the connection error is raised
+            for _ in range(2):
+                with self.assertRaises(openai.error.APIConnectionError):
+                    pool.complete(self.params, 111)
+            self.assertFalse(pool.metrics()[0]["ejected"])
+            self.assertEqual(2, down.requests)
+
+            pool = upstream.CredentialPool(
+                [down, upstream.Credential("sk-up", api_base=fake.url)]
+            )
+            for _ in range(10):
+                pool.complete(self.params, 111)
+            self.assertEqual(10, fake.served["sk-up"])
+            self.assertLessEqual(down.requests, 3)
+            self.assertEqual([True, False], [c["ejected"] for c in pool.metrics()])
+
+
+class FakeConnection:
+    def __init__(self):
+        self.alive = True
+        self.pings = 0
+        self.closed = False
+
+    def ping(self):
+        self.pings += 1
+        if not self.alive:
+            raise OSError("MySQL server has gone away")
+
+    def close(self):
+        self.closed = True
+
+
+class DatabasePoolTests(SimpleTestCase):
+    def _pool(self, size=2, timeout=0.05, check_after=5, max_idle=300):
+        self.opened = []
+
+        def connect():
+            self.opened.append(FakeConnection())
+            return self.opened[-1]
+
+        self.connect = connect
+        return database_pool.Pool(size, timeout, check_after, max_idle)
+
+    def test_reuses_connections(self):
+        pool = self._pool()
+        first = pool.acquire(self.connect)
+        pool.release(first)
+        self.assertIs(first, pool.acquire(self.connect))
+        second = pool.acquire(self.connect)
+        self.assertEqual([first, second], self.opened)
+        self.assertEqual(0, first.pings)
+
+        metrics = pool.metrics()
+        self.assertEqual(2, metrics["open"])
+        self.assertEqual(2, metrics["in_use"])
+        self.assertEqual(3, metrics["acquired"])
+
+    def test_waits_for_a_connection(self):
+        pool = self._pool(size=1, timeout=1)
+        held = pool.acquire(self.connect)
+        timer = threading.Timer(0.05, pool.release, [held])
+        timer.start()
+        self.assertIs(held, pool.acquire(self.connect))
+        timer.join()
+        self.assertEqual(1, pool.metrics()["waited"])
+        self.assertGreaterEqual(pool.metrics()["max_wait_ms"], 40)
+
+        # and gives up
+        pool.timeout = 0.05
+        with self.assertRaises(database_pool.PoolTimeout):
+            pool.acquire(self.connect)
+        self.assertEqual(1, pool.metrics()["timeouts"])
+        self.assertEqual(1, pool.metrics()["open"])
+
+    def test_replaces_stale_connections(self):
+        pool = self._pool(size=1, check_after=10, max_idle=100)
+        connection = pool.acquire(self.connect)
+        pool.release(connection)
+
+        # idle for a while: pinged, and replaced if the server dropped it
+        now, wall = time.monotonic(), time.time()
+        with mock.patch("time.monotonic", lambda: now + 20):
+            connection.alive = False
+            fresh = pool.acquire(self.connect)
+        self.assertEqual(1, connection.pings)
+        self.assertTrue(connection.closed)
+        self.assertIsNot(connection, fresh)
+        pool.release(fresh)
+
+        # thawed after a freeze longer than the server keeps connections
+        with mock.patch("time.time", lambda: wall + 1000):
+            self.assertIsNot(fresh, pool.acquire(self.connect))
+        self.assertEqual(0, fresh.pings)
+        self.assertTrue(fresh.closed)
+        self.assertEqual(
+            {"open": 1, "dropped": 2},
+            {k: pool.metrics()[k] for k in ("open", "dropped")},
+        )
+
+    def test_forked_process_starts_empty(self):
+        pool = database_pool.pool("default")
+        self.assertIs(pool, database_pool.pool("default"))
+        with mock.patch("os.getpid", lambda: -1):
+            self.assertIsNot(pool, database_pool.pool("default"))
+
+
+@override_settings(FUZZY_CACHE_ENABLED=True)
+@mock.patch.object(gpt.GPT, "TESTING", True)
+class FuzzyCacheTests(TestCase):
+    def setUp(self):
+        fuzzy_cache.reset()
+        self.addCleanup(fuzzy_cache.reset)
+
+    def _ask(self, q, lang="en"):
+        instance = gpt.GPT.load_model("dict")
+        with mock.patch.object(instance, "request", wraps=instance.request) as req:
+            completion = instance.create_completion({"q": q}, {"lang": lang})
+        return completion, req.called
+
+    def test_normalize(self):
+        self.assertEqual(fuzzy_cache.normalize("  Ｈｅｌｌｏ， World！ "), "helloworld")
+        self.assertEqual(fuzzy_cache.normalize("你好，世界。"), "你好世界")
+
+    def test_near_duplicates_share_completion(self):
+        completion, called = self._ask("What does 'serendipity' mean?")
+        self.assertTrue(called)
+        self.assertEqual("Hi!", completion["completion"])
+
+        # punctuation, spacing, case and full-width characters
+        completion, called = self._ask("what does serendipity mean ？ ")
+        self.assertFalse(called)
+        self.assertEqual(100, completion["total_token_usage"])
+        self.assertEqual(1, fuzzy_cache.metrics["exact_hits"])
+
+        # a typo is still a near-duplicate
+        _, called = self._ask("what does serendipitty mean")
+        self.assertFalse(called)
+        self.assertEqual(1, fuzzy_cache.metrics["fuzzy_hits"])
+
+        # but a different question or language is not
+        _, called = self._ask("what does serenity mean")
+        self.assertTrue(called)
+        _, called = self._ask("What does 'serendipity' mean?", lang="cn")
+        self.assertTrue(called)
+
+    def test_grammar_exact_hits_only(self):
+        def check(sentences):
+            instance = gpt.GPT.load_model("grammar")
+            with mock.patch.object(instance, "request", wraps=instance.request) as req:
+                instance.create_completion({"sentences": sentences}, {"lang": "en"})
+            return req.called
+
+        self.assertTrue(check("She has finished her homework before dinner."))
+        # a word apart, though similar enough for the other models
+        self.assertTrue(check("She have finished her homework before dinner."))
+        self.assertEqual(0, fuzzy_cache.metrics["fuzzy_hits"])
+        self.assertFalse(check("she has finished her homework before dinner"))
+        self.assertEqual(1, fuzzy_cache.metrics["exact_hits"])
+
+        instance = gpt.GPT.load_model("grammar")
+        instance.model.set_params({"lang": "en"})
+        partition = instance.cache_partition()
+        # the same input would have been a near-duplicate hit
+        self.assertIsNotNone(
+            fuzzy_cache.get(partition, "She had finished her homework before dinner.")
+        )
+
+    def test_backing_store(self):
+        self._ask("ephemeral")
+        fuzzy_cache.reset()
+        _, called = self._ask("Ephemeral.")
+        self.assertFalse(called)
+
+    def test_eviction(self):
+        index = fuzzy_cache.FuzzyIndex(max_entries=2)
+
+        def add(text):
+            normalized = fuzzy_cache.normalize(text)
+            signature = fuzzy_cache.minhash(fuzzy_cache.shingles(normalized))
+            index.add(normalized, signature, text)
+            return normalized, signature
+
+        first = add("what does serendipity mean")
+        add("what does ephemeral mean")
+        self.assertEqual(("what does serendipity mean", True), index.lookup(*first))
+        add("what does ubiquitous mean")
+
+        # the least recently used went, from the bands as well
+        self.assertEqual(2, len(index.exact))
+        self.assertNotIn("whatdoesephemeralmean", index.exact)
+        entries = [e for band in index.bands.values() for e in band.values()]
+        self.assertEqual(2, len({e[0] for e in entries}))
+        self.assertEqual(2 * fuzzy_cache.BANDS, len(entries))
+        self.assertIsNotNone(index.lookup(*first))
+
+    @override_settings(FUZZY_CACHE_MAX_ENTRIES=1)
+    def test_backing_store_loads_newest(self):
+        self._ask("ephemeral")
+        self._ask("serendipity")
+        fuzzy_cache.reset()
+        _, called = self._ask("Serendipity.")
+        self.assertFalse(called)
+        _, called = self._ask("Ephemeral.")
+        self.assertTrue(called)
+
+    @override_settings(FUZZY_CACHE_MAX_ENTRIES=2)
+    def test_backing_store_upserts_and_prunes(self):
+        value = {
+            "completion": "Hi!",
+            "finish_reason": "stop",
+            "prompt_token_usage": 1,
+            "completion_token_usage": 1,
+            "total_token_usage": 2,
+        }
+        fuzzy_cache.put("p", "Ephemeral.", value)
+        fuzzy_cache.put("p", "ephemeral", dict(value, completion="Hello!"))
+        entry = CompletionCacheEntry.objects.get()
+        self.assertEqual(("ephemeral", "Hello!"), (entry.normalized, entry.completion))
+
+        for text in ("serendipity", "ubiquitous", "ephemeral!"):
+            fuzzy_cache.put("p", text, value)
+        fuzzy_cache.put("q", "serendipity", value)
+        self.assertEqual(
+            [("p", "ubiquitous"), ("p", "ephemeral"), ("q", "serendipity")],
+            list(
+                CompletionCacheEntry.objects.order_by("pk").values_list(
+                    "partition", "normalized"
+                )
+            ),
+        )
+
+
+@override_settings(DATABASE_REPLICAS=["replica0", "replica1"])
+class ReplicaRouterTests(SimpleTestCase):
+    def setUp(self):
+        self.router = routers.ReplicaRouter()
+        healthy = {"replica0": True, "replica1": False}
+        patcher = mock.patch.object(routers, "is_healthy", healthy.get)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_db_for_read(self):
+        self.assertEqual("replica0", self.router.db_for_read(Gift))
+        self.assertEqual("default", self.router.db_for_write(Gift))
+        with routers.pinned_to_primary():
+            self.assertEqual("default", self.router.db_for_read(Gift))
+        self.assertEqual("replica0", self.router.db_for_read(Gift))
+
+        with mock.patch.object(routers, "is_healthy", return_value=False):
+            self.assertEqual("default", self.router.db_for_read(Gift))
+
+    def test_allow_migrate(self):
+        self.assertTrue(self.router.allow_migrate("default", "skye"))
+        self.assertFalse(self.router.allow_migrate("replica1", "skye"))
+
+
+@override_settings(DATABASE_REPLICA_MAX_LAG=5, DATABASE_REPLICA_CHECK_INTERVAL=60)
+class ReplicaHealthTests(SimpleTestCase):
+    def setUp(self):
+        routers._health.clear()
+        self.addCleanup(routers._health.clear)
+
+    def test_is_healthy(self):
+        with mock.patch.object(routers, "replica_lag", return_value=1) as lag:
+            self.assertTrue(routers.is_healthy("replica0"))
+            self.assertTrue(routers.is_healthy("replica0"))
+            self.assertEqual(1, lag.call_count)
+        with mock.patch.object(routers, "replica_lag", return_value=10):
+            self.assertFalse(routers.is_healthy("replica1"))
+        with mock.patch.object(routers, "replica_lag", side_effect=Exception):
+            self.assertFalse(routers.is_healthy("replica2"))
+
+
+@override_settings(COMPLETION_SHARDS=["default", "shard1"])
+class ShardRouterTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.router = routers.ShardRouter()
+
+    def test_shard_for(self):
+        self.assertEqual("default", routers.shard_for(2))
+        self.assertEqual("shard1", routers.shard_for(3))
+
+        user = User.objects.create_user(username="moved@mail.com")
+        ShardAssignment.objects.create(user=user, alias="shard1")
+        routers.forget_shard(user.pk)
+        self.assertEqual("shard1", routers.shard_for(user.pk))
+        # only cached in a cache shared by the processes
+        with self.assertNumQueries(1):
+            routers.shard_for(user.pk)
+        shared = {
+            "default": {
+                "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+                "LOCATION": tempfile.mkdtemp(),
+            }
+        }
+        with override_settings(CACHES=shared):
+            routers.shard_for(user.pk)
+            with self.assertNumQueries(0):
+                routers.shard_for(user.pk)
+
+    def test_placement(self):
+        user = User(pk=3)
+        self.assertEqual(
+            "shard1",
+            self.router.db_for_write(Completion, instance=Completion(user=user)),
+        )
+        self.assertEqual("shard1", self.router.db_for_read(Completion, instance=user))
+        self.assertIsNone(self.router.db_for_read(Completion))
+        self.assertIsNone(self.router.db_for_read(Gift, instance=user))
+        self.assertTrue(self.router.allow_migrate("shard1", "skye", "completion"))
+        self.assertFalse(self.router.allow_migrate("shard1", "skye", "gift"))
+        self.assertIsNone(self.router.allow_migrate("default", "skye", "gift"))
+
+
+@skipUnless(
+    len(settings.COMPLETION_SHARDS) > 1, "needs at least two COMPLETION_SHARD_URLS"
+)
+@override_settings(COMPLETION_SHARD_CACHE_TTL=0)
+class ReshardTests(TestCase):
+    databases = "__all__"
+
+    def test_reshard_completions(self):
+        cache.clear()
+        user = _create_superuser()
+        for i in range(5):
+            Completion.objects.create(
+                user=user,
+                prompt={"q": i},
+                completion="",
+                prompt_usage=1,
+                completion_usage=1,
+                total_usage=2,
+            )
+        first = Completion.objects.for_user(user.pk).order_by("pk").first()
+        source = routers.shard_for(user.pk)
+        target = next(a for a in settings.COMPLETION_SHARDS if a != source)
+        # another user of the source shard asked the first question too
+        shared = Completion.objects.using(source).create(
+            user_id=user.pk + 1,
+            prompt={"q": 0},
+            completion="",
+            prompt_usage=1,
+            completion_usage=1,
+            total_usage=2,
+        )
+
+        call_command(
+            "reshard_completions",
+            target,
+            str(user.pk),
+            "--chunk-size=2",
+            stdout=StringIO(),
+        )
+
+        self.assertEqual(target, routers.shard_for(user.pk))
+        self.assertFalse(Completion.objects.using(source).filter(user=user).exists())
+        completions = Completion.objects.for_user(user.pk).order_by("pk")
+        self.assertEqual(5, completions.count())
+        self.assertEqual(first.created_at, completions[0].created_at)
+        self.assertEqual(
+            10, user.completion_set.aggregate(Sum("total_usage"))["total_usage__sum"]
+        )
+
+        # the blobs left on the source are the ones another user refers to
+        digests = {c.prompt_digest for c in completions} | {
+            c.completion_digest for c in completions
+        }
+        self.assertEqual(
+            {shared.prompt_digest, shared.completion_digest},
+            set(
+                Blob.objects.using(source)
+                .filter(digest__in=digests)
+                .values_list("digest", flat=True)
+            ),
+        )
+        self.assertEqual(
+            len(digests),
+            Blob.objects.using(target).filter(digest__in=digests).count(),
+        )
+
+
 class ModelTests(TestCase):
+    databases = "__all__"
+
+    def test_profile_saves_only_changes(self):
+        user = User.objects.create_user(username="profile@mail.com")
+        self.assertEqual(f"/{user.pk}/", user.profile.invitation_path)
+        self.assertEqual(user.pk, user.profile.inviter_id)
+
+        # logging in saves the user, the profile isn't loaded to be saved too
+        user = User.objects.get(pk=user.pk)
+        with self.assertNumQueries(1):
+            user.save(update_fields=["last_login"])
+
+        user.profile.name = "Profile"
+        with CaptureQueriesContext(connection) as queries:
+            user.save()
+        self.assertEqual(2, len(queries))
+        self.assertIn('SET "name" = ', queries[1]["sql"])
+        self.assertNotIn("is_vip", queries[1]["sql"])
+        with self.assertNumQueries(0):
+            user.profile.save_changes()
+        self.assertEqual("Profile", Profile.objects.get(user=user).name)
+
+    def test_completion_blobs(self):
+        user = User.objects.create_user(username="blobs@mail.com")
+        answer = "An answer long enough to be worth compressing. " * 10
+
+        def complete(q):
+            return Completion.objects.create(
+                user=user,
+                model="dict.1",
+                prompt={"q": q},
+                completion=answer,
+                finish_reason="stop",
+                prompt_usage=1,
+                completion_usage=1,
+                total_usage=2,
+            )
+
+        first, second = complete("word"), complete("another word")
+        db = routers.shard_for(user.pk)
+        # the same answer is stored once, compressed
+        self.assertEqual(3, Blob.objects.using(db).count())
+        blob = Blob.objects.using(db).get(pk=first.completion_digest)
+        self.assertLess(len(blob.data), blob.size)
+
+        completions = list(Completion.objects.for_user(user.pk).order_by("pk"))
+        with self.assertNumQueries(1, using=db):
+            Completion.load_bodies(completions)
+            self.assertEqual({"q": "word"}, completions[0].prompt)
+            self.assertEqual(answer, completions[1].completion)
+        self.assertEqual(second.prompt, completions[1].prompt)
+
     def test_redeemcode(self):
         code = RedeemCode.objects.generate_new_code(50).code
         redeemcode = RedeemCode.objects.get(code=code)
@@ -96,6 +915,140 @@ class ModelTests(TestCase):
         self.assertIsNotNone(redeemcode.created_at)
         self.assertIsNone(redeemcode.redeemed_at)
 
+    def test_bulk_generate_redeemcodes(self):
+        batch = RedeemCode.objects.bulk_generate(20, 25, chunk_size=10)
+        codes = RedeemCode.objects.filter(batch=batch)
+        self.assertEqual(25, codes.count())
+        self.assertEqual(25, len(set(codes.values_list("code", flat=True))))
+        self.assertEqual({20}, set(codes.values_list("amount", flat=True)))
+
+        lines = list(iter_redeem_codes_csv(codes, chunk_size=7))
+        self.assertEqual(26, len(lines))
+        self.assertTrue(lines[0].startswith("code,amount,batch,created_at"))
+        self.assertRegexpMatches(lines[1], r"^[A-Z0-9]{40},20,%s," % batch)
+
+    def test_generate_redeem_codes_command(self):
+        fd, path = tempfile.mkstemp(suffix=".csv")
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        call_command(
+            "generate_redeem_codes",
+            "30",
+            "5",
+            "--batch=promo",
+            f"--output={path}",
+            stdout=StringIO(),
+        )
+        self.assertEqual(5, RedeemCode.objects.filter(batch="promo").count())
+        with open(path) as f:
+            self.assertEqual(6, len(f.readlines()))
+
+
+class GiftCampaignTests(TestCase):
+    def setUp(self):
+        self.skye = _create_superuser()
+        self.users = []
+        for i in range(7):
+            user = User.objects.create_user(username=f"user{i}@mail.com")
+            user.profile.inviter = self.users[0] if i > 2 else self.skye
+            user.profile.save()
+            self.users.append(user)
+        User.objects.filter(pk=self.users[-1].pk).update(is_active=False)
+
+    def test_active_users(self):
+        call_command(
+            "run_gift_campaign",
+            "spring",
+            "--target=active_users",
+            "--amount=50",
+            "--chunk-size=3",
+            stdout=StringIO(),
+        )
+        campaign = GiftCampaign.objects.get(name="spring")
+        self.assertEqual(GiftCampaign.STATUS_DONE, campaign.status)
+        self.assertEqual(7, campaign.processed)
+        self.assertEqual(7, Gift.objects.filter(campaign=campaign, amount=50).count())
+        self.assertFalse(Gift.objects.filter(user=self.users[-1]).exists())
+
+    def test_inviters(self):
+        campaign = GiftCampaign.objects.create(
+            name="top", target=GiftCampaign.TARGET_INVITERS, min_invitees=4, amount=9
+        )
+        campaign.run()
+        # skye invited 3 users, the first of them invited 4
+        self.assertEqual(
+            [self.users[0].pk],
+            list(Gift.objects.filter(campaign=campaign).values_list("user", flat=True)),
+        )
+
+    def test_resume_is_idempotent(self):
+        campaign = GiftCampaign.objects.create(
+            name="resume", target=GiftCampaign.TARGET_ACTIVE_USERS, amount=1
+        )
+        # gifts of the first chunk were committed, but its progress was lost
+        first_chunk = list(campaign.target_user_ids()[:3])
+        Gift.objects.bulk_create(
+            [Gift(user_id=i, amount=1, campaign=campaign) for i in first_chunk]
+        )
+        campaign.run(chunk_size=3)
+        self.assertEqual(
+            7, Gift.objects.filter(campaign=campaign).values("user").distinct().count()
+        )
+        self.assertEqual(7, Gift.objects.filter(campaign=campaign).count())
+
+    def test_admin_queues(self):
+        campaign = GiftCampaign.objects.create(
+            name="admin", target=GiftCampaign.TARGET_ACTIVE_USERS, amount=1
+        )
+        self.client.force_login(self.skye)
+        response = self.client.post(
+            "/admin/skye/giftcampaign/",
+            {"action": "run_campaigns", "_selected_action": [campaign.pk]},
+        )
+        self.assertEqual(302, response.status_code)
+        campaign.refresh_from_db()
+        self.assertEqual(GiftCampaign.STATUS_QUEUED, campaign.status)
+        self.assertFalse(Gift.objects.filter(campaign=campaign).exists())
+
+        call_command("run_gift_campaign", "--queued", stdout=StringIO())
+        campaign.refresh_from_db()
+        self.assertEqual(GiftCampaign.STATUS_DONE, campaign.status)
+        self.assertEqual(7, campaign.processed)
+
+    def test_one_run_at_a_time(self):
+        campaign = GiftCampaign.objects.create(
+            name="race", target=GiftCampaign.TARGET_ACTIVE_USERS, amount=1
+        )
+        other = GiftCampaign.objects.get(pk=campaign.pk)
+        self.assertTrue(other.claim())
+        self.assertFalse(campaign.run())
+        self.assertFalse(Gift.objects.filter(campaign=campaign).exists())
+
+        # the other run stalls past its lease, and is taken over
+        with override_settings(GIFT_CAMPAIGN_LEASE=0):
+            self.assertTrue(campaign.run(chunk_size=3))
+            self.assertFalse(other.run(chunk_size=3))
+        campaign.refresh_from_db()
+        self.assertEqual(GiftCampaign.STATUS_DONE, campaign.status)
+        self.assertEqual(7, campaign.processed)
+
+    @override_settings(GIFT_CAMPAIGN_LEASE=0)
+    def test_lost_lease_rolls_back_chunk(self):
+        campaign = GiftCampaign.objects.create(
+            name="lost", target=GiftCampaign.TARGET_ACTIVE_USERS, amount=1
+        )
+        other = GiftCampaign.objects.get(pk=campaign.pk)
+        # another run claims the campaign after the first chunk
+        self.assertFalse(
+            campaign.run(
+                chunk_size=3, progress=lambda c: self.assertTrue(other.claim())
+            )
+        )
+        self.assertTrue(other.run(chunk_size=3))
+        other.refresh_from_db()
+        self.assertEqual(7, other.processed)
+        self.assertEqual(7, Gift.objects.filter(campaign=campaign).count())
+
 
 class MiddlewareTests(TestCase):
     def test_hide_admin_from_non_staff_middleware(self):
@@ -110,9 +1063,343 @@ class MiddlewareTests(TestCase):
         response = self.client.get("/admin/")
         self.assertEqual(response.status_code, 404)
 
+    def test_request_id_middleware(self):
+        response = self.client.get("/csrf", HTTP_X_REQUEST_ID="abc-123")
+        self.assertEqual("abc-123", response["X-Request-ID"])
+        response = self.client.get("/csrf", HTTP_X_REQUEST_ID="<script>")
+        self.assertRegex(response["X-Request-ID"], r"^[0-9a-f]{32}$")
+        # the id doesn't outlive the request
+        self.assertIsNone(log.request_id.get())
+
+
+class LoggingTests(SimpleTestCase):
+    def _record(self, msg="Completion", level=logging.INFO, **data):
+        record = logging.LogRecord("skye", level, __file__, 1, msg, None, None)
+        record.data = data
+        return record
+
+    @override_settings(LOG_MAX_FIELD_LENGTH=5)
+    def test_json_formatter(self):
+        line = json.loads(log.JsonFormatter().format(self._record(prompt="x" * 8)))
+        self.assertEqual("Compl…[5 more]", line["message"])
+        self.assertEqual("xxxxx…[3 more]", line["prompt"])
+
+    def test_rate_limit_filter(self):
+        f = log.RateLimitFilter(rate=0, burst=2)
+        self.assertTrue(f.filter(self._record(level=logging.INFO)))
+        errors = [self._record("Failed", logging.ERROR) for _ in range(4)]
+        self.assertEqual([True, True, False, False], [f.filter(r) for r in errors])
+        self.assertTrue(f.filter(self._record("Other failure", logging.ERROR)))
+
+        f.rate = 1000
+        time.sleep(0.01)
+        record = self._record("Failed", logging.ERROR)
+        self.assertTrue(f.filter(record))
+        self.assertEqual(2, record.suppressed)
+
+    def test_async_handler(self):
+        written = []
+        writing = threading.Event()
+        unblocked = threading.Event()
+
+        class Stream:
+            def write(self, s):
+                writing.set()
+                unblocked.wait(5)
+                written.append(s)
+
+            def flush(self):
+                pass
+
+        handler = log.AsyncHandler(Stream(), capacity=2)
+        token = log.request_id.set("abc")
+        self.addCleanup(log.request_id.reset, token)
+        handler.handle(self._record())
+        writing.wait(5)
+        for _ in range(4):
+            handler.handle(self._record())
+        # the writer is stuck on the first record, the queue holds two more
+        self.assertEqual(2, handler.dropped)
+        self.assertGreaterEqual(log.metrics()["dropped"], 2)
+        unblocked.set()
+        handler.close()
+        self.assertEqual(3, len([s for s in written if s.strip()]))
+        self.assertEqual("abc", json.loads(written[0])["request_id"])
+
+    @skipUnless(hasattr(os, "fork"), "needs fork")
+    def test_async_handler_in_forked_process(self):
+        path = os.path.join(tempfile.mkdtemp(), "log.jsonl")
+        stream = open(path, "a")
+        self.addCleanup(stream.close)
+        handler = log.AsyncHandler(stream)
+        self.addCleanup(handler.close)
+
+        def child():
+            handler.handle(self._record("In the child"))
+            handler.close()
+            stream.flush()
+
+        process = multiprocessing.get_context("fork").Process(target=child)
+        process.start()
+        process.join(10)
+        self.assertEqual(0, process.exitcode)
+        with open(path) as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual(["In the child"], [line["message"] for line in lines])
+
+
+class AdminTests(TestCase):
+    databases = "__all__"
+
+    CHANGELISTS = (
+        "/admin/auth/user/",
+        "/admin/skye/profile/",
+        "/admin/skye/redeemcode/",
+        "/admin/skye/completion/",
+    )
+
+    def setUp(self):
+        self.client.force_login(_create_superuser())
+
+    def _add_rows(self, n):
+        start = User.objects.count()
+        for i in range(start, start + n):
+            user = User.objects.create_user(username=f"user{i}@mail.com")
+            RedeemCode.objects.generate_new_code(100)
+            Completion.objects.create(
+                user=user,
+                model="GPT",
+                prompt={},
+                completion="",
+                finish_reason="stop",
+                prompt_usage=1,
+                completion_usage=1,
+                total_usage=2,
+            )
+
+    def _count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(200, response.status_code)
+        return len(queries)
+
+    def test_changelist_queries_dont_grow_with_rows(self):
+        self._add_rows(3)
+        small = {url: self._count_queries(url) for url in self.CHANGELISTS}
+        self._add_rows(30)
+        for url in self.CHANGELISTS:
+            self.assertLessEqual(self._count_queries(url), small[url], url)
+
+    def test_completion_cursor(self):
+        self._add_rows(3)
+        user = User.objects.order_by("pk").last()
+        params = {"id__lt": Completion.objects.for_user(user.pk).get().pk + 1}
+        params["q"] = user.pk
+        if settings.COMPLETION_SHARDS:
+            params["shard"] = routers.shard_for(user.pk)
+        response = self.client.get("/admin/skye/completion/", params)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(1, len(response.context["cl"].result_list))
+
+    def test_cursor_pages_are_estimated(self):
+        is_unfiltered = admin.EstimatedCountPaginator.is_unfiltered
+        self.assertTrue(is_unfiltered(Completion.objects.all()))
+        self.assertTrue(is_unfiltered(Completion.objects.filter(id__lt=10)))
+        self.assertFalse(is_unfiltered(Completion.objects.filter(user_id=1)))
+        self.assertFalse(is_unfiltered(Completion.objects.filter(total_usage__lt=10)))
+        self.assertFalse(is_unfiltered(Completion.objects.filter(id__lt=10, user_id=1)))
+
+
+@override_settings(
+    CACHES={
+        "default": {
+            "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+            "LOCATION": tempfile.mkdtemp(),
+        }
+    }
+)
+class QueryBudgetTests(TestCase):
+    """Every URL of skye.urls is requested by a user with a small and with a
+    large history, and must stay within its budget of queries, which must
+    not grow with the history. Caches, shared by the processes as in
+    production, are cleared before each request, so that the budgets hold
+    cold.
+    The requests over their budget of milliseconds are only reported, unless
+    QUERY_BUDGET_CHECK_TIMES is set; slow machines can scale the time budgets
+    with QUERY_BUDGET_TIME_SCALE."""
+
+    databases = "__all__"
+
+    SMALL, LARGE = 2, 200
+    CHECK_TIMES = bool(os.environ.get("QUERY_BUDGET_CHECK_TIMES"))
+    TIME_SCALE = float(os.environ.get("QUERY_BUDGET_TIME_SCALE", 1))
+    # route: (queries, milliseconds), both on all the databases
+    BUDGETS = {
+        "csrf": (1, 50),
+        "register": (7, 1000),
+        "login": (6, 1000),
+        "logout": (4, 50),
+        "user": (3, 50),
+        "ask": (19, 300),
+        "jobs/<int:pk>": (3, 100),
+        "jobs/<int:pk>/cancel": (5, 100),
+        "invitation-code": (3, 100),
+        "invitees": (3, 100),
+        "invitees/tree": (6, 100),
+        "redeem": (8, 200),
+        "balance": (5, 100),
+        "redeemcodes": (3, 100),
+        "gifts": (3, 100),
+        "completions": (4, 100),
+        "completions/<int:pk>": (4, 100),
+        "metrics": (2, 100),
+    }
+    # routes looking the shard of the user up, once more when sharded
+    SHARD_LOOKUPS = {"ask", "balance", "completions", "completions/<int:pk>"}
+
+    def setUp(self):
+        self.superuser = _create_superuser()
+        self.superuser.profile.is_vip = True
+        self.superuser.save()
+        self.users = 0
+
+    def _create_user(self):
+        self.users += 1
+        email = f"user{self.users}@mail.com"
+        return User.objects.create_user(username=email, email=email)
+
+    def _add_history(self, n):
+        """``n`` more of everything the endpoints of the superuser list."""
+        for _ in range(n):
+            invitee = self._create_user()
+            invitee.profile.set_inviter(self.superuser.profile)
+            invitee.save()
+            Gift.objects.create(user=self.superuser, amount=1000)
+            RedeemCode.objects.filter(
+                pk=RedeemCode.objects.generate_new_code(100).pk
+            ).update(redeemer=self.superuser, redeemed_at=timezone.now())
+            Completion.objects.create(
+                user=self.superuser,
+                model="dict.1",
+                prompt={"q": "serendipity"},
+                completion="A happy accident.",
+                finish_reason="stop",
+                prompt_usage=1,
+                completion_usage=1,
+                total_usage=2,
+            )
+            CompletionJob.objects.create(
+                user=self.superuser,
+                model="dict",
+                prompts={"q": "serendipity"},
+                status=CompletionJob.STATUS_DONE,
+            )
+
+    def _request(self, route):
+        """The method, path and JSON body of a request of ``route``."""
+        if route == "register":
+            email = f"user{self.users + 1}@mail.com"
+            self.users += 1
+            body = {
+                "name": "New",
+                "email": email,
+                "password": "secret",
+                "invitation_code": self.superuser.profile.invitation_code,
+            }
+            return "post", "/register", body
+        if route == "login":
+            body = {"email": self.superuser.email, "password": "secret"}
+            return "post", "/login", body
+        if route == "ask":
+            body = {"model": "dict", "prompts": {"q": "hi"}, "params": {"lang": "en"}}
+            return "post", "/ask", body
+        if route == "jobs/<int:pk>":
+            job = CompletionJob.objects.filter(user=self.superuser).last()
+            return "get", f"/jobs/{job.pk}", None
+        if route == "jobs/<int:pk>/cancel":
+            job = CompletionJob.objects.create(
+                user=self.superuser, model="dict", prompts={"q": "hi"}
+            )
+            return "post", f"/jobs/{job.pk}/cancel", None
+        if route == "redeem":
+            code = RedeemCode.objects.generate_new_code(1000)
+            return "post", "/redeem", {"code": code.code}
+        if route == "completions/<int:pk>":
+            completion = Completion.objects.for_user(self.superuser.pk).last()
+            return "get", f"/completions/{completion.pk}", None
+        if route == "logout":
+            return "post", "/logout", None
+        return "get", "/" + route, None
+
+    def _measure(self, route):
+        method, path, body = self._request(route)
+        self.client.force_login(self.superuser)
+        cache.clear()
+        with ExitStack() as stack:
+            captured = [
+                stack.enter_context(CaptureQueriesContext(connections[alias]))
+                for alias in connections
+            ]
+            started = time.perf_counter()
+            if body is None:
+                response = getattr(self.client, method)(path)
+            else:
+                response = getattr(self.client, method)(
+                    path, body, content_type="application/json"
+                )
+            elapsed = (time.perf_counter() - started) * 1000
+        self.assertLess(response.status_code, 400, f"{method.upper()} {path}")
+        queries = [q["sql"] for c in captured for q in c.captured_queries]
+        return queries, elapsed
+
+    @staticmethod
+    def _listing(queries):
+        return "\n".join(f"  {i}. {sql}" for i, sql in enumerate(queries, 1))
+
+    def test_every_url_has_a_budget(self):
+        routes = {str(p.pattern) for p in urls.urlpatterns}
+        self.assertEqual(set(self.BUDGETS), routes)
+
+    @mock.patch.object(gpt.GPT, "TESTING", True)
+    def test_budgets(self):
+        self._add_history(self.SMALL)
+        small = {route: self._measure(route) for route in self.BUDGETS}
+        self._add_history(self.LARGE - self.SMALL)
+        large = {route: self._measure(route) for route in self.BUDGETS}
+
+        for route, (max_queries, max_ms) in self.BUDGETS.items():
+            if settings.COMPLETION_SHARDS and route in self.SHARD_LOOKUPS:
+                max_queries += 1
+            with self.subTest(route=route):
+                queries, elapsed = large[route]
+                self.assertLessEqual(
+                    len(queries),
+                    max_queries,
+                    f"/{route} issued {len(queries)} queries, "
+                    f"over its budget of {max_queries}:\n{self._listing(queries)}",
+                )
+                self.assertEqual(
+                    len(small[route][0]),
+                    len(queries),
+                    f"/{route} issued {len(small[route][0])} queries with a "
+                    f"history of {self.SMALL} and {len(queries)} with one of "
+                    f"{self.LARGE}:\n{self._listing(queries)}",
+                )
+                max_ms *= self.TIME_SCALE
+                message = (
+                    f"/{route} took {elapsed:.0f}ms, over its budget of {max_ms:.0f}ms"
+                )
+                if self.CHECK_TIMES:
+                    self.assertLessEqual(elapsed, max_ms, message)
+                elif elapsed > max_ms:
+                    sys.stderr.write(f"\n{message}")
+
 
 class ApiTests(TestCase):
+    databases = "__all__"
+
     def setUp(self):
+        cache.clear()
         self.superuser = _create_superuser()
 
     @override_settings(GIFT_AMOUNT=5000)
@@ -164,6 +1451,15 @@ class ApiTests(TestCase):
         self.assertEqual(sum_gifted("sh.skyeharris@gmail.com"), 10000)
         self.assertEqual(sum_gifted("friend@mail.com"), 10000)
 
+        # the profile is inserted as invited
+        friend = User.objects.get(email="friend@mail.com")
+        self.assertEqual("friend", friend.profile.name)
+        self.assertEqual(self.superuser.pk, friend.profile.inviter_id)
+        self.assertEqual(
+            f"/{self.superuser.pk}/{friend.pk}/", friend.profile.invitation_path
+        )
+        self.assertEqual(1, friend.profile.invitation_depth)
+
         # test duplicate registering
         response = self.client.post(
             "/register",
@@ -220,6 +1516,55 @@ class ApiTests(TestCase):
         )
         self.assertEqual(200, response.status_code)
 
+    @override_settings(PASSWORD_HASH_PROCESSES=0)
+    def test_login_rehashes_password(self):
+        def login():
+            return self.client.post(
+                "/login",
+                {"email": "sh.skyeharris@gmail.com", "password": "secret"},
+                content_type="application/json",
+            )
+
+        with override_settings(PASSWORD_HASH_ITERATIONS=1000):
+            self.assertEqual(200, login().status_code)
+            self.superuser.refresh_from_db()
+            self.assertTrue(self.superuser.password.startswith("pbkdf2_sha256$1000$"))
+            self.assertEqual(200, login().status_code)
+
+        # and back, and from another hasher
+        self.assertEqual(200, login().status_code)
+        self.superuser.refresh_from_db()
+        self.assertTrue(self.superuser.password.startswith("pbkdf2_sha256$260000$"))
+        self.superuser.password = make_password("secret", hasher="pbkdf2_sha1")
+        self.superuser.save()
+        self.assertEqual(200, login().status_code)
+        self.superuser.refresh_from_db()
+        self.assertTrue(self.superuser.password.startswith("pbkdf2_sha256$"))
+
+    def test_login_overloaded(self):
+        with override_settings(PASSWORD_HASH_QUEUE_LIMIT=0):
+            response = self.client.post(
+                "/login",
+                {"email": "sh.skyeharris@gmail.com", "password": "secret"},
+                content_type="application/json",
+            )
+            self.assertEqual(503, response.status_code)
+            self.assertEqual("overloaded", response.json()["error"])
+            self.assertEqual("1", response["Retry-After"])
+
+            response = self.client.post(
+                "/register",
+                {
+                    "name": "friend",
+                    "email": "friend@mail.com",
+                    "password": "secret",
+                    "invitation_code": "XXXX-XXXX-XXXX-XXXX",
+                },
+                content_type="application/json",
+            )
+            self.assertEqual(503, response.status_code)
+            self.assertFalse(User.objects.filter(email="friend@mail.com").exists())
+
     def test_logout(self):
         self._login_skye()
         response = self.client.post("/logout")
@@ -276,6 +1621,262 @@ class ApiTests(TestCase):
         # )
         # self.assertEqual(response.status_code, 200)
 
+    @mock.patch.object(gpt.GPT, "TESTING", True)
+    def test_ask_settles_balance_hold(self):
+        self._login_skye()
+        ask = {"model": "dict", "prompts": {"q": "hi"}, "params": {"lang": "en"}}
+
+        response = self.client.post("/ask", ask, content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["data"]["completion"], "Hi!")
+        self.assertFalse(BalanceHold.objects.exists())
+        completion = Completion.objects.for_user(self.superuser.pk).get()
+        self.assertEqual(100, completion.total_usage)
+        self.assertEqual("text-davinci-003", completion.upstream_model)
+
+        # the balance is overdrawn now
+        response = self.client.post("/ask", ask, content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["error"], "insufficient_balance")
+
+        # stale holds don't count against the balance
+        Gift.objects.create(user=self.superuser, amount=100)
+        BalanceHold.objects.create(
+            user=self.superuser,
+            amount=4096,
+            expires_at=timezone.now() - timedelta(seconds=1),
+        )
+        response = self.client.post("/ask", ask, content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(BalanceHold.objects.exists())
+
+    @mock.patch.object(gpt.GPT, "TESTING", True)
+    def test_ask_async(self):
+        self._login_skye()
+        Gift.objects.create(user=self.superuser, amount=10000)
+        data = {
+            "model": "dict",
+            "prompts": {"q": "hi"},
+            "params": {"lang": "en"},
+            "async": True,
+        }
+
+        def ask():
+            return self.client.post("/ask", data, content_type="application/json")
+
+        response = ask()
+        self.assertEqual(202, response.status_code)
+        job = response.json()["data"]
+        self.assertEqual("queued", job["status"])
+        self.assertEqual(f"/jobs/{job['id']}", response["Location"])
+        self.assertTrue(BalanceHold.objects.exists())
+
+        # polls wait up to ?wait seconds for the job
+        response = self.client.get(f"/jobs/{job['id']}", {"wait": "0.1"})
+        self.assertEqual("queued", response.json()["data"]["status"])
+        response = self.client.get(f"/jobs/{job['id']}", {"wait": "soon"})
+        self.assertEqual(400, response.status_code)
+        self.assertEqual(404, self.client.get("/jobs/0").status_code)
+
+        call_command("run_completion_workers", processes=1, burst=True)
+        response = self.client.get(f"/jobs/{job['id']}", {"wait": "10"})
+        self.assertEqual("done", response.json()["data"]["status"])
+        self.assertEqual("Hi!", response.json()["data"]["completion"])
+        self.assertEqual(1, Completion.objects.for_user(self.superuser.pk).count())
+        self.assertFalse(BalanceHold.objects.exists())
+
+        # cancelling a queued job releases its hold
+        job = ask().json()["data"]
+        response = self.client.post(f"/jobs/{job['id']}/cancel")
+        self.assertEqual("cancelled", response.json()["data"]["status"])
+        self.assertFalse(BalanceHold.objects.exists())
+        response = self.client.post(f"/jobs/{job['id']}/cancel")
+        self.assertEqual(409, response.status_code)
+
+        # a running job is billed anyway
+        job = ask().json()["data"]
+        claimed = jobs.claim("test")
+        self.assertEqual(job["id"], claimed.pk)
+        self.assertIsNone(jobs.claim("test"))
+        self.assertEqual(200, self.client.post(f"/jobs/{job['id']}/cancel").status_code)
+        jobs.run(claimed)
+        self.assertEqual("cancelled", CompletionJob.objects.get(pk=job["id"]).status)
+        self.assertEqual(2, Completion.objects.for_user(self.superuser.pk).count())
+        self.assertFalse(BalanceHold.objects.exists())
+
+        # backpressure
+        job = ask().json()["data"]
+        with override_settings(JOB_USER_LIMIT=1):
+            response = ask()
+            self.assertEqual(429, response.status_code)
+            self.assertEqual("too_many_jobs", response.json()["error"])
+        with override_settings(JOB_QUEUE_LIMIT=1):
+            response = ask()
+            self.assertEqual(503, response.status_code)
+            self.assertTrue(response.has_header("Retry-After"))
+        data["long"] = True
+        self.assertEqual(400, ask().status_code)
+
+        # stale jobs fail and release their holds
+        CompletionJob.objects.filter(pk=job["id"]).update(
+            created_at=timezone.now() - timedelta(days=1)
+        )
+        jobs.reap()
+        job = CompletionJob.objects.get(pk=job["id"])
+        self.assertEqual(("failed", "expired"), (job.status, job.error))
+        self.assertFalse(BalanceHold.objects.exists())
+
+        # a job failed meanwhile is not billed when its worker is done
+        del data["long"]
+        job = ask().json()["data"]
+        claimed = jobs.claim("test")
+        CompletionJob.objects.filter(pk=job["id"]).update(
+            started_at=timezone.now() - timedelta(days=1)
+        )
+        jobs.reap()
+        jobs.run(claimed)
+        job = CompletionJob.objects.get(pk=job["id"])
+        self.assertEqual(("failed", "worker_lost"), (job.status, job.error))
+        self.assertEqual(2, Completion.objects.for_user(self.superuser.pk).count())
+        self.assertFalse(BalanceHold.objects.exists())
+
+    @mock.patch.object(gpt.GPT, "TESTING", True)
+    def test_ask_rejects_bad_requests(self):
+        self._login_skye()
+
+        def ask(body, **kwargs):
+            return self.client.post(
+                "/ask", body, content_type="application/json", **kwargs
+            )
+
+        response = ask("{not json")
+        self.assertEqual(400, response.status_code)
+        self.assertEqual("body must be JSON", response.json()["detail"])
+        response = ask({"prompts": {"q": "hi"}})
+        self.assertEqual("model is required", response.json()["detail"])
+        response = ask({"model": "dict", "prompts": {"q": "hi"}, "params": {}})
+        self.assertEqual("params.lang is required", response.json()["detail"])
+        response = ask({"model": "dict", "prompts": {}, "params": {"lang": "en"}})
+        self.assertEqual("prompts.q is required", response.json()["detail"])
+        response = ask(
+            {
+                "model": "thesis_outline_assistant",
+                "prompts": {"level": "h3", "content": "hi"},
+                "params": {"mode": "accurate"},
+            }
+        )
+        self.assertEqual(400, response.status_code)
+        self.assertEqual(
+            "prompts.level must be one of title, h1, h2", response.json()["detail"]
+        )
+        self.assertFalse(BalanceHold.objects.exists())
+        self.assertFalse(Completion.objects.for_user(self.superuser.pk).exists())
+
+    @override_settings(GPT_CHUNK_TOKENS=60, GPT_CHUNK_CONCURRENCY=2)
+    @mock.patch.object(gpt.GPT, "TESTING", True)
+    def test_ask_long(self):
+        self._login_skye()
+        Gift.objects.create(user=self.superuser, amount=4096 * 2 + 500)
+        paragraphs = [f"Paragraph number {i}." for i in range(5)]
+        ask = {
+            "model": "expansion",
+            "prompts": {"prompt": "\n\n".join(paragraphs)},
+            "params": {"mode": "accurate"},
+            "long": True,
+        }
+
+        # two chunks have to be in flight at once to pass the barrier
+        barrier = threading.Barrier(2, timeout=5)
+        client = gpt.test_client()
+
+        def request(params):
+            if "number 0" in params["prompt"] or "number 1" in params["prompt"]:
+                barrier.wait()
+            return client(params)
+
+        with mock.patch.object(gpt, "test_client", lambda: request):
+            response = self.client.post("/ask", ask, content_type="application/json")
+            lines = [json.loads(line) for line in response.streaming_content]
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(list(range(5)), [line["index"] for line in lines])
+        self.assertTrue(all(line["completion"] == "Hi!" for line in lines))
+
+        # each chunk is billed, no hold is left behind
+        completions = Completion.objects.for_user(self.superuser.pk).order_by("pk")
+        self.assertEqual(paragraphs, [c.prompt["prompt"] for c in completions])
+        self.assertFalse(BalanceHold.objects.exists())
+
+        # the stream stops once the balance can't hold another chunk
+        Completion.objects.create(
+            user=self.superuser,
+            model="test",
+            prompt={},
+            completion="",
+            finish_reason="stop",
+            prompt_usage=0,
+            completion_usage=0,
+            total_usage=4096 * 2 - 250,
+        )
+        response = self.client.post("/ask", ask, content_type="application/json")
+        lines = [json.loads(line) for line in response.streaming_content]
+        self.assertEqual({"index": 3, "error": "insufficient_balance"}, lines[-1])
+        self.assertEqual(3, len(lines[:-1]))
+        self.assertFalse(BalanceHold.objects.exists())
+
+        # short documents are not chunked
+        ask["model"] = "dict"
+        response = self.client.post("/ask", ask, content_type="application/json")
+        self.assertEqual(400, response.status_code)
+
+    @override_settings(GPT_CHUNK_TOKENS=60, GPT_CHUNK_CONCURRENCY=2)
+    @mock.patch.object(gpt.GPT, "TESTING", True)
+    def test_ask_long_idempotency_key(self):
+        self._login_skye()
+        Gift.objects.create(user=self.superuser, amount=4096 * 5)
+        ask = {
+            "model": "expansion",
+            "prompts": {"prompt": "\n\n".join(f"Paragraph {i}." for i in range(3))},
+            "params": {"mode": "accurate"},
+            "long": True,
+        }
+
+        def post(key):
+            return self.client.post(
+                "/ask", ask, content_type="application/json", HTTP_IDEMPOTENCY_KEY=key
+            )
+
+        # the key is in progress until the whole stream is sent
+        response = post("long")
+        content = iter(response.streaming_content)
+        body = [next(content)]
+        record = IdempotencyKey.objects.get(key="long")
+        self.assertEqual(IdempotencyKey.STATUS_IN_PROGRESS, record.status)
+        body.extend(content)
+        record.refresh_from_db()
+        self.assertEqual(IdempotencyKey.STATUS_DONE, record.status)
+        self.assertEqual(3, Completion.objects.for_user(self.superuser.pk).count())
+
+        # the retry replays the stream instead of completing the chunks again
+        response = post("long")
+        self.assertEqual("true", response["Idempotent-Replayed"])
+        self.assertEqual("application/x-ndjson", response["Content-Type"])
+        self.assertEqual(b"".join(body), response.content)
+        self.assertEqual(3, Completion.objects.for_user(self.superuser.pk).count())
+
+        # a stream broken off releases its key
+        client = gpt.test_client()
+
+        def request(params):
+            if "Paragraph 1" in params["prompt"]:
+                raise openai.error.APIConnectionError("Connection reset")
+            return client(params)
+
+        with mock.patch.object(gpt, "test_client", lambda: request):
+            response = post("broken")
+            with self.assertRaises(openai.error.APIConnectionError):
+                list(response.streaming_content)
+        self.assertFalse(IdempotencyKey.objects.filter(key="broken").exists())
+
     def test_get_invitation_code(self):
         self._login_skye()
 
@@ -289,16 +1890,104 @@ class ApiTests(TestCase):
         self.assertTrue(
             self.client.login(username="friend@mail.com", password="secret")
         )
-        self.assertRegexpMatches(
-            response.json()["data"]["code"], r"(\w{4})-(\w{4})-(\w{4})-(\w{4})"
+        response = self.client.get("/invitation-code")
+        code = response.json()["data"]["code"]
+        self.assertRegexpMatches(code, r"(\w{4})-(\w{4})-(\w{4})-(\w{4})")
+        self.assertEqual(
+            code, Profile.objects.get(user__email="friend@mail.com").invitation_code
         )
 
+        # only the first GET writes
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/invitation-code")
+        self.assertEqual(code, response.json()["data"]["code"])
+        self.assertFalse([q for q in queries if not q["sql"].startswith("SELECT")])
+
     def test_get_invitees(self):
         self._login_skye()
 
         response = self.client.get("/invitees")
         self.assertEqual(200, response.status_code)
 
+    @override_settings(GIFT_AMOUNT=10)
+    def test_get_invitee_tree(self):
+        # skye <- friend <- friend_of_friend
+        for name, code in (("friend", "XXXX-XXXX-XXXX-XXXX"), ("fof", "FRND-XXXX")):
+            if name == "fof":
+                profile = User.objects.get(email="friend@mail.com").profile
+                profile.invitation_code = code
+                profile.save()
+            response = self.client.post(
+                "/register",
+                {
+                    "name": name,
+                    "email": f"{name}@mail.com",
+                    "password": "secret",
+                    "invitation_code": code,
+                },
+                content_type="application/json",
+            )
+            self.assertEqual(200, response.status_code)
+
+        self._login_skye()
+        response = self.client.get("/invitees/tree")
+        self.assertEqual(200, response.status_code)
+        data = response.json()["data"]
+        self.assertDictEqual({"downline": 2, "gifted": 10}, data["stats"])
+        self.assertEqual(
+            [
+                ("friend@mail.com", "sh.skyeharris@gmail.com", 1),
+                ("fof@mail.com", "friend@mail.com", 2),
+            ],
+            [(i["email"], i["inviter"], i["level"]) for i in data["invitees"]],
+        )
+
+        response = self.client.get("/invitees/tree?depth=1")
+        self.assertEqual(1, len(response.json()["data"]["invitees"]))
+
+        # stats are cached, and invalidated when the downline grows
+        with self.assertNumQueries(0):
+            self.superuser.profile.downline_stats()
+        friend = User.objects.get(email="friend@mail.com")
+        fof = User.objects.get(email="fof@mail.com")
+        self.assertEqual([self.superuser.pk, friend.pk], fof.profile.ancestor_ids())
+        Profile.invalidate_downline_stats(fof.profile.ancestor_ids())
+        with self.assertNumQueries(2):
+            self.superuser.profile.downline_stats()
+
+    def test_deep_invitation_chain(self):
+        # as registered, with ids of 10 digits
+        chain = [self.superuser]
+        for i in range(Profile.MAX_PATH_DEPTH + 4):
+            email = f"user{i}@mail.com"
+            user = User(id=2_000_000_000 + i, username=email, email=email)
+            user.profile = Profile.invited_by(chain[-1].profile, name=email)
+            user.save()
+            chain.append(user)
+        profiles = [Profile.objects.get(user=user) for user in chain]
+
+        for depth, profile in enumerate(profiles):
+            self.assertEqual(depth, profile.invitation_depth)
+            self.assertLessEqual(len(profile.invitation_path), 191)
+            self.assertEqual(
+                [user.pk for user in chain[:depth]], profile.ancestor_ids()
+            )
+            self.assertEqual(
+                {user.pk for user in chain[depth + 1 :]},
+                {p.user_id for p in profile.downline()},
+            )
+            self.assertEqual(
+                {user.pk for user in chain[depth + 1 : depth + 3]},
+                {p.user_id for p in profile.downline(max_depth=2)},
+            )
+        # the path stopped growing at MAX_PATH_DEPTH
+        capped = profiles[Profile.MAX_PATH_DEPTH + 1 :]
+        self.assertTrue(all(p.path_is_capped for p in capped))
+        self.assertEqual(
+            {profiles[Profile.MAX_PATH_DEPTH].invitation_path},
+            {p.invitation_path for p in capped},
+        )
+
     def test_redeem(self):
         self._login_skye()
 
@@ -331,6 +2020,76 @@ class ApiTests(TestCase):
         self.assertEqual(400, response.status_code)
         self.assertEqual("code_used", response.json()["error"])
 
+    def test_idempotency_key(self):
+        self._login_skye()
+        code = RedeemCode.objects.generate_new_code(1000).code
+
+        def redeem(code, key):
+            return self.client.post(
+                "/redeem",
+                {"code": code},
+                content_type="application/json",
+                HTTP_IDEMPOTENCY_KEY=key,
+            )
+
+        response = redeem(code, "retried")
+        self.assertEqual(200, response.status_code)
+        self.assertFalse(response.has_header("Idempotent-Replayed"))
+
+        # the retry gets the stored response instead of code_used
+        response = redeem(code, "retried")
+        self.assertEqual(200, response.status_code)
+        self.assertEqual("true", response["Idempotent-Replayed"])
+
+        # a key is not reusable for another request
+        response = redeem("fakecode", "retried")
+        self.assertEqual(422, response.status_code)
+        self.assertEqual("idempotency_key_reused", response.json()["error"])
+
+        # another key is another request
+        response = redeem(code, "another")
+        self.assertEqual("code_used", response.json()["error"])
+        response = redeem(code, "x" * 65)
+        self.assertEqual("bad_request", response.json()["error"])
+
+        # expired keys and abandoned claims are reusable
+        IdempotencyKey.objects.filter(key="retried").update(expires_at=timezone.now())
+        self.assertEqual("code_used", redeem(code, "retried").json()["error"])
+        IdempotencyKey.objects.filter(key="retried").update(
+            status=IdempotencyKey.STATUS_IN_PROGRESS,
+            created_at=timezone.now() - timedelta(days=1),
+        )
+        self.assertEqual(400, redeem(code, "retried").status_code)
+        self.assertEqual(
+            IdempotencyKey.STATUS_DONE, IdempotencyKey.objects.get(key="retried").status
+        )
+
+        IdempotencyKey.objects.update(expires_at=timezone.now())
+        call_command("purge_idempotency_keys", stdout=StringIO())
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+    @override_settings(DATABASE_REPLICAS=["replica0"])
+    def test_read_your_writes(self):
+        pinned = []
+        real = routers.pinned_to_primary
+
+        def pinned_to_primary(pin=True):
+            pinned.append(pin)
+            return real(pin)
+
+        self._login_skye()
+        with mock.patch.object(routers, "pinned_to_primary", pinned_to_primary):
+            self.client.get("/balance")
+            self.client.post("/redeem", {"code": "x"}, content_type="application/json")
+            # marked in a cookie, seen by any process
+            self.assertIn(routers.STICKY_COOKIE, self.client.cookies)
+            self.client.get("/balance")
+
+            # only for the user who wrote
+            self.client.force_login(self._create_friend_user())
+            self.client.get("/balance")
+        self.assertEqual([False, True, True, False], pinned)
+
     def test_get_balance(self):
         self._login_skye()
 
@@ -406,6 +2165,119 @@ class ApiTests(TestCase):
         response = self.client.get("/redeemcodes")
         self.assertEqual(200, response.status_code)
 
+    def test_get_metrics(self):
+        response = self.client.get("/metrics")
+        self.assertEqual(404, response.status_code)
+
+        self._login_skye()
+        response = self.client.get("/metrics")
+        self.assertEqual(200, response.status_code)
+        self.assertIn("fuzzy_cache", response.json()["data"])
+        self.assertIn("upstream", response.json()["data"])
+        self.assertIn("databases", response.json()["data"])
+        self.assertIn("dropped", response.json()["data"]["log"])
+
+    def test_conditional_get(self):
+        self._login_skye()
+
+        def get(url, etag):
+            return self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+        # the version tokens of a process would be stale in the others
+        self.assertFalse(self.client.get("/balance").has_header("ETag"))
+
+        shared = {
+            "default": {
+                "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+                "LOCATION": tempfile.mkdtemp(),
+            }
+        }
+        with override_settings(CACHES=shared):
+            self._check_conditional_get(get)
+
+    def _check_conditional_get(self, get):
+        urls = ("/balance", "/gifts", "/redeemcodes", "/invitees")
+        etags = {url: self.client.get(url)["ETag"] for url in urls}
+        for url in urls:
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(304, get(url, etags[url]).status_code)
+            # only the session and the user are loaded
+            self.assertLessEqual(len(queries), 2, url)
+
+        # gifts change the balance and the gift list only
+        Gift.objects.create(user=self.superuser, amount=100)
+        self.assertEqual(200, get("/balance", etags["/balance"]).status_code)
+        self.assertEqual(200, get("/gifts", etags["/gifts"]).status_code)
+        self.assertEqual(304, get("/redeemcodes", etags["/redeemcodes"]).status_code)
+
+        # redeeming updates the codes without signals
+        code = RedeemCode.objects.generate_new_code(1000)
+        self.assertEqual(304, get("/redeemcodes", etags["/redeemcodes"]).status_code)
+        self.client.post(
+            "/redeem", {"code": code.code}, content_type="application/json"
+        )
+        self.assertEqual(200, get("/redeemcodes", etags["/redeemcodes"]).status_code)
+
+        # somebody else's invitee
+        friend = self._create_friend_user()
+        self.assertEqual(304, get("/invitees", etags["/invitees"]).status_code)
+        friend.profile.set_inviter(self.superuser.profile)
+        friend.profile.save()
+        self.assertEqual(200, get("/invitees", etags["/invitees"]).status_code)
+
+    def test_get_completions(self):
+        self._login_skye()
+        friend = self._create_friend_user()
+
+        def complete(user, q, completion):
+            return Completion.objects.create(
+                user=user,
+                model="dict.1",
+                prompt={"q": q},
+                completion=completion,
+                finish_reason="stop",
+                prompt_usage=1,
+                completion_usage=1,
+                total_usage=2,
+            )
+
+        complete(friend, "serendipity", "Not yours.")
+        ids = [
+            complete(self.superuser, "serendipity", "A happy accident.").pk,
+            complete(self.superuser, "缘分", "人与人之间命中注定的遇合的机会。").pk,
+            complete(self.superuser, "ephemeral", "Lasting a very short time.").pk,
+        ]
+
+        def get(**params):
+            response = self.client.get("/completions", params)
+            self.assertEqual(200, response.status_code)
+            return response.json()
+
+        # newest first, page by page
+        page = get(limit=2)
+        self.assertEqual(ids[:0:-1], [c["id"] for c in page["data"]])
+        page = get(limit=2, before=page["next"])
+        self.assertEqual([ids[0]], [c["id"] for c in page["data"]])
+        self.assertIsNone(page["next"])
+
+        # searched in the full-text index, or with LIKE for short queries
+        page = get(q="SERENDIP")
+        self.assertEqual([ids[0]], [c["id"] for c in page["data"]])
+        self.assertEqual("serendipity", page["data"][0]["snippet"])
+        self.assertEqual([ids[1]], [c["id"] for c in get(q="注定")["data"]])
+        self.assertEqual([ids[2]], [c["id"] for c in get(q="short time")["data"]])
+        self.assertEqual([], get(q="nothing like it")["data"])
+
+        response = self.client.get("/completions", {"before": "x"})
+        self.assertEqual(400, response.status_code)
+
+        response = self.client.get(f"/completions/{ids[2]}")
+        self.assertEqual(
+            "Lasting a very short time.", response.json()["data"]["completion"]
+        )
+        response = self.client.get(f"/completions/{ids[0] - 1}")
+        self.assertEqual(404, response.status_code)
+
     def test_get_gift_list(self):
         self._login_skye()
 
@@ -425,3 +2297,276 @@ class ApiTests(TestCase):
 
     def _login_skye(self):
         self.client.force_login(self._get_skye_user_model())
+
+
+def _run_in_parallel(fn, n):
+    """Call ``fn(i)`` from ``n`` threads started at once and return the results
+    together with the elapsed seconds."""
+    barrier = threading.Barrier(n)
+    results = [None] * n
+
+    def run(i):
+        barrier.wait()
+        try:
+            results[i] = fn(i)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(n)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results, time.perf_counter() - started
+
+
+class ConcurrencyTests(TransactionTestCase):
+    databases = "__all__"
+
+    def test_concurrent_redeem(self):
+        skye = _create_superuser()
+        friends = []
+        for i in range(20):
+            friend = User.objects.create_user(
+                username=f"friend{i}@mail.com", password="secret"
+            )
+            friend.profile.inviter = skye
+            friend.profile.save()
+            friends.append(friend)
+        code = RedeemCode.objects.generate_new_code(1000).code
+
+        n = 200
+        clients = [Client() for _ in range(n)]
+        for i, client in enumerate(clients):
+            client.force_login(friends[i % len(friends)])
+
+        def redeem(i):
+            return (
+                clients[i]
+                .post("/redeem", {"code": code}, content_type="application/json")
+                .status_code
+            )
+
+        results, elapsed = _run_in_parallel(redeem, n)
+        sys.stderr.write(
+            f"\nconcurrent redeem: {n} requests in {elapsed:.2f}s "
+            f"({n / elapsed:.0f} req/s)\n"
+        )
+        self.assertEqual(1, results.count(200))
+        self.assertEqual(n - 1, results.count(400))
+        self.assertEqual(1, Gift.objects.filter(user=skye).count())
+        self.assertEqual(30, Gift.objects.get(user=skye).amount)
+
+    @mock.patch.object(gpt.GPT, "TESTING", True)
+    def test_concurrent_ask_balance_holds(self):
+        skye = _create_superuser()
+        Gift.objects.create(user=skye, amount=100)
+        fast_client = gpt.test_client()
+
+        def slow_client(params):
+            time.sleep(0.2)
+            response = fast_client(params)
+            # overdraw the balance, so no request can start after this one
+            response.usage.total_tokens = 150
+            return response
+
+        n = 20
+        clients = [Client() for _ in range(n)]
+        for client in clients:
+            client.force_login(skye)
+
+        def ask(i):
+            return (
+                clients[i]
+                .post(
+                    "/ask",
+                    {"model": "dict", "prompts": {"q": "hi"}, "params": {"lang": "en"}},
+                    content_type="application/json",
+                )
+                .status_code
+            )
+
+        with mock.patch.object(gpt, "test_client", lambda: slow_client):
+            results, elapsed = _run_in_parallel(ask, n)
+        sys.stderr.write(
+            f"\nconcurrent ask: {n} requests in {elapsed:.2f}s "
+            f"({n / elapsed:.0f} req/s)\n"
+        )
+        self.assertEqual(1, results.count(200))
+        self.assertEqual(n - 1, results.count(400))
+        self.assertEqual(1, Completion.objects.for_user(skye.pk).count())
+        self.assertFalse(BalanceHold.objects.exists())
+
+    @mock.patch.object(gpt.GPT, "TESTING", True)
+    def test_concurrent_duplicate_ask(self):
+        skye = _create_superuser()
+        Gift.objects.create(user=skye, amount=1000)
+        fast_client = gpt.test_client()
+        calls = []
+
+        def slow_client(params):
+            calls.append(params)
+            time.sleep(0.2)
+            return fast_client(params)
+
+        n = 10
+        clients = [Client() for _ in range(n)]
+        for client in clients:
+            client.force_login(skye)
+
+        def ask(i):
+            response = clients[i].post(
+                "/ask",
+                {"model": "dict", "prompts": {"q": "hi"}, "params": {"lang": "en"}},
+                content_type="application/json",
+                HTTP_IDEMPOTENCY_KEY="retried",
+            )
+            return response.status_code, response.content
+
+        with mock.patch.object(gpt, "test_client", lambda: slow_client):
+            results, elapsed = _run_in_parallel(ask, n)
+        sys.stderr.write(
+            f"\nconcurrent duplicate ask: {n} requests in {elapsed:.2f}s\n"
+        )
+        # the retries waited for the first request and got its response
+        self.assertEqual(1, len(calls))
+        self.assertEqual(1, len(set(results)))
+        self.assertEqual(200, results[0][0])
+        self.assertEqual(1, Completion.objects.for_user(skye.pk).count())
+
+    @override_settings(PASSWORD_HASH_PROCESSES=2, PASSWORD_HASH_QUEUE_LIMIT=4)
+    def test_login_burst(self):
+        """A burst of logins is shed beyond the pool, which keeps hashing off
+        the request threads: cheap requests go on meanwhile."""
+        _create_superuser()
+        # spawn the pool first, not to time it
+        self.assertTrue(passwords.make_password("warm up"))
+
+        n = 24
+        clients = [Client() for _ in range(n)]
+
+        def login(i):
+            if i % 4 == 0:
+                started = time.perf_counter()
+                clients[i].get("/csrf")
+                return time.perf_counter() - started
+            return (
+                clients[i]
+                .post(
+                    "/login",
+                    {"email": "sh.skyeharris@gmail.com", "password": "secret"},
+                    content_type="application/json",
+                )
+                .status_code
+            )
+
+        results, elapsed = _run_in_parallel(login, n)
+        statuses = [r for i, r in enumerate(results) if i % 4]
+        latencies = [r for i, r in enumerate(results) if i % 4 == 0]
+        sys.stderr.write(
+            f"\nlogin burst: {len(statuses)} logins in {elapsed:.2f}s, "
+            f"{statuses.count(200)} ok, {statuses.count(503)} shed, "
+            f"/csrf meanwhile in at most {max(latencies) * 1000:.0f}ms\n"
+        )
+        self.assertEqual(len(statuses), statuses.count(200) + statuses.count(503))
+        self.assertGreaterEqual(statuses.count(200), 1)
+        self.assertGreaterEqual(statuses.count(503), 1)
+
+    @mock.patch.object(gpt.GPT, "TESTING", True)
+    def test_concurrent_job_workers(self):
+        skye = _create_superuser()
+        Gift.objects.create(user=skye, amount=100000)
+        data = {"model": "dict", "prompts": {"q": "hi"}, "params": {"lang": "en"}}
+        queued = [jobs.enqueue(skye, data).pk for _ in range(20)]
+        stop = threading.Event()
+
+        n = 4
+        results, elapsed = _run_in_parallel(
+            lambda i: jobs.work(f"worker{i}", stop, burst=True), n
+        )
+        sys.stderr.write(
+            f"\nconcurrent job workers: {len(queued)} jobs in {elapsed:.2f}s\n"
+        )
+        # every job ran exactly once
+        self.assertEqual(
+            {"done"},
+            set(CompletionJob.objects.values_list("status", flat=True)),
+        )
+        self.assertEqual(len(queued), Completion.objects.for_user(skye.pk).count())
+        self.assertFalse(BalanceHold.objects.exists())
+
+
+class TrafficCaptureTests(LiveServerTestCase):
+    databases = "__all__"
+
+    def test_filler_is_varied(self):
+        rng = random.Random(0)
+        texts = [replay_traffic._fill({"q": 200}, rng)["q"] for _ in range(20)]
+        self.assertEqual({200}, {len(text) for text in texts})
+        fuzzy_cache.reset()
+        self.addCleanup(fuzzy_cache.reset)
+        for text in texts:
+            self.assertIsNone(fuzzy_cache.get("replay", text))
+            fuzzy_cache.put(
+                "replay",
+                text,
+                {
+                    "completion": "",
+                    "finish_reason": "stop",
+                    "prompt_token_usage": 1,
+                    "completion_token_usage": 1,
+                    "total_token_usage": 2,
+                },
+            )
+        # and the same for the same seed
+        self.assertEqual(
+            texts[0], replay_traffic._fill({"q": 200}, random.Random(0))["q"]
+        )
+
+    @mock.patch.object(gpt.GPT, "TESTING", True)
+    def test_capture_and_replay(self):
+        path = os.path.join(tempfile.mkdtemp(), "capture.jsonl")
+        user = _create_superuser()
+        Gift.objects.create(user=user, amount=10000)
+        ask = {
+            "model": "dict",
+            "prompts": {"q": "secret words"},
+            "params": {"lang": "en"},
+        }
+        with override_settings(TRAFFIC_CAPTURE_PATH=path):
+            client = Client()
+            client.force_login(user)
+            client.post("/ask", ask, content_type="application/json")
+            client.post(
+                "/ask", dict(ask, **{"async": True}), content_type="application/json"
+            )
+            client.get("/balance")
+            client.get("/completions", {"q": "secret", "limit": "5"})
+            client.get("/admin/")
+        capture.writer(path).flush()
+
+        with open(path) as f:
+            self.assertNotIn("secret", f.read())
+        records = list(capture.read(path))
+        self.assertEqual(
+            ["ask", "ask", "balance", "completions"], [r["route"] for r in records]
+        )
+        self.assertEqual(
+            {"model": "dict", "prompts": {"q": 12}, "params": {"lang": "en"}},
+            records[0]["body"],
+        )
+        self.assertEqual({"q": 6, "limit": "5"}, records[3]["query"])
+        self.assertEqual(202, records[1]["status"])
+        self.assertNotEqual(str(user.pk), records[0]["user"])
+        self.assertEqual(1, len({r["user"] for r in records}))
+
+        out = StringIO()
+        call_command(
+            "replay_traffic", path, url=self.live_server_url, speed=100, stdout=out
+        )
+        report = out.getvalue()
+        self.assertIn("POST /ask: 2 requests", report)
+        self.assertIn("GET /completions: 1 requests", report)
+        self.assertNotIn(" 1 errors", report)
+        self.assertEqual(2, CompletionJob.objects.count())
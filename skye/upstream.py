@@ -0,0 +1,249 @@
+"""Pool of the upstream credentials, see OPENAI_KEYS.
+
+Each credential tracks the quota left to it from the x-ratelimit headers of
+its responses, refilling linearly until the reset they announce. Requests go
+to a credential picked at random, weighted by its weight and its headroom,
+the smaller share of its request and token quota left, so the tokens per
+minute spread over the keys by what they can still take. A credential
+answering 429 is ejected until its quota resets, and the request is retried
+on the others. A connection error ejects a credential for a while too, unless
+it is the last one available: a blip of a single key would otherwise fail
+every request until it is back.
+"""
+import logging
+import random
+import re
+import threading
+import time
+
+import openai
+from django.conf import settings
+from openai import api_requestor, util
+
+logger = logging.getLogger(__name__)
+
+_DURATION = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+KINDS = ("requests", "tokens")
+
+
+def parse_duration(value):
+    """Seconds of a reset header like "6m0s" or "20ms", None if missing."""
+    if not value:
+        return None
+    matches = _DURATION.findall(value)
+    if not matches:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(n) * _UNITS[unit] for n, unit in matches)
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class Credential:
+    def __init__(self, key, weight=1.0, api_base=None):
+        self.key = key
+        self.weight = weight
+        self.api_base = api_base
+        self.limit = dict.fromkeys(KINDS)
+        self.remaining = dict.fromkeys(KINDS)
+        self.reset = dict.fromkeys(KINDS)
+        self.observed_at = 0.0
+        self.in_flight = dict.fromkeys(KINDS, 0)
+        self.ejected_until = 0.0
+        self.requests = 0
+        self.rate_limited = 0
+
+    @property
+    def name(self):
+        return f"...{self.key[-4:]}"
+
+    def left(self, kind, now):
+        """The quota of ``kind`` left to this credential, None if unknown."""
+        limit, remaining = self.limit[kind], self.remaining[kind]
+        if limit is None or remaining is None:
+            return None
+        reset = self.reset[kind]
+        if not reset:
+            refilled = limit
+        else:
+            elapsed = min(1.0, (now - self.observed_at) / reset)
+            refilled = remaining + (limit - remaining) * elapsed
+        return refilled - self.in_flight[kind]
+
+    def headroom(self, now):
+        """The share of the quota left, from 0 to 1, 1 while unknown."""
+        shares = [1.0]
+        for kind in KINDS:
+            left = self.left(kind, now)
+            if left is not None and self.limit[kind]:
+                shares.append(max(0.0, left / self.limit[kind]))
+        return min(shares)
+
+    def observe(self, headers, now):
+        for kind in KINDS:
+            limit = _int(headers.get(f"x-ratelimit-limit-{kind}"))
+            remaining = _int(headers.get(f"x-ratelimit-remaining-{kind}"))
+            if limit is not None and remaining is not None:
+                self.limit[kind] = limit
+                self.remaining[kind] = remaining
+                self.reset[kind] = parse_duration(
+                    headers.get(f"x-ratelimit-reset-{kind}")
+                )
+        self.observed_at = now
+
+    def retry_after(self, headers):
+        """Seconds until the quota this credential ran out of resets."""
+        seconds = parse_duration(headers.get("retry-after"))
+        if seconds is None:
+            resets = [
+                parse_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+                for kind in KINDS
+                if headers.get(f"x-ratelimit-remaining-{kind}") == "0"
+            ]
+            seconds = max([s for s in resets if s is not None], default=None)
+        return seconds if seconds is not None else settings.UPSTREAM_EJECT_SECONDS
+
+    def as_dict(self, now):
+        return {
+            "name": self.name,
+            "weight": self.weight,
+            "ejected": self.ejected_until > now,
+            "headroom": round(self.headroom(now), 3),
+            "requests": self.requests,
+            "rate_limited": self.rate_limited,
+        }
+
+
+class CredentialPool:
+    def __init__(self, credentials):
+        self.credentials = credentials
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens, exclude=()):
+        """A credential to send a request of ``tokens`` with, None if they
+        are all ejected or excluded."""
+        with self._lock:
+            now = time.monotonic()
+            candidates = [
+                c
+                for c in self.credentials
+                if c.ejected_until <= now and c not in exclude
+            ]
+            if not candidates:
+                return None
+            weights = [c.weight * c.headroom(now) for c in candidates]
+            if not any(weights):
+                # drained by our estimates, upstream has the last word
+                weights = [c.weight for c in candidates]
+            credential = random.choices(candidates, weights)[0]
+            credential.in_flight["requests"] += 1
+            credential.in_flight["tokens"] += tokens
+            credential.requests += 1
+            return credential
+
+    def release(self, credential, tokens, headers=None):
+        with self._lock:
+            credential.in_flight["requests"] -= 1
+            credential.in_flight["tokens"] -= tokens
+            if headers:
+                credential.observe(headers, time.monotonic())
+
+    def eject(self, credential, seconds, keep_last=False):
+        """Take ``credential`` out of the pool for ``seconds``. With
+        ``keep_last``, only if another credential is still available, returns
+        whether it was ejected."""
+        with self._lock:
+            now = time.monotonic()
+            if keep_last and not any(
+                c.ejected_until <= now for c in self.credentials if c is not credential
+            ):
+                return False
+            credential.ejected_until = now + seconds
+            credential.rate_limited += 1
+        logger.warning(
+            "Upstream credential ejected",
+            extra={"data": {"credential": credential.name, "seconds": seconds}},
+        )
+        return True
+
+    def complete(self, params: dict, tokens: int):
+        """Send a completion request of about ``tokens`` tokens, trying each
+        credential at most once. Raises the error of the last one tried when
+        none answered."""
+        tried = []
+        error = None
+        while True:
+            credential = self.acquire(tokens, exclude=tried)
+            if credential is None:
+                if error is not None:
+                    raise error
+                raise openai.error.RateLimitError(
+                    "Every upstream credential is rate limited"
+                )
+            tried.append(credential)
+            headers = None
+            try:
+                requestor = api_requestor.APIRequestor(
+                    key=credential.key, api_base=credential.api_base
+                )
+                response, _, api_key = requestor.request("post", "/completions", params)
+                headers = response._headers
+            except openai.error.RateLimitError as err:
+                headers = err.headers or {}
+                self.eject(credential, credential.retry_after(headers))
+                error = err
+                continue
+            except (
+                openai.error.APIConnectionError,
+                openai.error.ServiceUnavailableError,
+                openai.error.Timeout,
+            ) as err:
+                self.eject(credential, settings.UPSTREAM_EJECT_SECONDS, keep_last=True)
+                error = err
+                continue
+            finally:
+                self.release(credential, tokens, headers)
+            return util.convert_to_openai_object(response, api_key)
+
+    def metrics(self):
+        with self._lock:
+            now = time.monotonic()
+            return [c.as_dict(now) for c in self.credentials]
+
+
+def parse_credentials(entries):
+    """Credentials of entries like "sk-...;weight=2;api_base=https://..."."""
+    credentials = []
+    for entry in entries:
+        key, *options = entry.split(";")
+        options = dict(option.split("=", 1) for option in options)
+        credentials.append(
+            Credential(
+                key.strip(),
+                weight=float(options.get("weight", 1)),
+                api_base=options.get("api_base"),
+            )
+        )
+    return credentials
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def pool() -> CredentialPool:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = CredentialPool(
+                parse_credentials(settings.OPENAI_KEYS or [settings.OPENAI_KEY])
+            )
+    return _pool
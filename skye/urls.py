@@ -11,10 +11,17 @@ urlpatterns = [
     path("user", views.get_user),
     # business
     path("ask", views.ask),
+    path("jobs/<int:pk>", views.get_job),
+    path("jobs/<int:pk>/cancel", views.cancel_job),
     path("invitation-code", views.get_invitation_code),
     path("invitees", views.get_invitees),
+    path("invitees/tree", views.get_invitee_tree),
     path("redeem", views.redeem),
     path("balance", views.get_balance),
     path("redeemcodes", views.get_redeemcode_history),
     path("gifts", views.get_gift_list),
+    path("completions", views.get_completions),
+    path("completions/<int:pk>", views.get_completion),
+    # operations
+    path("metrics", views.get_metrics),
 ]
@@ -0,0 +1,52 @@
+"""Per-user version tokens of the data behind the history endpoints, used
+as their ETags.
+
+A token is a random value kept in cache until the data changes: bumping a
+version deletes it, and the next read picks a new one. Unlike counters,
+tokens never come back to an old value when the cache is flushed.
+
+The tokens must be shared by all the processes: a process caching its own
+would answer 304 with data another process changed. They are not used, and
+the endpoints answer without ETags, unless the cache is shared.
+"""
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+GIFTS = "gifts"
+REDEEM_CODES = "redeem_codes"
+COMPLETIONS = "completions"
+INVITEES = "invitees"
+
+
+def enabled() -> bool:
+    from .routers import cache_is_shared
+
+    return cache_is_shared()
+
+
+def _key(resource, user_id):
+    return f"skye:version:{resource}:{user_id}"
+
+
+def get(user_id, *resources) -> str:
+    """The version of the ``resources`` of a user, as one string."""
+    keys = [_key(resource, user_id) for resource in resources]
+    tokens = cache.get_many(keys)
+    for key in keys:
+        if key not in tokens:
+            cache.add(key, uuid.uuid4().hex[:16], settings.VERSION_TOKEN_TTL)
+            tokens[key] = cache.get(key) or uuid.uuid4().hex[:16]
+    return "-".join(tokens[key] for key in keys)
+
+
+def bump(resource, user_ids, using=None):
+    """Invalidate the version of ``resource`` of these users, now and once
+    the current transaction commits: a read racing the transaction would
+    otherwise tie the old data to the new version."""
+    keys = [_key(resource, user_id) for user_id in user_ids if user_id is not None]
+    if keys:
+        cache.delete_many(keys)
+        transaction.on_commit(lambda: cache.delete_many(keys), using=using)
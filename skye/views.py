@@ -1,4 +1,7 @@
-import json
+import contextvars
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from http import HTTPStatus
 
 import openai
@@ -7,14 +10,40 @@ from django.contrib import auth
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.db import IntegrityError, transaction
-from django.db.models import Sum
-from django.http import HttpResponse, JsonResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.utils import timezone
 from django.views.decorators.csrf import ensure_csrf_cookie, csrf_exempt
-from django.views.decorators.http import require_safe, require_POST
+from django.views.decorators.http import condition, require_safe, require_POST
 
-from .gpt import GPT
-from .models import Profile, RedeemCode, Gift, Completion
+from skye_server import log
+from skye_server.mysql import pool as database_pool
+
+from . import api, billing, fallback, fuzzy_cache, jobs, passwords, upstream, versions
+from .idempotency import idempotent
+from .api import JsonResponse, Schema, optional
+from .gpt import GPT, MAX_TOKENS
+from .models import Profile, RedeemCode, Gift, Completion, CompletionJob
+
+logger = logging.getLogger(__name__)
+
+
+def _overloaded():
+    response = JsonResponse(
+        {"error": "overloaded"}, status=HTTPStatus.SERVICE_UNAVAILABLE
+    )
+    response["Retry-After"] = "1"
+    return response
+
+
+def _etag(*resources):
+    """ETags of the GET endpoints listing the ``resources`` of the user."""
+
+    def etag_func(request, *args, **kwargs):
+        if not versions.enabled():
+            return None
+        return versions.get(request.user.pk, *resources)
+
+    return etag_func
 
 
 @ensure_csrf_cookie
@@ -22,9 +51,17 @@ def csrf(request):
     return HttpResponse(status=HTTPStatus.OK)
 
 
+REGISTER = Schema({"name": str, "email": str, "password": str, "invitation_code": str})
+LOGIN = Schema({"email": str, "password": str})
+# the prompts and params are checked by the schema of the model
+ASK = Schema({"model": str, "long": optional(bool), "async": optional(bool)})
+REDEEM = Schema({"code": str})
+
+
 @require_POST
+@api.json_body(REGISTER)
 def register(request):
-    data = json.loads(request.body)
+    data = request.data
 
     # validate invitation code
     try:
@@ -34,38 +71,50 @@ def register(request):
             {"error": "illegal_invitation_code"}, status=HTTPStatus.UNPROCESSABLE_ENTITY
         )
 
-    # try creating a new user
+    # create the user, its profile and the awards in one go
+    user = User(
+        username=User.normalize_username(data["email"]),
+        email=User.objects.normalize_email(data["email"]),
+    )
     try:
-        user = User.objects.create_user(
-            username=data["email"], email=data["email"], password=data["password"]
-        )
+        user.password = passwords.make_password(data["password"])
+    except passwords.Overloaded:
+        return _overloaded()
+    user.profile = Profile.invited_by(inviter_profile, name=data["name"])
+    try:
+        with transaction.atomic():
+            user.save()
+            Gift.objects.bulk_create(
+                [
+                    Gift(
+                        user=user,
+                        amount=settings.GIFT_AMOUNT * 2,
+                        reason=Gift.REASON_ACCEPTED_INVITATION,
+                    ),
+                    Gift(
+                        user_id=inviter_profile.user_id,
+                        amount=settings.GIFT_AMOUNT,
+                        reason=Gift.REASON_SUCCESSFUL_INVITATION,
+                    ),
+                ]
+            )
+            versions.bump(versions.GIFTS, [user.pk, inviter_profile.user_id])
     except IntegrityError as err:
         if "username" in str(err):
             return JsonResponse({"error": "user_exists"}, status=HTTPStatus.CONFLICT)
         raise
-
-    # make awards
-    user.profile.name = data["name"]
-    user.profile.inviter = inviter_profile.user
-    with transaction.atomic():
-        user.save()
-        Gift.objects.create(
-            user=user,
-            amount=settings.GIFT_AMOUNT * 2,
-            reason=Gift.REASON_ACCEPTED_INVITATION,
-        )
-        Gift.objects.create(
-            user=user.profile.inviter,
-            amount=settings.GIFT_AMOUNT,
-            reason=Gift.REASON_SUCCESSFUL_INVITATION,
-        )
+    Profile.invalidate_downline_stats(user.profile.ancestor_ids())
     return HttpResponse(status=HTTPStatus.OK)
 
 
 @require_POST
+@api.json_body(LOGIN)
 def login(request):
-    data = json.loads(request.body)
-    user = auth.authenticate(username=data["email"], password=data["password"])
+    data = request.data
+    try:
+        user = auth.authenticate(username=data["email"], password=data["password"])
+    except passwords.Overloaded:
+        return _overloaded()
     if user is None:
         return HttpResponse(status=HTTPStatus.UNAUTHORIZED)
     else:
@@ -98,10 +147,12 @@ def get_user(request):
 
 
 @require_POST
+@api.json_body(ASK)
 @login_required
+@idempotent
 def ask(request):
     user = request.user
-    data = json.loads(request.body)
+    data = request.data
 
     # only VIP can use original GPT model
     if data["model"] == "general" and not user.profile.is_vip:
@@ -111,33 +162,46 @@ def ask(request):
     gpt = GPT.load_model(data["model"])
     if not gpt:
         return JsonResponse({"error": "wrong_model"}, status=HTTPStatus.BAD_REQUEST)
+    error = api.model_schema(data["model"]).validate(data)
+    if error:
+        return api.bad_request(error)
 
-    # check balance
-    a = _account(user)
-    if a["paid_balance"] + a["gifted_balance"] - a["total_usage"] < 0:
+    if "params" not in data:
+        data["params"] = None
+
+    if data.get("async"):
+        if data.get("long"):
+            return api.bad_request("long answers can't be asked asynchronously")
+        return _ask_async(user, data)
+
+    if data.get("long"):
+        if not gpt.model.chunk_field:
+            return JsonResponse({"error": "wrong_model"}, status=HTTPStatus.BAD_REQUEST)
+        return _ask_long(user, data)
+
+    # put a hold on the balance for the in-flight completion
+    hold = billing.reserve(user, MAX_TOKENS)
+    if not hold:
         return JsonResponse(
             {"error": "insufficient_balance"}, status=HTTPStatus.BAD_REQUEST
         )
 
-    if "params" not in data:
-        data["params"] = None
     try:
         completion = gpt.create_completion(data["prompts"], data["params"])
     except openai.error.InvalidRequestError as err:
-        print(str(err))
+        hold.delete()
+        logger.error(
+            "Upstream rejected the completion request",
+            extra={"data": {"model": data["model"], "error": str(err)}},
+        )
         return JsonResponse(
             {"error": "skye_internal_error"}, status=HTTPStatus.INTERNAL_SERVER_ERROR
         )
-    Completion.objects.create(
-        user=user,
-        model=gpt.model.codename,
-        prompt=data["prompts"],
-        completion=completion["completion"],
-        finish_reason=completion["finish_reason"],
-        prompt_usage=completion["prompt_token_usage"],
-        completion_usage=completion["completion_token_usage"],
-        total_usage=completion["total_token_usage"],
-    )
+    except Exception:
+        hold.delete()
+        raise
+
+    billing.settle(user, gpt.model.codename, data["prompts"], completion, hold)
     return JsonResponse(
         {
             "data": {
@@ -149,19 +213,140 @@ def ask(request):
     )
 
 
+def _ask_async(user, data):
+    """Queue the completion and answer 202 with the job to poll."""
+    if jobs.queue_full():
+        response = JsonResponse(
+            {"error": "queue_full"}, status=HTTPStatus.SERVICE_UNAVAILABLE
+        )
+        response["Retry-After"] = str(settings.JOB_MAX_WAIT)
+        return response
+    if jobs.pending_count(user) >= settings.JOB_USER_LIMIT:
+        return JsonResponse(
+            {"error": "too_many_jobs"}, status=HTTPStatus.TOO_MANY_REQUESTS
+        )
+
+    job = jobs.enqueue(user, data)
+    if not job:
+        return JsonResponse(
+            {"error": "insufficient_balance"}, status=HTTPStatus.BAD_REQUEST
+        )
+    response = JsonResponse({"data": job.as_dict()}, status=HTTPStatus.ACCEPTED)
+    response["Location"] = f"/jobs/{job.pk}"
+    return response
+
+
+def _ask_long(user, data):
+    """Complete the long text of a chunking model chunk by chunk, up to
+    GPT_CHUNK_CONCURRENCY chunks at once, and stream the results as JSON
+    lines in the order of the chunks. Each chunk is held and billed on its
+    own, in the request thread; the worker threads only talk to upstream."""
+    gpt = GPT.load_model(data["model"])
+    chunks = gpt.chunk_prompts(data["prompts"], settings.GPT_CHUNK_TOKENS)
+    concurrency = settings.GPT_CHUNK_CONCURRENCY
+
+    def complete(prompts):
+        # models keep the rendered prompt, each chunk needs its own
+        return GPT.load_model(data["model"]).create_completion(prompts, data["params"])
+
+    def line(d):
+        return api.dumps(d) + b"\n"
+
+    def stream():
+        executor = ThreadPoolExecutor(concurrency)
+        in_flight = deque()
+        sent = 0
+        try:
+            for index in range(len(chunks)):
+                while sent < len(chunks) and len(in_flight) < concurrency:
+                    hold = billing.reserve(user, MAX_TOKENS)
+                    if not hold:
+                        break
+                    # keep the request id in the logs of the worker thread
+                    context = contextvars.copy_context()
+                    future = executor.submit(context.run, complete, chunks[sent])
+                    in_flight.append((chunks[sent], hold, future))
+                    sent += 1
+                if not in_flight:
+                    yield line({"index": index, "error": "insufficient_balance"})
+                    return
+
+                prompts, hold, future = in_flight.popleft()
+                try:
+                    completion = future.result()
+                except openai.error.InvalidRequestError as err:
+                    hold.delete()
+                    logger.error(
+                        "Upstream rejected the completion request",
+                        extra={"data": {"model": data["model"], "error": str(err)}},
+                    )
+                    yield line({"index": index, "error": "skye_internal_error"})
+                    return
+                except Exception:
+                    hold.delete()
+                    raise
+                billing.settle(user, gpt.model.codename, prompts, completion, hold)
+                yield line(
+                    {
+                        "index": index,
+                        "completion": completion["completion"],
+                        "finish_reason": completion["finish_reason"],
+                    }
+                )
+        finally:
+            # chunks already sent upstream are billed even if the stream stops
+            for prompts, hold, future in in_flight:
+                try:
+                    completion = future.result()
+                except Exception:
+                    hold.delete()
+                else:
+                    billing.settle(user, gpt.model.codename, prompts, completion, hold)
+            executor.shutdown(wait=False)
+
+    return StreamingHttpResponse(stream(), content_type="application/x-ndjson")
+
+
+@require_safe
+@login_required
+def get_job(request, pk):
+    """The job, waiting up to ?wait seconds for it to finish."""
+    try:
+        timeout = min(max(float(request.GET.get("wait", 0)), 0), settings.JOB_MAX_WAIT)
+    except ValueError:
+        return api.bad_request("wait must be a number of seconds")
+    job = jobs.wait(request.user, pk, timeout)
+    if job is None:
+        return HttpResponse(status=HTTPStatus.NOT_FOUND)
+    return JsonResponse({"data": job.as_dict()}, status=HTTPStatus.OK)
+
+
+@require_POST
+@login_required
+def cancel_job(request, pk):
+    job = CompletionJob.objects.filter(user=request.user, pk=pk).first()
+    if job is None:
+        return HttpResponse(status=HTTPStatus.NOT_FOUND)
+    if not jobs.cancel(job):
+        return JsonResponse({"error": "job_finished"}, status=HTTPStatus.CONFLICT)
+    return JsonResponse({"data": job.as_dict()}, status=HTTPStatus.OK)
+
+
 @require_safe
 @login_required
 def get_invitation_code(request):
-    user = request.user
-    code = user.profile.assure_invitation_code()
-    user.save()
+    profile = request.user.profile
+    code = profile.assure_invitation_code()
+    # a GET only writes the first time
+    profile.save_changes()
     return JsonResponse({"data": {"code": code}}, status=HTTPStatus.OK)
 
 
 @require_safe
 @login_required
+@condition(etag_func=_etag(versions.INVITEES))
 def get_invitees(request):
-    invitees = request.user.invitee_set.all()
+    invitees = request.user.invitee_set.select_related("user")
     return JsonResponse(
         {
             "data": [
@@ -177,37 +362,78 @@ def get_invitees(request):
     )
 
 
+@require_safe
+@login_required
+def get_invitee_tree(request):
+    profile = request.user.profile
+    try:
+        max_depth = int(request.GET.get("depth", 3))
+    except ValueError:
+        return JsonResponse({"error": "wrong_depth"}, status=HTTPStatus.BAD_REQUEST)
+
+    downline = (
+        profile.downline(max_depth)
+        .select_related("user", "inviter")
+        .order_by("invitation_path")[: settings.INVITATION_TREE_LIMIT]
+    )
+    return JsonResponse(
+        {
+            "data": {
+                "stats": profile.downline_stats(),
+                "invitees": [
+                    {
+                        "name": invitee.name,
+                        "email": invitee.user.email,
+                        "inviter": invitee.inviter.email,
+                        "level": invitee.invitation_depth - profile.invitation_depth,
+                        "joined_at": invitee.user.date_joined,
+                    }
+                    for invitee in downline
+                ],
+            }
+        },
+        status=HTTPStatus.OK,
+    )
+
+
 @require_POST
+@api.json_body(REDEEM)
 @login_required
+@idempotent
 def redeem(request):
-    data = json.loads(request.body)
-
-    # validate the redeem code
-    try:
-        redeemcode = RedeemCode.objects.get(code=data["code"])
-    except RedeemCode.DoesNotExist:
-        return JsonResponse({"error": "wrong_code"}, status=HTTPStatus.BAD_REQUEST)
-    if redeemcode.redeemer:
-        return JsonResponse({"error": "code_used"}, status=HTTPStatus.BAD_REQUEST)
+    data = request.data
+    inviter_id = request.user.profile.inviter_id
 
-    # redeem and send a gift to the inviter
-    user = request.user
-    redeemcode.redeemer = user
-    redeemcode.redeemed_at = timezone.now()
+    # redeem the code unless somebody did it before, and send a gift to the inviter
     with transaction.atomic():
-        redeemcode.save()
-        Gift.objects.create(
-            user=user.profile.inviter,
-            amount=int(redeemcode.amount * 0.03),
-            reason=Gift.REASON_INVITEE_REDEEMED,
-        )
+        redeemed = RedeemCode.objects.filter(
+            code=data["code"], redeemer__isnull=True
+        ).update(redeemer=request.user, redeemed_at=timezone.now())
+        if redeemed:
+            versions.bump(versions.REDEEM_CODES, [request.user.pk])
+            amount = RedeemCode.objects.values_list("amount", flat=True).get(
+                code=data["code"]
+            )
+            Gift.objects.create(
+                user_id=inviter_id,
+                amount=int(amount * 0.03),
+                reason=Gift.REASON_INVITEE_REDEEMED,
+            )
+
+    if redeemed:
+        Profile.invalidate_downline_stats([inviter_id])
+    else:
+        if RedeemCode.objects.filter(code=data["code"]).exists():
+            return JsonResponse({"error": "code_used"}, status=HTTPStatus.BAD_REQUEST)
+        return JsonResponse({"error": "wrong_code"}, status=HTTPStatus.BAD_REQUEST)
     return HttpResponse(status=HTTPStatus.OK)
 
 
 @require_safe
 @login_required
+@condition(etag_func=_etag(versions.GIFTS, versions.REDEEM_CODES, versions.COMPLETIONS))
 def get_balance(request):
-    a = _account(request.user)
+    a = billing.account(request.user)
     return JsonResponse(
         {
             "data": {
@@ -220,6 +446,7 @@ def get_balance(request):
 
 @require_safe
 @login_required
+@condition(etag_func=_etag(versions.REDEEM_CODES))
 def get_redeemcode_history(request):
     history = RedeemCode.objects.filter(redeemer=request.user)
     return JsonResponse(
@@ -239,6 +466,7 @@ def get_redeemcode_history(request):
 
 @require_safe
 @login_required
+@condition(etag_func=_etag(versions.GIFTS))
 def get_gift_list(request):
     history = request.user.gift_set.all()
     return JsonResponse(
@@ -256,12 +484,103 @@ def get_gift_list(request):
     )
 
 
-def _account(user):
-    total_usage = user.completion_set.aggregate(Sum("total_usage"))["total_usage__sum"]
-    paid_balance = user.redeemcode_set.aggregate(Sum("amount"))["amount__sum"]
-    gifted_balance = user.gift_set.aggregate(Sum("amount"))["amount__sum"]
-    return {
-        "total_usage": total_usage or 0,
-        "paid_balance": paid_balance or 0,
-        "gifted_balance": gifted_balance or 0,
-    }
+@require_safe
+@login_required
+@condition(etag_func=_etag(versions.COMPLETIONS))
+def get_completions(request):
+    """Completions of the user, newest first, optionally only those containing
+    ``q``. The next page starts ``before`` the id returned as ``next``."""
+    try:
+        before = int(request.GET["before"]) if "before" in request.GET else None
+        limit = int(request.GET.get("limit", settings.COMPLETION_PAGE_SIZE))
+    except ValueError:
+        return api.bad_request("before and limit must be int")
+    limit = max(1, min(limit, 100))
+    q = request.GET.get("q", "").strip()
+
+    completions = Completion.objects.for_user(request.user.pk).order_by("-pk")
+    if before is not None:
+        completions = completions.filter(pk__lt=before)
+    if q:
+        completions = completions.filter(search__text__fulltext=q)
+    page = list(completions[: limit + 1])
+    Completion.load_bodies(page[:limit])
+    return JsonResponse(
+        {
+            "data": [
+                {
+                    "id": completion.pk,
+                    "model": completion.model,
+                    "prompt": completion.prompt,
+                    "snippet": _snippet(completion, q),
+                    "finish_reason": completion.finish_reason,
+                    "created_at": completion.created_at,
+                }
+                for completion in page[:limit]
+            ],
+            "next": page[limit - 1].pk if len(page) > limit else None,
+        },
+        status=HTTPStatus.OK,
+    )
+
+
+@require_safe
+@login_required
+def get_completion(request, pk):
+    try:
+        completion = Completion.objects.for_user(request.user.pk).get(pk=pk)
+    except Completion.DoesNotExist:
+        return HttpResponse(status=HTTPStatus.NOT_FOUND)
+    return JsonResponse(
+        {
+            "data": {
+                "id": completion.pk,
+                "model": completion.model,
+                "upstream_model": completion.upstream_model,
+                "prompt": completion.prompt,
+                "completion": completion.completion,
+                "finish_reason": completion.finish_reason,
+                "created_at": completion.created_at,
+            }
+        },
+        status=HTTPStatus.OK,
+    )
+
+
+@require_safe
+def get_metrics(request):
+    if not request.user.is_staff:
+        return HttpResponse(status=HTTPStatus.NOT_FOUND)
+    return JsonResponse(
+        {
+            "data": {
+                "databases": database_pool.metrics(),
+                "log": log.metrics(),
+                "fuzzy_cache": fuzzy_cache.metrics,
+                "passwords": passwords.pool().metrics(),
+                "models": fallback.router().metrics(),
+                "upstream": upstream.pool().metrics(),
+            }
+        },
+        status=HTTPStatus.OK,
+    )
+
+
+def _snippet(completion, q):
+    """A preview of the completion around the first occurrence of ``q``, or
+    of the prompts if only they contain it."""
+    width = settings.COMPLETION_SNIPPET_LENGTH
+    prompts = completion.prompt
+    prompts = prompts.values() if isinstance(prompts, dict) else [prompts]
+    for text in [completion.completion, *map(str, prompts)]:
+        i = text.lower().find(q.lower()) if q else 0
+        if i < 0:
+            continue
+        start = max(0, min(i - (width - len(q)) // 2, len(text) - width))
+        end = start + width
+        return (
+            ("…" if start > 0 else "")
+            + text[start:end]
+            + ("…" if end < len(text) else "")
+        )
+    return completion.completion[:width]
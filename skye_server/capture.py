@@ -0,0 +1,93 @@
+"""Capture of the shape of the production traffic, see
+middleware.TrafficCaptureMiddleware and the replay_traffic command.
+
+A record is one JSON line: the start time, an anonymized user, the method,
+the URL route and query, the status and duration, and the shape of the JSON
+body. Texts are replaced by their length; only the model, its params and
+the flags of /ask are kept as they are.
+"""
+import gzip
+import hashlib
+import hmac
+import json
+import queue
+import threading
+
+from django.conf import settings
+
+# body and query fields whose values are kept
+KEEP = {"model", "params", "long", "async", "limit", "wait"}
+
+
+def anonymize(user_id):
+    if user_id is None:
+        return None
+    key = settings.SECRET_KEY.encode("utf-8")
+    digest = hmac.new(key, str(user_id).encode("utf-8"), hashlib.sha256)
+    return digest.hexdigest()[:12]
+
+
+def shape(value):
+    """The lengths of the texts in ``value``."""
+    if isinstance(value, str):
+        return len(value)
+    if isinstance(value, dict):
+        return {k: shape(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [shape(v) for v in value]
+    return value
+
+
+def shape_fields(d):
+    return {k: v if k in KEEP else shape(v) for k, v in d.items()}
+
+
+class Writer:
+    """Appends records to a JSON lines file from a background thread.
+    Records are dropped (and counted) when the queue is full."""
+
+    def __init__(self, path, capacity=10000):
+        self.path = path
+        self.queue = queue.Queue(capacity)
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        """Wait for the records written so far to be in the file."""
+        self.queue.join()
+
+    def _run(self):
+        with open(self.path, "a", encoding="utf-8") as f:
+            while True:
+                record = self.queue.get()
+                f.write(json.dumps(record, separators=(",", ":")) + "\n")
+                if self.queue.empty():
+                    f.flush()
+                self.queue.task_done()
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def writer(path) -> Writer:
+    with _writers_lock:
+        if path not in _writers:
+            _writers[path] = Writer(path)
+        return _writers[path]
+
+
+def read(path):
+    """The records of a capture, which may have been gzipped since."""
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
@@ -0,0 +1,168 @@
+"""Structured logging: one JSON object per line, written by a background
+thread so that request threads never wait on the log stream.
+
+Use ``extra={"data": {...}}`` to attach fields to a record.
+"""
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+import time
+import weakref
+from logging.handlers import QueueHandler, QueueListener
+
+from django.conf import settings
+
+request_id = contextvars.ContextVar("request_id", default=None)
+
+
+def _cap(value, limit):
+    if isinstance(value, str) and len(value) > limit:
+        return f"{value[:limit]}…[{len(value) - limit} more]"
+    if isinstance(value, dict):
+        return {k: _cap(v, limit) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_cap(v, limit) for v in value]
+    return value
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as a JSON line, strings longer than
+    LOG_MAX_FIELD_LENGTH are cut."""
+
+    def format(self, record):
+        limit = settings.LOG_MAX_FIELD_LENGTH
+        d = {
+            "time": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": _cap(record.getMessage(), limit),
+            "request_id": getattr(record, "request_id", None),
+        }
+        data = getattr(record, "data", None)
+        if data:
+            d.update(_cap(data, limit))
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            d["suppressed"] = suppressed
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            d["exception"] = _cap(record.exc_text, limit)
+        return json.dumps(d, ensure_ascii=False, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets through at most ``burst`` records of the same logger and message
+    template at once, refilled at ``rate`` records per second. The next
+    record let through reports how many were suppressed meanwhile."""
+
+    def __init__(self, rate=None, burst=None, level=logging.WARNING):
+        super().__init__()
+        self.rate = settings.LOG_ERROR_RATE if rate is None else rate
+        self.burst = settings.LOG_ERROR_BURST if burst is None else burst
+        self.level = level
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def filter(self, record):
+        if record.levelno < self.level:
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            tokens, last, suppressed = self._buckets.get(key, (self.burst, now, 0))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self._buckets[key] = (tokens, now, suppressed + 1)
+                return False
+            self._buckets[key] = (tokens - 1, now, 0)
+        record.suppressed = suppressed
+        return True
+
+
+class _Listener(QueueListener):
+    def enqueue_sentinel(self):
+        # the queue may be full, wait for the records ahead to be written
+        self.queue.put(self._sentinel)
+
+
+_handlers = weakref.WeakSet()
+
+
+class AsyncHandler(QueueHandler):
+    """Hands records over to a bounded queue drained by a listener thread,
+    which writes them to ``stream`` as JSON lines. Records are dropped
+    instead of blocking when the queue is full, and counted in metrics()."""
+
+    def __init__(self, stream=None, capacity=None):
+        self.capacity = capacity or settings.LOG_QUEUE_SIZE
+        super().__init__(queue.Queue(self.capacity))
+        target = logging.StreamHandler(stream or sys.stdout)
+        target.setFormatter(JsonFormatter())
+        self.dropped = 0
+        self.listener = _Listener(self.queue, target, respect_handler_level=True)
+        self.listener.start()
+        _handlers.add(self)
+
+    def _after_fork(self):
+        # the listener thread isn't forked, and the queue may have been
+        # locked by it: a forked process starts its own
+        self.queue = self.listener.queue = queue.Queue(self.capacity)
+        self.listener._thread = None
+        self.dropped = 0
+        self.listener.start()
+
+    def prepare(self, record):
+        # only what can't wait is done in the calling thread, the record is
+        # formatted by the listener
+        record.request_id = request_id.get()
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        # flushes the queue, logging.shutdown() closes the handlers at exit
+        _handlers.discard(self)
+        if self.listener._thread:
+            self.listener.stop()
+        super().close()
+
+
+def _after_fork_in_child():
+    for handler in list(_handlers):
+        handler._after_fork()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def metrics():
+    """The records waiting in the queues of the AsyncHandlers of this
+    process, and the ones dropped since it started."""
+    handlers = list(_handlers)
+    return {
+        "queued": sum(h.queue.qsize() for h in handlers),
+        "dropped": sum(h.dropped for h in handlers),
+    }
+
+
+def sampled(codename):
+    """Whether the bodies of this completion of model ``codename`` should be
+    logged, see LOG_BODY_SAMPLE_RATES."""
+    rates = settings.LOG_BODY_SAMPLE_RATES
+    rate = rates.get(codename, settings.LOG_BODY_SAMPLE_RATE)
+    return rate > 0 and random.random() < rate
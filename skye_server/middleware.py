@@ -1,5 +1,41 @@
+import json
+import logging
+import re
+import time
+import uuid
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
 from django.http import HttpRequest, HttpResponseNotFound
 
+from skye import routers
+from skye_server import capture, log
+
+logger = logging.getLogger(__name__)
+
+
+class RequestIdMiddleware:
+    """Tags the log records of a request with its X-Request-ID header, or a
+    new id, and returns the id in the response."""
+
+    HEADER = "X-Request-ID"
+    VALID = re.compile(r"^[\w.-]{1,64}$")
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request: HttpRequest):
+        request_id = request.headers.get(self.HEADER, "")
+        if not self.VALID.match(request_id):
+            request_id = uuid.uuid4().hex
+        token = log.request_id.set(request_id)
+        try:
+            response = self.get_response(request)
+        finally:
+            log.request_id.reset(token)
+        response[self.HEADER] = request_id
+        return response
+
 
 class HideAdminFromNonStaffMiddleware:
     """Run this after django.contrib.auth.middleware.AuthenticationMiddleware"""
@@ -9,7 +45,77 @@ class HideAdminFromNonStaffMiddleware:
 
     def __call__(self, request: HttpRequest):
         if request.path.startswith("/admin") and not request.user.is_staff:
-            print("NON-STAFF WAS TRYING TO ACCESS ADMIN!")
+            logger.warning(
+                "Non-staff was trying to access admin",
+                extra={"data": {"path": request.path, "user_id": request.user.pk}},
+            )
             return HttpResponseNotFound()
         else:
             return self.get_response(request)
+
+
+class ReadReplicaMiddleware:
+    """Run this after django.contrib.sessions.middleware.SessionMiddleware
+
+    Pins the reads of unsafe requests, and of safe requests of users who
+    wrote recently, to the primary database."""
+
+    SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request: HttpRequest):
+        user_id = routers.session_user_id(request)
+        safe = request.method in self.SAFE_METHODS
+        sticky = routers.is_sticky(request, user_id)
+        with routers.pinned_to_primary(not safe or sticky):
+            response = self.get_response(request)
+        if not safe and settings.DATABASE_REPLICAS:
+            user_id = routers.session_user_id(request)
+            if user_id is not None:
+                routers.stick(response, user_id)
+        return response
+
+
+class TrafficCaptureMiddleware:
+    """Run this after django.contrib.auth.middleware.AuthenticationMiddleware
+
+    Records the anonymized shape of every request but the admin ones to
+    TRAFFIC_CAPTURE_PATH, see skye_server.capture. Unused unless set."""
+
+    def __init__(self, get_response):
+        if not settings.TRAFFIC_CAPTURE_PATH:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.writer = capture.writer(settings.TRAFFIC_CAPTURE_PATH)
+
+    def __call__(self, request: HttpRequest):
+        if request.path.startswith("/admin"):
+            return self.get_response(request)
+        # read before the view, which may consume the stream
+        body = request.body if request.content_type == "application/json" else b""
+        started_at = time.time()
+        started = time.perf_counter()
+        response = self.get_response(request)
+        elapsed = time.perf_counter() - started
+
+        match = request.resolver_match
+        record = {
+            "t": round(started_at, 3),
+            "user": capture.anonymize(request.user.pk),
+            "method": request.method,
+            "route": match.route if match else None,
+            "query": capture.shape_fields(request.GET.dict()),
+            "status": response.status_code,
+            "ms": round(elapsed * 1000, 1),
+        }
+        if body:
+            try:
+                data = json.loads(body)
+            except ValueError:
+                data = None
+            if isinstance(data, dict):
+                record["body"] = capture.shape_fields(data)
+        self.writer.write(record)
+        return response
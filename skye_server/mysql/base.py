@@ -0,0 +1,39 @@
+"""The MySQL backend of Django, with its connections kept in a pool of the
+process instead of being opened and closed for every request, see
+skye_server.mysql.pool. Set DATABASE_POOL_SIZE to 0 to go without."""
+from functools import partial
+
+from django.db.backends.mysql import base
+from django.db.backends.mysql.base import Database
+
+from .pool import PoolTimeout, pool
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def get_new_connection(self, conn_params):
+        connect = partial(base.DatabaseWrapper.get_new_connection, self, conn_params)
+        try:
+            return pool(self.alias).acquire(connect)
+        except PoolTimeout as err:
+            raise Database.OperationalError(str(err)) from err
+
+    def init_connection_state(self):
+        # the session variables of a pooled connection are set already
+        if not getattr(self.connection, "skye_initialized", False):
+            super().init_connection_state()
+            self.connection.skye_initialized = True
+
+    def _close(self):
+        connection = self.connection
+        if connection is None:
+            return
+        if self.in_atomic_block:
+            # its transaction must not be carried on by another request
+            pool(self.alias).discard(connection)
+            return
+        try:
+            connection.rollback()
+        except Database.Error:
+            pool(self.alias).discard(connection)
+        else:
+            pool(self.alias).release(connection)
@@ -0,0 +1,167 @@
+"""Pools of database connections, one per database and process.
+
+A connection taken from the pool is checked first if it was idle: pinged
+after DATABASE_POOL_CHECK_AFTER seconds, and dropped without a ping after
+DATABASE_POOL_MAX_IDLE seconds, which should be below the wait_timeout of
+the server. A serverless process thawed after a freeze sees its connections
+idle for the whole freeze, and replaces those the server or the network
+dropped meanwhile. The idle time is the longest of the monotonic and the
+wall clock ones, the monotonic clock may not count a suspended host.
+"""
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeout(Exception):
+    """No connection was given back to the pool in time."""
+
+
+class Pool:
+    """Up to ``size`` connections, opened with the ``connect`` callable
+    passed to acquire. Connections are pinged with their ping method."""
+
+    def __init__(self, size, timeout, check_after, max_idle):
+        self.size = size
+        self.timeout = timeout
+        self.check_after = check_after
+        self.max_idle = max_idle
+        self._cond = threading.Condition()
+        # (connection, monotonic time, wall time) of the idle connections
+        self._idle = []
+        self.open = 0
+        self.in_use = 0
+        self.acquired = 0
+        self.waited = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.timeouts = 0
+        self.dropped = 0
+
+    def _idle_for(self, since, since_wall):
+        return max(time.monotonic() - since, time.time() - since_wall)
+
+    def _take(self):
+        """An idle connection and how long it was idle, or (None, None) when
+        a new one may be opened."""
+        started = time.monotonic()
+        with self._cond:
+            while not self._idle and self.open >= self.size:
+                remaining = started + self.timeout - time.monotonic()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise PoolTimeout(
+                        f"No connection of the {self.size} of the pool was "
+                        f"given back within {self.timeout}s"
+                    )
+                self._cond.wait(remaining)
+            waited = time.monotonic() - started
+            self.acquired += 1
+            self.in_use += 1
+            if waited > 0.001:
+                self.waited += 1
+                self.wait_seconds += waited
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+            if self._idle:
+                # the most recent one: the others may expire meanwhile
+                connection, since, since_wall = self._idle.pop()
+                return connection, self._idle_for(since, since_wall)
+            self.open += 1
+            return None, None
+
+    def _usable(self, connection, idle):
+        if idle > self.max_idle:
+            return False
+        if idle > self.check_after:
+            try:
+                connection.ping()
+            except Exception:
+                return False
+        return True
+
+    def acquire(self, connect):
+        while True:
+            connection, idle = self._take()
+            if connection is None:
+                try:
+                    return connect()
+                except Exception:
+                    self._forget()
+                    raise
+            if self._usable(connection, idle):
+                return connection
+            logger.info(
+                "Dropped a stale database connection",
+                extra={"data": {"idle_seconds": round(idle, 1)}},
+            )
+            self.discard(connection)
+
+    def release(self, connection):
+        with self._cond:
+            self.in_use -= 1
+            self._idle.append((connection, time.monotonic(), time.time()))
+            self._cond.notify()
+
+    def discard(self, connection):
+        """Close a connection taken from the pool instead of giving it back."""
+        try:
+            connection.close()
+        except Exception:
+            pass
+        self._forget()
+
+    def _forget(self):
+        with self._cond:
+            self.open -= 1
+            self.in_use -= 1
+            self.dropped += 1
+            self._cond.notify()
+
+    def metrics(self):
+        with self._cond:
+            return {
+                "size": self.size,
+                "open": self.open,
+                "in_use": self.in_use,
+                "idle": len(self._idle),
+                "acquired": self.acquired,
+                "waited": self.waited,
+                "wait_ms": round(self.wait_seconds * 1000),
+                "max_wait_ms": round(self.max_wait_seconds * 1000),
+                "timeouts": self.timeouts,
+                "dropped": self.dropped,
+            }
+
+
+_pools = {}
+_pools_pid = None
+_pools_lock = threading.Lock()
+
+
+def pool(alias) -> Pool:
+    global _pools_pid
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            # a forked process must not share the sockets of its parent,
+            # nor close them: its pools start empty
+            _pools.clear()
+            _pools_pid = os.getpid()
+        if alias not in _pools:
+            _pools[alias] = Pool(
+                settings.DATABASE_POOL_SIZE,
+                settings.DATABASE_POOL_TIMEOUT,
+                settings.DATABASE_POOL_CHECK_AFTER,
+                settings.DATABASE_POOL_MAX_IDLE,
+            )
+        return _pools[alias]
+
+
+def metrics():
+    with _pools_lock:
+        pools = dict(_pools) if _pools_pid == os.getpid() else {}
+    return {alias: p.metrics() for alias, p in sorted(pools.items())}